@@ -29,6 +29,7 @@ def from_module_import(module_name: str, *elements: Tuple[str]) -> Tuple[Any]:
     return tuple(sys.modules[module_name].__dict__[el] for el in elements)
 
 from_module_import("vtk_convenience")
+from_module_import("shared_mesh")
 Vector3D, *_ = from_module_import("vtk_convenience", "Vector3D")
 Spine, Endplate, Body = from_module_import("morphology", "Spine", "Endplate", "Body")
 
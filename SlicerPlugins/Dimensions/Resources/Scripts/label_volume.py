@@ -0,0 +1,399 @@
+"""
+Vertebra surfaces straight from a CT label map.
+
+A labelled NIfTI or NRRD volume, one integer label per vertebra, is read
+with vtk's own readers and the surfaces of all vertebrae are extracted in
+a single multi-label pass, without exporting an STL file per level:
+
+    flying-edges  vtkDiscreteFlyingEdges3D, one closed surface per label
+    surface-nets  vtkSurfaceNets3D, faces between adjacent vertebrae are
+                  shared and turned to face outwards for either one
+
+Labels follow the VerSe convention, 1 to 24 being C1 to L5 as in
+Spine.VERTEBRAE; other labels, e.g. the sacrum, are ignored. Points are
+given in the RAS world coordinates of the file: the sform (or qform) of
+a NIfTI file, space origin and space directions of a NRRD file, read
+from its header and turned from LPS or LAS into RAS.
+
+Every surface is then smoothed with a windowed sinc filter and, given a
+budget, decimated to at most that many triangles per vertebra. Both are
+set per process by configure_extraction, by default from the
+SLOPES_VOLUME_* environment variables.
+
+Single vertebrae are addressed as "<volume>#<level>", which load_stl
+reads, and slopes_cli.py and slopes_batch.py take a label map in place
+of a list of STL files or a spine directory. The last volumes extracted
+are cached per process, so loading all levels of one file reads it once.
+
+Usage:
+    configure_extraction(method="surface-nets", triangles=20000)
+    vertebrae = read_vertebrae("patient_042.nii.gz")   # {"T11": vtkPolyData, ...}
+    load_stl("patient_042.nii.gz#L1")
+"""
+from __future__ import annotations
+
+import os
+import re
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from labelled_surface import Mesh, level_name, mesh_polydata, split_by_label
+from vtkmodules.vtkCommonDataModel import vtkImageData, vtkPolyData
+
+SUFFIXES = (".nii", ".nii.gz", ".nrrd", ".nhdr")
+SEPARATOR = "#"
+METHODS = ("flying-edges", "surface-nets")
+METHOD_VARIABLE = "SLOPES_VOLUME_METHOD"
+SMOOTHING_VARIABLE = "SLOPES_VOLUME_SMOOTHING"
+TRIANGLES_VARIABLE = "SLOPES_VOLUME_TRIANGLES"
+# the pass band of 3D Slicer's closed surfaces at smoothing factor 0.5
+PASS_BAND = 0.01
+# signs turning the coordinates of a NRRD "space" into RAS
+NRRD_SPACES = {
+    "right-anterior-superior": (1, 1, 1),
+    "ras": (1, 1, 1),
+    "left-anterior-superior": (-1, 1, 1),
+    "las": (-1, 1, 1),
+    "left-posterior-superior": (-1, -1, 1),
+    "lps": (-1, -1, 1),
+}
+
+
+@dataclass(frozen=True)
+class Extraction:
+    """
+    Keyword Arguments:
+    method - one of METHODS
+    smoothing - windowed sinc iterations per vertebra, 0 for none
+    triangles - maximum number of triangles per vertebra, 0 for no decimation
+    """
+    method: str = "flying-edges"
+    smoothing: int = 20
+    triangles: int = 0
+
+
+_extraction: Optional[Extraction] = None
+
+
+def configure_extraction(
+    method: Optional[str] = None, smoothing: Optional[int] = None, triangles: Optional[int] = None
+) -> Extraction:
+    """
+    Select how this process extracts surfaces from label maps. Arguments
+    not given default to the SLOPES_VOLUME_METHOD, SLOPES_VOLUME_SMOOTHING
+    and SLOPES_VOLUME_TRIANGLES environment variables, then to Extraction.
+    """
+    global _extraction  # pylint: disable=global-statement
+    default = Extraction()
+    method = method or os.environ.get(METHOD_VARIABLE, default.method)
+    if method not in METHODS:
+        raise ValueError(f"unknown extraction method {method!r}, expected one of {', '.join(METHODS)}")
+    _extraction = Extraction(
+        method=method,
+        smoothing=int(os.environ.get(SMOOTHING_VARIABLE, default.smoothing)) if smoothing is None else smoothing,
+        triangles=int(os.environ.get(TRIANGLES_VARIABLE, default.triangles)) if triangles is None else triangles,
+    )
+    return _extraction
+
+
+def current_extraction() -> Extraction:
+    """The Extraction of this process, configured from the environment on first use."""
+    return _extraction or configure_extraction()
+
+
+def is_volume(filename: str) -> bool:
+    return filename.lower().endswith(SUFFIXES) and os.path.isfile(filename)
+
+
+def is_volume_member(filename: str) -> bool:
+    """Whether "filename" names a level of a label map, "<volume>#<level>"."""
+    volume, separator, _ = filename.rpartition(SEPARATOR)
+    return bool(separator) and volume.lower().endswith(SUFFIXES)
+
+
+def read_label_volume(filename: str) -> Tuple[vtkImageData, np.ndarray]:
+    """
+    The labels of a NIfTI or NRRD file on a grid at the origin with
+    identity directions, and the 4x4 matrix from that grid to world.
+    """
+    # pylint: disable=import-outside-toplevel
+    from vtkmodules.vtkIOImage import vtkNIFTIImageReader, vtkNrrdReader
+
+    reader = vtkNrrdReader() if filename.lower().endswith((".nrrd", ".nhdr")) else vtkNIFTIImageReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    image = reader.GetOutput()
+
+    matrix = np.eye(4)
+    spacing = image.GetSpacing()
+    if isinstance(reader, vtkNIFTIImageReader):
+        form = reader.GetSFormMatrix() or reader.GetQFormMatrix()
+        if form is not None:
+            matrix = np.array([[form.GetElement(i, j) for j in range(4)] for i in range(4)])
+        matrix[:3, 3] += matrix[:3, :3] @ np.array(image.GetOrigin())
+    else:
+        # vtkNrrdReader drops the space directions, except for their lengths
+        geometry = nrrd_geometry(filename)
+        if geometry is None:
+            matrix[:3, 3] = image.GetOrigin()
+        else:
+            spacing, matrix = geometry
+
+    grid = vtkImageData()
+    grid.ShallowCopy(image)
+    grid.SetSpacing(*spacing)
+    grid.SetOrigin(0.0, 0.0, 0.0)
+    grid.SetDirectionMatrix(1, 0, 0, 0, 1, 0, 0, 0, 1)
+    return grid, matrix
+
+
+def nrrd_header(filename: str) -> Dict[str, str]:
+    """The fields of the header of a NRRD file, or of a detached .nhdr header, by lower case name."""
+    with open(filename, "rb") as file:
+        data = file.read(1 << 16)
+    end = data.find(b"\n\n")
+    lines = data[: end if end >= 0 else len(data)].decode("latin-1").splitlines()
+    if not lines or not lines[0].startswith("NRRD"):
+        raise ValueError(f"{filename} is not a NRRD file")
+    fields = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(": ")
+        if separator and not line.startswith("#"):
+            fields[name.strip().lower()] = value.strip()
+    return fields
+
+
+def _vectors(text: str) -> List[Optional[np.ndarray]]:
+    """The vectors "(x,y,z)" of a NRRD field in order, None for "none"."""
+    return [
+        None if word == "none" else np.array([float(v) for v in word.strip("()").split(",")])
+        for word in re.findall(r"\([^)]*\)|none", text)
+    ]
+
+
+def nrrd_geometry(filename: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Spacing, and 4x4 matrix from a grid with that spacing to RAS world
+    coordinates, of a NRRD file with "space directions"; None without.
+    """
+    fields = nrrd_header(filename)
+    if "space directions" not in fields:
+        return None
+    space = fields.get("space", "right-anterior-superior").lower()
+    if space not in NRRD_SPACES:
+        raise ValueError(f"{filename}: unsupported NRRD space {space!r}, expected one of {', '.join(NRRD_SPACES)}")
+    directions = [d for d in _vectors(fields["space directions"]) if d is not None]
+    if len(directions) != 3 or any(len(d) != 3 for d in directions):
+        raise ValueError(f"{filename}: expected three spatial axes, got {fields['space directions']!r}")
+    directions = np.column_stack(directions)
+    origin = _vectors(fields["space origin"])[0] if "space origin" in fields else np.zeros(3)
+
+    spacing = np.linalg.norm(directions, axis=0)
+    to_ras = np.diag(NRRD_SPACES[space])
+    matrix = np.eye(4)
+    matrix[:3, :3] = to_ras @ directions / spacing
+    matrix[:3, 3] = to_ras @ origin
+    return spacing, matrix
+
+
+def vertebra_labels(image: vtkImageData) -> List[int]:
+    """Labels 1 to 24, C1 to L5, present in "image"."""
+    values = conv.vtk_to_numpy(image.GetPointData().GetScalars())
+    if values.ndim > 1:
+        values = values[:, 0]
+    if values.dtype.kind in "iu":
+        clipped = np.where((values >= 1) & (values <= 24), values, 0).astype(np.intp)
+        present = np.flatnonzero(np.bincount(clipped, minlength=25))
+    else:
+        present = np.unique(np.rint(values)).astype(np.intp)
+    return [int(label) for label in present if 1 <= label <= 24]
+
+
+def _flying_edges(image: vtkImageData, labels: Sequence[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # pylint: disable=import-outside-toplevel
+    from vtkmodules.vtkFiltersGeneral import vtkDiscreteFlyingEdges3D
+
+    extract = vtkDiscreteFlyingEdges3D()
+    extract.SetInputData(image)
+    for index, label in enumerate(labels):
+        extract.SetValue(index, label)
+    extract.ComputeNormalsOff()
+    extract.ComputeGradientsOff()
+    extract.ComputeScalarsOn()
+    extract.Update()
+
+    output = extract.GetOutput()
+    arrays = conv.polydata_to_arrays(output)
+    triangles = arrays.get("polys_connectivity", np.zeros(0, dtype=np.int64)).reshape(-1, 3)
+    scalars = conv.vtk_to_numpy(output.GetPointData().GetScalars()) if triangles.size else np.zeros(0)
+    return arrays["points"], triangles, np.rint(scalars[triangles[:, 0]]).astype(np.int64)
+
+
+def _surface_nets(image: vtkImageData, labels: Sequence[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # pylint: disable=import-outside-toplevel
+    from vtkmodules.vtkFiltersCore import vtkSurfaceNets3D
+
+    extract = vtkSurfaceNets3D()
+    extract.SetInputData(image)
+    for index, label in enumerate(labels):
+        extract.SetLabel(index, label)
+    extract.SetOutputMeshTypeToTriangles()
+    # smoothed per vertebra afterwards, as with flying edges
+    extract.SmoothingOff()
+    extract.Update()
+
+    output = extract.GetOutput()
+    arrays = conv.polydata_to_arrays(output)
+    triangles = arrays.get("polys_connectivity", np.zeros(0, dtype=np.int64)).reshape(-1, 3)
+    if not triangles.size:
+        return arrays["points"], triangles, np.zeros(0, dtype=np.int64)
+    pairs = conv.vtk_to_numpy(output.GetCellData().GetArray("BoundaryLabels")).astype(np.int64)
+    # a face between two vertebrae faces out of the first, so turn it for the second
+    return (
+        arrays["points"],
+        np.concatenate([triangles, triangles[:, ::-1]]),
+        np.concatenate([pairs[:, 0], pairs[:, 1]]),
+    )
+
+
+def smooth(polydata: vtkPolyData, iterations: int) -> vtkPolyData:
+    """Windowed sinc smoothing, which keeps the volume of a closed surface."""
+    # pylint: disable=import-outside-toplevel
+    from vtkmodules.vtkFiltersCore import vtkWindowedSincPolyDataFilter
+
+    smoother = vtkWindowedSincPolyDataFilter()
+    smoother.SetInputData(polydata)
+    smoother.SetNumberOfIterations(iterations)
+    smoother.SetPassBand(PASS_BAND)
+    smoother.NormalizeCoordinatesOn()
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.Update()
+    return smoother.GetOutput()
+
+
+def _finish(mesh: Mesh, extraction: Extraction) -> Mesh:
+    if not extraction.smoothing and not (extraction.triangles and len(mesh[1]) > extraction.triangles):
+        return mesh
+    polydata = mesh_polydata(mesh)
+    if extraction.smoothing:
+        polydata = smooth(polydata, extraction.smoothing)
+    if extraction.triangles:
+        polydata = conv.decimate(polydata, extraction.triangles)
+    arrays = conv.polydata_to_arrays(polydata)
+    return arrays["points"].astype(float), arrays["polys_connectivity"].reshape(-1, 3)
+
+
+def extract_levels(filename: str, extraction: Optional[Extraction] = None) -> Dict[str, Mesh]:
+    """Points and triangles per level of a label map, ordered cranial to caudal."""
+    extraction = extraction or current_extraction()
+    image, matrix = read_label_volume(filename)
+    labels = vertebra_labels(image)
+    extract = _surface_nets if extraction.method == "surface-nets" else _flying_edges
+    points, triangles, triangle_labels = extract(image, labels)
+
+    points = points @ matrix[:3, :3].T + matrix[:3, 3]
+    if np.linalg.det(matrix[:3, :3]) < 0:
+        # a mirroring transform turns every face inwards
+        triangles = triangles[:, ::-1]
+    return {
+        level_name(label): _finish(mesh, extraction)
+        for label, mesh in sorted(split_by_label(points, triangles, triangle_labels).items())
+    }
+
+
+@lru_cache(maxsize=4)
+def _cached_levels(filename: str, modified: float, extraction: Extraction) -> Dict[str, Mesh]:
+    return extract_levels(filename, extraction)
+
+
+def _levels(filename: str) -> Dict[str, Mesh]:
+    return _cached_levels(os.path.abspath(filename), os.path.getmtime(filename), current_extraction())
+
+
+def read_vertebrae(filename: str) -> Dict[str, vtkPolyData]:
+    """A geometry per level of a label map, ordered cranial to caudal."""
+    return {level: mesh_polydata(mesh) for level, mesh in _levels(filename).items()}
+
+
+def volume_members(filename: str) -> List[str]:
+    """
+    "<volume>#<level>" of every vertebra in a label map, cranial to
+    caudal. Only the labels are read, the surfaces are extracted on load.
+    """
+    image, _ = read_label_volume(filename)
+    return [f"{filename}{SEPARATOR}{level_name(label)}" for label in vertebra_labels(image)]
+
+
+def volume_name(filename: str) -> str:
+    """File name of a label map without its suffix, e.g. "patient_042" of "patient_042.nii.gz"."""
+    name = os.path.basename(filename)
+    suffix = next((s for s in SUFFIXES if name.lower().endswith(s)), "")
+    return name[: len(name) - len(suffix)]
+
+
+def load_volume_member(filename: str) -> vtkPolyData:
+    volume, _, level = filename.rpartition(SEPARATOR)
+    levels = _levels(volume)
+    if level not in levels:
+        raise KeyError(f"{volume} has no vertebra {level}")
+    return mesh_polydata(levels[level])
+
+
+def boundary_faces(image: vtkImageData) -> np.ndarray:
+    """
+    Number of voxel faces on the boundary of each label 0 to 24, other
+    labels counted as 0. Both extraction methods give about two triangles
+    per such face, before smoothing and decimation, a little less along
+    edges of the surface.
+    """
+    values = conv.vtk_to_numpy(image.GetPointData().GetScalars())
+    if values.ndim > 1:
+        values = values[:, 0]
+    if values.dtype.kind not in "iu":
+        values = np.rint(values)
+    # faces on the border of the volume are not extracted
+    values = np.where((values >= 1) & (values <= 24), values, 0).astype(np.intp).reshape(image.GetDimensions()[::-1])
+    faces = np.zeros(25, dtype=np.int64)
+    for axis in range(3):
+        lower = np.moveaxis(values, axis, 0)[:-1]
+        upper = np.moveaxis(values, axis, 0)[1:]
+        boundary = lower != upper
+        faces += np.bincount(lower[boundary], minlength=25) + np.bincount(upper[boundary], minlength=25)
+    return faces
+
+
+@lru_cache(maxsize=16)
+def _cached_triangle_estimates(filename: str, modified: float) -> Dict[str, int]:
+    image, _ = read_label_volume(filename)
+    faces = boundary_faces(image)
+    return {level_name(label): 2 * int(faces[label]) for label in vertebra_labels(image)}
+
+
+def volume_member_triangles(filename: str) -> int:
+    """
+    Estimated triangles of "<volume>#<level>", two per voxel face on the
+    boundary of its label, at most the budget of current_extraction. Only
+    the labels are read, no surface is extracted.
+    """
+    volume, _, level = filename.rpartition(SEPARATOR)
+    estimates = _cached_triangle_estimates(os.path.abspath(volume), os.path.getmtime(volume))
+    if level not in estimates:
+        raise KeyError(f"{volume} has no vertebra {level}")
+    budget = current_extraction().triangles
+    return min(estimates[level], budget) if budget else estimates[level]
+
+
+def expand_volumes(filenames: Sequence[str]) -> List[str]:
+    """Replace every label map among "filenames" by its levels."""
+    expanded = []
+    for filename in filenames:
+        expanded += volume_members(filename) if is_volume(filename) else [filename]
+    return expanded
@@ -0,0 +1,399 @@
+"""
+Readers for one surface file holding all vertebrae of a spine.
+
+Segmentation tools often export a single labelled surface instead of one
+STL file per vertebra. Supported are:
+
+    .vtp, .ply  triangles with a per-cell (or per-point) label array,
+                e.g. "label"; 1 to 24 are C1 to L5 as in Spine.VERTEBRAE
+    .stl        several solids, ASCII "solid L1 ... endsolid L1" or
+                concatenated binary STL files with the level in their
+                header; the level is taken from the solid's name
+
+Labels other than 1 to 24, e.g. 26 for the sacrum in VerSe, and solids
+without a level in their name are ignored. Two solids of the same level
+are an error.
+
+The triangles are sorted by label once and every level becomes its own
+mesh holding only the points it uses, in their original order.
+
+Single vertebrae are addressed as "<surface>#<level>", which load_stl
+reads, and slopes_cli.py and slopes_batch.py take a surface file in
+place of a list of STL files or a spine directory. The last surfaces
+split are cached per process, so loading all levels of one file parses
+it once.
+
+Usage:
+    vertebrae = read_vertebrae("patient_042.vtp")   # {"T11": vtkPolyData, ...}
+    load_stl("patient_042.vtp#L1")
+"""
+from __future__ import annotations
+
+import os
+import re
+import struct
+
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+SUFFIXES = (".vtp", ".ply", ".stl")
+SEPARATOR = "#"
+LABEL_ARRAYS = ("label", "labels", "Label", "Labels", "vertebra")
+LEVEL_PATTERN = re.compile(r"[CTL]\d{1,2}", re.IGNORECASE)
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+# bytes searched for the element counts of PLY and VTP headers
+HEADER_BYTES = 1 << 16
+STL_FACET = np.dtype([("normal", "<f4", 3), ("corners", "<f4", (3, 3)), ("attribute", "<u2")])
+
+Mesh = Tuple[np.ndarray, np.ndarray]
+
+
+def _vertebrae():
+    # deferred, morphology imports vtk_convenience, which defers this module
+    from morphology import Spine  # pylint: disable=import-outside-toplevel
+
+    return Spine.VERTEBRAE
+
+
+def is_surface(filename: str) -> bool:
+    return filename.lower().endswith(SUFFIXES) and os.path.isfile(filename)
+
+
+def is_surface_member(filename: str) -> bool:
+    """Whether "filename" names a level of a labelled surface, "<surface>#<level>"."""
+    surface, separator, _ = filename.rpartition(SEPARATOR)
+    return bool(separator) and surface.lower().endswith(SUFFIXES)
+
+
+def level_name(label) -> str:
+    """Spine.VERTEBRAE name of a numeric label, 1 being C1, or of a name containing a level."""
+    vertebrae = _vertebrae()
+    if isinstance(label, (int, np.integer)) or (isinstance(label, float) and label.is_integer()):
+        if 1 <= int(label) <= len(vertebrae):
+            return vertebrae[int(label) - 1]
+        raise ValueError(f"label {label} is not one of 1 ({vertebrae[0]}) to {len(vertebrae)} ({vertebrae[-1]})")
+    match = LEVEL_PATTERN.search(str(label))
+    if match is None or match.group().upper() not in vertebrae:
+        raise ValueError(f"no vertebra level in {label!r}")
+    return match.group().upper()
+
+
+def split_by_label(points: np.ndarray, triangles: np.ndarray, labels: np.ndarray) -> Dict[object, Mesh]:
+    """
+    Split a triangle mesh by per-triangle labels. Every part keeps only
+    the points it uses, renumbered in their original order. Label 0 is
+    background and skipped.
+    """
+    order = np.argsort(labels, kind="stable")
+    values, starts = np.unique(labels[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
+    parts = {}
+    for value, start, stop in zip(values, starts, stops):
+        if value == 0:
+            continue
+        part = triangles[order[start:stop]]
+        used, renumbered = np.unique(part, return_inverse=True)
+        parts[value.item()] = (points[used], renumbered.reshape(-1, 3))
+    return parts
+
+
+def weld(corners: np.ndarray) -> Mesh:
+    """Points and triangles of a triangle soup of shape (t, 3, 3), merging identical corners."""
+    points, inverse = np.unique(corners.reshape(-1, 3), axis=0, return_inverse=True)
+    return points, inverse.reshape(-1, 3)
+
+
+def _binary_blocks(data: bytes) -> List[Tuple[bytes, int, int]]:
+    """Header, triangle offset and count of every concatenated binary STL, empty if "data" is not one."""
+    blocks, position = [], 0
+    while position + 84 <= len(data):
+        (count,) = np.frombuffer(data, dtype="<u4", count=1, offset=position + 80)
+        end = position + 84 + 50 * int(count)
+        if end > len(data):
+            return []
+        blocks.append((data[position : position + 80], position + 84, int(count)))
+        position = end
+    return blocks if position == len(data) else []
+
+
+def binary_stl_counts(filename: str) -> Optional[List[int]]:
+    """
+    Triangle count of every concatenated binary STL in a file, read from
+    their headers only; None if it is not one.
+    """
+    size = os.path.getsize(filename)
+    counts, position = [], 0
+    with open(filename, "rb") as file:
+        while position + 84 <= size:
+            file.seek(position + 80)
+            (count,) = struct.unpack("<I", file.read(4))
+            position += 84 + 50 * count
+            counts.append(count)
+    return counts if counts and position == size else None
+
+
+def surface_triangles(filename: str) -> Optional[int]:
+    """
+    Number of triangles of a labelled surface without reading its meshes:
+    from the headers of binary STL solids, "element face" of a PLY file or
+    NumberOfPolys of a VTP file. None if the header does not tell, as for
+    ASCII STL files.
+    """
+    if filename.lower().endswith(".stl"):
+        counts = binary_stl_counts(filename)
+        return sum(counts) if counts is not None else None
+    with open(filename, "rb") as file:
+        header = file.read(HEADER_BYTES)
+    pattern = rb"element\s+face\s+(\d+)" if filename.lower().endswith(".ply") else rb'NumberOfPolys="(\d+)"'
+    counts = [int(count) for count in re.findall(pattern, header)]
+    return sum(counts) if counts else None
+
+
+def read_stl_solids(filename: str) -> Dict[str, Mesh]:
+    """
+    Welded mesh per solid of a multi-solid ASCII or concatenated binary
+    STL, keyed by solid name. Raise ValueError if two solids share a name.
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+
+    blocks = _binary_blocks(data)
+    if blocks:
+        solids = [
+            (
+                header.decode("ascii", "replace").strip("\0 ").removeprefix("solid").strip(),
+                np.frombuffer(data, dtype=STL_FACET, count=count, offset=offset)["corners"].astype(float),
+            )
+            for header, offset, count in blocks
+        ]
+    else:
+        solids = [
+            (
+                match.group(1).decode("ascii", "replace").strip(),
+                np.array(re.findall(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)", match.group(2)), dtype=float).reshape(-1, 3, 3),
+            )
+            for match in re.finditer(rb"solid[ \t]*([^\r\n]*)(.*?)endsolid", data, re.DOTALL)
+        ]
+
+    meshes = {}
+    for name, corners in solids:
+        if name in meshes:
+            raise ValueError(f"{filename} has two solids named {name!r}")
+        meshes[name] = weld(corners)
+    return meshes
+
+
+def _ply_header(data: bytes) -> Tuple[str, List[tuple], int]:
+    end = data.index(b"end_header")
+    body = data.index(b"\n", end) + 1
+    fmt, elements = None, []
+    for line in data[:end].decode("ascii").splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == "format":
+            fmt = words[1]
+        elif words[0] == "element":
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == "property" and words[1] == "list":
+            elements[-1][2].append((words[4], (PLY_TYPES[words[2]], PLY_TYPES[words[3]])))
+        elif words[0] == "property":
+            elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+    return fmt, elements, body
+
+
+def read_ply(filename: str) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """
+    Points, triangles, and scalar per-point and per-face properties of a
+    triangle PLY file. vtkPLYReader drops custom face properties such as
+    labels, hence this reader.
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+    fmt, elements, position = _ply_header(data)
+    endian = {"binary_little_endian": "<", "binary_big_endian": ">"}.get(fmt)
+    numbers = np.array(data[position:].split(), dtype=float) if fmt == "ascii" else None
+
+    parsed = {}
+    for name, count, properties in elements:
+        # lists are read as fixed triples, verified by their count field below
+        fields = []
+        for prop, kind in properties:
+            if isinstance(kind, tuple):
+                fields += [(f"{prop}_count", kind[0]), (prop, kind[1], 3)]
+            else:
+                fields.append((prop, kind))
+        if fmt == "ascii":
+            width = sum(4 if isinstance(kind, tuple) else 1 for _, kind in properties)
+            rows = numbers[:count * width].reshape(count, width)
+            numbers = numbers[count * width:]
+            columns, column = {}, 0
+            for prop, kind in properties:
+                if isinstance(kind, tuple):
+                    columns[f"{prop}_count"] = rows[:, column]
+                    columns[prop] = rows[:, column + 1 : column + 4].astype(np.int64)
+                    column += 4
+                else:
+                    columns[prop] = rows[:, column]
+                    column += 1
+        else:
+            dtype = np.dtype([(f[0], endian + f[1], *f[2:]) for f in fields])
+            table = np.frombuffer(data, dtype=dtype, count=count, offset=position)
+            position += dtype.itemsize * count
+            columns = {f[0]: table[f[0]] for f in fields}
+        parsed[name] = columns
+
+    vertex, face = parsed["vertex"], parsed["face"]
+    list_name = next(n for n in ("vertex_indices", "vertex_index") if n in face)
+    if np.any(face[f"{list_name}_count"] != 3):
+        raise ValueError(f"{filename}: only triangle faces are supported")
+    points = np.column_stack([vertex["x"], vertex["y"], vertex["z"]]).astype(float)
+    point_arrays = {k: np.asarray(v) for k, v in vertex.items() if k not in ("x", "y", "z")}
+    cell_arrays = {k: np.asarray(v) for k, v in face.items() if not k.startswith(list_name)}
+    return points, np.asarray(face[list_name], dtype=np.int64), point_arrays, cell_arrays
+
+
+def read_vtp(filename: str) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """Points, triangles, and point and cell arrays of a VTK XML polydata file."""
+    # pylint: disable=import-outside-toplevel
+    from vtkmodules.vtkFiltersCore import vtkTriangleFilter
+    from vtkmodules.vtkIOXML import vtkXMLPolyDataReader
+
+    reader = vtkXMLPolyDataReader()
+    reader.SetFileName(filename)
+    triangulate = vtkTriangleFilter()
+    triangulate.SetInputConnection(reader.GetOutputPort())
+    triangulate.PassVertsOff()
+    triangulate.PassLinesOff()
+    triangulate.Update()
+    polydata = triangulate.GetOutput()
+
+    arrays = conv.polydata_to_arrays(polydata)
+    triangles = arrays.get("polys_connectivity", np.zeros(0, dtype=np.int64)).reshape(-1, 3)
+
+    def named(data) -> Dict[str, np.ndarray]:
+        return {
+            data.GetArrayName(i): conv.vtk_to_numpy(data.GetArray(i))
+            for i in range(data.GetNumberOfArrays())
+            if data.GetArray(i) is not None and data.GetArray(i).GetNumberOfComponents() == 1
+        }
+
+    return arrays["points"].astype(float), triangles, named(polydata.GetPointData()), named(polydata.GetCellData())
+
+
+def _labels(
+    filename: str, triangles: np.ndarray, point_arrays: Dict[str, np.ndarray], cell_arrays: Dict[str, np.ndarray],
+    label_array: Optional[str],
+) -> np.ndarray:
+    names = (label_array,) if label_array else LABEL_ARRAYS
+    for name in names:
+        if name in cell_arrays:
+            return np.rint(cell_arrays[name]).astype(np.int64)
+    for name in names:
+        if name in point_arrays:
+            # a triangle belongs to the vertebra of its first corner
+            return np.rint(point_arrays[name]).astype(np.int64)[triangles[:, 0]]
+    raise ValueError(f"{filename} has no label array, expected one of {', '.join(names)}")
+
+
+def split_surface(filename: str, label_array: Optional[str] = None) -> Dict[str, Mesh]:
+    """
+    Points and triangles per level of a labelled surface, ordered cranial
+    to caudal. Labels and solids that name no vertebra are skipped.
+    """
+    vertebrae = _vertebrae()
+    if filename.lower().endswith(".stl"):
+        named = read_stl_solids(filename).items()
+    else:
+        read = read_ply if filename.lower().endswith(".ply") else read_vtp
+        points, triangles, point_arrays, cell_arrays = read(filename)
+        labels = _labels(filename, triangles, point_arrays, cell_arrays, label_array)
+        named = split_by_label(points, triangles, labels).items()
+
+    parts = {}
+    for name, mesh in named:
+        try:
+            level = level_name(name)
+        except ValueError:
+            continue
+        if level in parts:
+            raise ValueError(f"{filename} has two solids of level {level}")
+        parts[level] = mesh
+    return dict(sorted(parts.items(), key=lambda item: vertebrae.index(item[0])))
+
+
+@lru_cache(maxsize=4)
+def _cached_split(filename: str, modified: float, label_array: Optional[str]) -> Dict[str, Mesh]:
+    return split_surface(filename, label_array)
+
+
+def _split(filename: str, label_array: Optional[str] = None) -> Dict[str, Mesh]:
+    return _cached_split(os.path.abspath(filename), os.path.getmtime(filename), label_array)
+
+
+def mesh_polydata(mesh: Mesh) -> vtkPolyData:
+    points, triangles = mesh
+    return conv.polydata_from_arrays({
+        "points": points.astype(np.float32),
+        "polys_offsets": np.arange(0, 3 * len(triangles) + 1, 3, dtype=conv.ID_TYPE),
+        "polys_connectivity": triangles.reshape(-1).astype(conv.ID_TYPE),
+    })
+
+
+def read_vertebrae(filename: str, label_array: Optional[str] = None) -> Dict[str, vtkPolyData]:
+    """A geometry per level of a labelled surface, ordered cranial to caudal."""
+    return {level: mesh_polydata(mesh) for level, mesh in _split(filename, label_array).items()}
+
+
+def surface_members(filename: str) -> List[str]:
+    """"<surface>#<level>" of every vertebra in a labelled surface, cranial to caudal."""
+    return [f"{filename}{SEPARATOR}{level}" for level in _split(filename)]
+
+
+def load_surface_member(filename: str) -> vtkPolyData:
+    surface, _, level = filename.rpartition(SEPARATOR)
+    parts = _split(surface)
+    if level not in parts:
+        raise KeyError(f"{surface} has no vertebra {level}")
+    return mesh_polydata(parts[level])
+
+
+def is_multi_solid(filename: str) -> bool:
+    """
+    Whether an STL file holds more than one solid, without parsing its
+    triangles: from the headers of a binary STL, or reading an ASCII STL
+    only up to its second "solid" line.
+    """
+    counts = binary_stl_counts(filename)
+    if counts is not None:
+        return len(counts) > 1
+    solids = 0
+    with open(filename, "rb") as file:
+        for line in file:
+            if line.lstrip().startswith(b"solid"):
+                solids += 1
+                if solids > 1:
+                    return True
+    return False
+
+
+def expand_surfaces(filenames: Sequence[str]) -> List[str]:
+    """Replace every labelled surface or multi-solid STL among "filenames" by its levels."""
+    expanded = []
+    for filename in filenames:
+        if is_surface(filename) and (not filename.lower().endswith(".stl") or is_multi_solid(filename)):
+            expanded += surface_members(filename)
+        else:
+            expanded.append(filename)
+    return expanded
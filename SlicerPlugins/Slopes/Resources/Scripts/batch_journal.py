@@ -0,0 +1,173 @@
+"""
+Completion journal of batch runs.
+
+A SQLite table records every attempt at a spine together with the
+parameters it was analysed with and the SHA-256 of the file written. An
+attempt is marked "running" and committed before the analysis starts, so
+a run killed in the middle of a spine (a pathological mesh, the OOM
+killer) leaves a trace: on restart that attempt counts as failed. Spines
+that are done, with an output file that still matches its hash, are
+skipped; failed ones are retried as long as the RetryPolicy allows.
+
+Usage:
+    with Journal("cohort.sqlite") as journal:
+        for job in journal.pending(jobs, parameters, RetryPolicy(max_attempts=2), output_of):
+            journal.start(job.spine_id, parameters)
+            ...
+            journal.finish(job.spine_id, parameters, digest)
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+
+from dataclasses import asdict, dataclass
+from time import time
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass(frozen=True)
+class JournalEntry:
+    spine_id: str
+    parameters: str
+    status: str
+    attempts: int
+    result_hash: Optional[str]
+    error: Optional[str]
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Keyword Arguments:
+    max_attempts - attempts per spine, including ones that crashed the run
+    """
+    max_attempts: int = 2
+
+    def should_run(self, entry: Optional[JournalEntry]) -> bool:
+        if entry is None:
+            return True
+        if entry.status == DONE:
+            return False
+        return entry.attempts < self.max_attempts
+
+
+def parameters_key(parameters: object) -> str:
+    """
+    Canonical text of a parameters dataclass, used to tell runs apart.
+    Fields that are 0, options switched off, are left out, so that adding
+    such an option keeps the keys of earlier runs.
+    """
+    return json.dumps({k: v for k, v in asdict(parameters).items() if v != 0}, sort_keys=True)
+
+
+def file_hash(filename: str) -> str:
+    with open(filename, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class Journal:
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.skipped = 0
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS spines (
+                    spine_id TEXT NOT NULL,
+                    parameters TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result_hash TEXT,
+                    error TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (spine_id, parameters)
+                )
+                """
+            )
+
+    def entry(self, spine_id: str, parameters: object) -> Optional[JournalEntry]:
+        row = self._connection.execute(
+            "SELECT spine_id, parameters, status, attempts, result_hash, error "
+            "FROM spines WHERE spine_id = ? AND parameters = ?",
+            (spine_id, parameters_key(parameters)),
+        ).fetchone()
+        return JournalEntry(*row) if row else None
+
+    def pending(
+        self,
+        jobs: Iterable,
+        parameters: object,
+        policy: RetryPolicy,
+        output_of: Callable[[str], str],
+    ) -> Iterator:
+        """
+        Yield the jobs still to be done. A finished spine whose output file
+        "output_of(spine_id)" is missing or altered is done again.
+        """
+        for job in jobs:
+            entry = self.entry(job.spine_id, parameters)
+            if entry is not None and entry.status == DONE and not _matches(output_of(job.spine_id), entry.result_hash):
+                entry = None
+            if policy.should_run(entry):
+                yield job
+            else:
+                self.skipped += 1
+
+    def start(self, spine_id: str, parameters: object) -> None:
+        with self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO spines (spine_id, parameters, status, attempts, updated)
+                VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT (spine_id, parameters) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = attempts + 1,
+                    updated = excluded.updated
+                """,
+                (spine_id, parameters_key(parameters), RUNNING, time()),
+            )
+
+    def finish(self, spine_id: str, parameters: object, result_hash: str) -> None:
+        self._set(spine_id, parameters, DONE, result_hash=result_hash)
+
+    def fail(self, spine_id: str, parameters: object, error: str) -> None:
+        self._set(spine_id, parameters, FAILED, error=error)
+
+    def _set(
+        self, spine_id: str, parameters: object, status: str,
+        result_hash: Optional[str] = None, error: Optional[str] = None,
+    ) -> None:
+        with self._connection:
+            self._connection.execute(
+                "UPDATE spines SET status = ?, result_hash = ?, error = ?, updated = ? "
+                "WHERE spine_id = ? AND parameters = ?",
+                (status, result_hash, error, time(), spine_id, parameters_key(parameters)),
+            )
+
+    def summary(self) -> Dict[str, int]:
+        """Number of spines per status; "running" ones crashed a previous run."""
+        return dict(self._connection.execute("SELECT status, COUNT(*) FROM spines GROUP BY status"))
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> Journal:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def _matches(filename: str, result_hash: Optional[str]) -> bool:
+    return os.path.exists(filename) and file_hash(filename) == result_hash
@@ -0,0 +1,496 @@
+"""
+Benchmark suite for the Slopes scripts.
+
+Each sub command measures one aspect of the analysis on a given set of
+vertebra STL files and prints a plain text table.
+
+Usage:
+    python benchmark.py workers L1.stl L2.stl L3.stl --workers 1 8 16 32
+    python benchmark.py smp L1.stl --backend STDThread --threads 1 2 4 8
+    python benchmark.py imports L1.stl L2.stl
+    python benchmark.py calibrate cohort/* -o cost_model.json
+    python benchmark.py decimation cohort/* --triangles 20000 5000 --errors 0.05 0.2 --proxies 20000
+    python benchmark.py centers L1.stl L2.stl L3.stl --target 100
+"""
+import importlib.util
+import os
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+from statistics import median
+from time import perf_counter
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from numpy import abs as absolute, array, concatenate, isnan, nan, nanmax, nanmean, zeros
+from numpy.linalg import norm
+
+import vtk_convenience as conv
+
+from cost_model import CostModel, spine_triangles
+from morphology import Spine, UpApproximator, Vertebra
+from slopes_batch import SpineJob, load_job, spine_jobs
+from spine_result import SpineResult
+from vtk_convenience import load_stl
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    """Return the median wall time of calling "func" "repeat" times in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    return median(timings)
+
+
+def benchmark_workers(filenames: List[str], workers: List[int], repeat: int, **parameters) -> None:
+    """
+    Print Spine construction time and speedup over the serial path
+    for each number of worker processes.
+    """
+    geometries = [load_stl(f) for f in filenames]
+    serial = Spine(geometries, **parameters)
+    serial_time = measure(lambda: Spine(geometries, **parameters), repeat)
+
+    print(f"{'workers':>8} {'seconds':>10} {'speedup':>8} {'identical':>10}")
+    print(f"{0:>8} {serial_time:>10.3f} {1.0:>8.2f} {'yes':>10}")
+    for count in workers:
+        parallel = Spine(geometries, workers=count, **parameters)
+        identical = parallel.angles == serial.angles
+        elapsed = measure(lambda: Spine(geometries, workers=count, **parameters), repeat)
+        print(f"{count:>8} {elapsed:>10.3f} {serial_time / elapsed:>8.2f} {'yes' if identical else 'NO':>10}")
+
+
+def smp_stages(geometry, lateral_axis, **_) -> dict:
+    """
+    Return the vtk filter stages of a vertebra analysis as
+    argument-free callables, with their inputs prepared beforehand.
+    """
+    center = conv.calc_center_of_mass(geometry)
+    return {
+        "clip_plane": lambda: conv.clip_plane(geometry, plane_origin=center, plane_normal=lateral_axis),
+        "cut_plane": lambda: conv.cut_plane(geometry, plane_origin=center, plane_normal=lateral_axis),
+        "_calc_normals": lambda: conv._calc_normals(geometry),
+        "calc_center_of_mass": lambda: conv.calc_center_of_mass(geometry),
+        "calc_obb": lambda: conv.calc_obb(geometry),
+    }
+
+
+def benchmark_smp(filenames: List[str], backend: str, threads: List[int], repeat: int, **parameters) -> None:
+    """
+    Print the time of each vtk filter stage on the largest given vertebra
+    per thread count, and its speedup over a single thread. Stages that do
+    not speed up are not multithreaded in this vtk build.
+    """
+    geometry = max((load_stl(f) for f in filenames), key=lambda g: g.GetNumberOfCells())
+    stages = smp_stages(geometry, **parameters)
+
+    timings = {}
+    for count in threads:
+        active_backend, _ = conv.configure_smp(backend, count)
+        timings[count] = {name: measure(stage, repeat) for name, stage in stages.items()}
+
+    print(f"backend: {active_backend}, triangles: {geometry.GetNumberOfCells()}")
+    print(f"{'stage':<20}" + "".join(f"{f'{count} thr (s)':>14}" for count in threads) + f"{'speedup':>9}")
+    for name in stages:
+        row = "".join(f"{timings[count][name]:>14.5f}" for count in threads)
+        speedup = timings[threads[0]][name] / timings[threads[-1]][name]
+        print(f"{name:<20}{row}{speedup:>9.2f}")
+
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_python(*arguments: str) -> subprocess.CompletedProcess:
+    """Run a fresh interpreter inside the scripts directory."""
+    return subprocess.run(
+        [sys.executable, *arguments],
+        cwd=SCRIPTS_DIRECTORY,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """Return the cumulative import time in microseconds per top-level package of "module"."""
+    stderr = run_python("-X", "importtime", "-c", f"import {module}").stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.rstrip()
+        # two leading spaces per nesting level; direct imports of "module" have one level
+        if len(name) - len(name.lstrip()) <= 3:
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def benchmark_imports(
+    filenames: List[str], repeat: int, target_help: float, target_analysis: float, top: int
+) -> None:
+    """
+    Print the largest contributors to importing morphology (-X importtime),
+    and the cold start time of "slopes_cli.py --help" and of a minimal
+    analysis of the given files against their targets.
+    """
+    times = import_times("morphology")
+    print(f"{'import':<40} {'cumulative (ms)':>16}")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[:top]:
+        print(f"{name:<40} {cumulative / 1000:>16.1f}")
+
+    runs = {
+        "slopes_cli.py --help": (["slopes_cli.py", "--help"], target_help),
+        "slopes_cli.py --output-axis 0": (["slopes_cli.py", *filenames, "--output-axis", "0"], target_analysis),
+    }
+    print()
+    print(f"{'cold start':<40} {'seconds':>10} {'target':>8}")
+    for name, (arguments, target) in runs.items():
+        elapsed = measure(lambda: run_python(*arguments), repeat)
+        verdict = "ok" if elapsed <= target else "SLOW"
+        print(f"{name:<40} {elapsed:>10.3f} {target:>8.2f} {verdict}")
+
+
+DIMENSIONS_SCRIPTS = os.path.join(SCRIPTS_DIRECTORY, os.pardir, os.pardir, os.pardir, "Dimensions", "Resources", "Scripts")
+
+
+def dimensions_morphology():
+    """The morphology module of the Dimensions plugin; its vtk_convenience is the same as ours."""
+    spec = importlib.util.spec_from_file_location("dimensions_morphology", os.path.join(DIMENSIONS_SCRIPTS, "morphology.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def cutter_centers(vertebra, endplates) -> list:
+    """Endplate centers as Dimensions computed them with vtkCutter, seeded by a point of the lateral curve."""
+    centers = []
+    for endplate in endplates:
+        seed = vertebra.body_laterally.curves[endplate].GetPoint(0)
+        cut = conv.cut_plane(vertebra.body.curves[endplate], plane_origin=seed, plane_normal=vertebra.orientation.front)
+        centers.append(array(cut.GetPoint(0)) if cut.GetNumberOfPoints() else None)
+    return centers
+
+
+def point_minmax(body, endplates) -> list:
+    """Curve extrema as Dimensions computed them, one GetPoint call per point."""
+    extrema = []
+    for endplate in endplates:
+        curve = body.curves[endplate]
+        points = array([curve.GetPoint(i) for i in range(curve.GetNumberOfPoints())])
+        distances = points.dot(body.regressions[endplate])
+        extrema.append((points[distances.argmin()], points[distances.argmax()]))
+    return extrema
+
+
+def benchmark_centers(filenames: List[str], repeat: int, target: float, **parameters) -> None:
+    """
+    Print the time per vertebra of the Dimensions height extraction from
+    the curve arrays, the endplate centers and the curve records with
+    their extrema, next to the vtkCutter and GetPoint code they replace,
+    in microseconds. Array stages slower than "target" are marked.
+    """
+    dimensions = dimensions_morphology()
+    endplates = dimensions.Endplate.options()
+    spine = dimensions.Spine([load_stl(f) for f in filenames], **parameters)
+    stages = {
+        "centers, arrays": (
+            lambda v: dimensions.Vertebra._calc_center(v.body, v.body_laterally, orientation=v.orientation), True
+        ),
+        "centers, vtkCutter": (lambda v: cutter_centers(v, endplates), False),
+        "minmax, arrays": (
+            lambda v: [dimensions.CurveRecord.from_polydata(v.body.curves[e], v.body.regressions[e]).extrema for e in endplates],
+            True,
+        ),
+        "minmax, GetPoint": (lambda v: point_minmax(v.body, endplates), False),
+    }
+
+    print(f"vertebrae: {len(spine)}")
+    print(f"{'stage':<20} {'us/vertebra':>12} {'target':>8}")
+    for name, (stage, targeted) in stages.items():
+        elapsed = measure(lambda: [stage(v) for v in spine], repeat) / len(spine) * 1e6
+        verdict = ("ok" if elapsed <= target else "SLOW") if targeted else ""
+        print(f"{name:<20} {elapsed:>12.1f} {f'{target:g}' if targeted else '':>8} {verdict}")
+
+
+def calibrate(directories: List[str], repeat: int, output: str, **parameters) -> None:
+    """
+    Time loading and analysing every vertebra, and the up approximation of
+    every spine, fit a CostModel to these timings and save it to "output".
+    Print the predicted and measured time per spine.
+    """
+    triangles, seconds, overheads, spines = [], [], [], []
+    for directory in directories:
+        job = SpineJob.from_directory(directory)
+        geometries = load_job(job)
+        up_approximator = UpApproximator(geometries)
+        overheads.append(measure(lambda: UpApproximator(geometries), repeat))
+        counts = spine_triangles(job.filenames)
+        timings = [
+            measure(lambda: Vertebra(load_stl(f), up_approximator=up_approximator, **parameters), repeat)
+            for f in job.filenames
+        ]
+        triangles += counts
+        seconds += timings
+        spines.append((job.spine_id, counts, overheads[-1] + sum(timings)))
+
+    model = CostModel.fit(triangles, seconds, overheads)
+    model.save(output)
+    print(f"per spine {model.per_spine:.4g} s, per vertebra {model.per_vertebra:.4g} s, per triangle {model.per_triangle:.4g} s")
+    print(f"{'spine':<20} {'levels':>6} {'triangles':>10} {'predicted':>10} {'measured':>10}")
+    for spine_id, counts, measured in spines:
+        print(f"{spine_id:<20} {len(counts):>6} {sum(counts):>10} {model.predict(counts):>10.3f} {measured:>10.3f}")
+
+
+def drift(full: List, decimated: List) -> Tuple[float, float]:
+    """Mean and maximum absolute difference over all spines; NaN where nothing was measured."""
+    difference = absolute(concatenate([array(d, dtype=float) - array(f, dtype=float) for f, d in zip(full, decimated)]))
+    if isnan(difference).all():
+        return nan, nan
+    return float(nanmean(difference)), float(nanmax(difference))
+
+
+def benchmark_decimation(
+    directories: List[str],
+    triangles: List[int],
+    errors: List[float],
+    repeat: int,
+    max_drift: float,
+    proxies: Sequence[int] = (),
+    **parameters,
+) -> None:
+    """
+    Analyse every spine at full resolution, decimated to each triangle
+    budget and error bound, and oriented on proxies of each size in
+    "proxies" (see Vertebra, "proxy_triangles"). Print the mean triangles per vertebra, the
+    time of decimating and of analysing all spines, the speedup of the
+    analysis alone, and how far segmental angles (degrees), widths and
+    centers (mm) drift from full resolution: mean and maximum over all
+    vertebrae of all spines. Heights are not compared, the Slopes analysis
+    does not measure them. Settings whose largest angle drift exceeds
+    "max_drift" are marked.
+    """
+    spines = [load_job(job) for job in spine_jobs(directories)]
+    settings = [("full", {}, 0)]
+    settings += [(f"<= {count} triangles", dict(triangles=count), 0) for count in triangles]
+    settings += [(f"<= {error:g} mm", dict(max_error=error), 0) for error in errors]
+    settings += [(f"proxy {count}", {}, count) for count in proxies]
+
+    rows = []
+    for name, decimation, proxy in settings:
+        results, angles, counts = [], [], []
+        decimating = analysing = 0.0
+        for geometries in spines:
+            decimate = lambda: [conv.decimate(g, **decimation) for g in geometries]
+            decimating += measure(decimate, repeat) if decimation else 0.0
+            decimated = decimate()
+            analysing += measure(lambda: Spine(decimated, lean=True, proxy_triangles=proxy, **parameters), repeat)
+            spine = Spine(decimated, lean=True, proxy_triangles=proxy, **parameters)
+            results.append(SpineResult.from_spine(spine, levels=[""] * len(spine)))
+            angles.append(spine.angles)
+            counts += [g.GetNumberOfPolys() for g in decimated]
+        rows.append((name, results, angles, decimating, analysing, sum(counts) / max(len(counts), 1)))
+
+    full_results, full_angles, full_seconds = rows[0][1], rows[0][2], rows[0][4]
+    print(f"spines: {len(spines)}, vertebrae: {sum(map(len, spines))}, maximum angle drift: {max_drift:g} deg")
+    print(
+        f"{'setting':<20} {'triangles':>10} {'decimate s':>11} {'analyse s':>10} {'speedup':>8}"
+        f" {'angle mean':>11} {'angle max':>10} {'width max':>10} {'center max':>11}"
+    )
+    for name, results, angles, decimating, analysing, count in rows:
+        angle_mean, angle_max = drift(full_angles, angles)
+        _, width_max = drift([r.widths for r in full_results], [r.widths for r in results])
+        _, center_max = drift(
+            [zeros(len(f)) for f in full_results],
+            [norm(r.centers - f.centers, axis=1) for r, f in zip(results, full_results)],
+        )
+        verdict = "" if angle_max <= max_drift else " DRIFT"
+        print(
+            f"{name:<20} {count:>10.0f} {decimating:>11.3f} {analysing:>10.3f} {full_seconds / analysing:>8.2f}"
+            f" {angle_mean:>11.4f} {angle_max:>10.4f} {width_max:>10.4f} {center_max:>11.4f}{verdict}"
+        )
+
+
+if __name__ == '__main__':
+    Parser = ArgumentParser(
+        prog='Slopes benchmark',
+        description='Measure the performance of the Slopes analysis on a set of vertebra STL files.',
+    )
+    Parser.add_argument(
+        '--repeat',
+        metavar='N',
+        type=int,
+        default=3,
+        help='Number of repetitions per measurement; the median is reported. (default: 3)',
+    )
+    Parser.add_argument(
+        '-r',
+        '--right',
+        metavar='FLOAT',
+        type=float,
+        nargs=3,
+        default=[1.0, 0.0, 0.0],
+        help='Direction of the subjects right. (default: 1 0 0)',
+    )
+    Commands = Parser.add_subparsers(dest='command', required=True)
+
+    Workers = Commands.add_parser('workers', help='Speedup of Spine(workers=N) over the serial path.')
+    Workers.add_argument('filenames', metavar='FILES', type=str, nargs='+', help='Vertebra STL files of one spine.')
+    Workers.add_argument(
+        '--workers',
+        metavar='N',
+        type=int,
+        nargs='+',
+        default=[2, 4, 8, 16, 32],
+        help='Worker counts to measure. (default: 2 4 8 16 32)',
+    )
+
+    Smp = Commands.add_parser('smp', help='Scaling of the vtk filter stages with the vtkSMPTools thread count.')
+    Smp.add_argument('filenames', metavar='FILES', type=str, nargs='+', help='Vertebra STL files; the largest is measured.')
+    Smp.add_argument(
+        '--backend',
+        metavar='NAME',
+        type=str,
+        help='vtkSMPTools backend. (default: $SLOPES_SMP_BACKEND or vtk default)',
+    )
+    Smp.add_argument(
+        '--threads',
+        metavar='N',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4, 8],
+        help='Thread counts to measure, ascending. (default: 1 2 4 8)',
+    )
+
+    Imports = Commands.add_parser('imports', help='Import time breakdown and cold start of slopes_cli.py.')
+    Imports.add_argument(
+        'filenames',
+        metavar='FILES',
+        type=str,
+        nargs='+',
+        help='Vertebra STL files for the minimal analysis, two are enough.',
+    )
+    Imports.add_argument(
+        '--target-help',
+        metavar='SEC',
+        type=float,
+        default=0.2,
+        help='Target cold start of "slopes_cli.py --help" in seconds. (default: 0.2)',
+    )
+    Imports.add_argument(
+        '--target-analysis',
+        metavar='SEC',
+        type=float,
+        default=1.5,
+        help='Target cold start of the minimal analysis in seconds; importing scipy.interpolate alone takes about half a second. (default: 1.5)',
+    )
+    Imports.add_argument(
+        '--top',
+        metavar='N',
+        type=int,
+        default=10,
+        help='Number of imports to list. (default: 10)',
+    )
+
+    Decimation = Commands.add_parser('decimation', help='Drift of angles and dimensions of decimated vertebrae against full resolution.')
+    Decimation.add_argument(
+        'directories',
+        metavar='DIRS',
+        type=str,
+        nargs='+',
+        help='Spine directories, archives, surfaces or packs as for slopes_batch.py.',
+    )
+    Decimation.add_argument(
+        '--triangles',
+        metavar='N',
+        type=int,
+        nargs='*',
+        default=[20000, 10000, 5000, 2000],
+        help='Triangle budgets per vertebra to measure. (default: 20000 10000 5000 2000)',
+    )
+    Decimation.add_argument(
+        '--errors',
+        metavar='MM',
+        type=float,
+        nargs='*',
+        default=[0.02, 0.05, 0.1, 0.2],
+        help='Error bounds in mm to measure. (default: 0.02 0.05 0.1 0.2)',
+    )
+    Decimation.add_argument(
+        '--max-drift',
+        metavar='DEG',
+        type=float,
+        default=0.5,
+        help='Largest acceptable change of any segmental angle in degrees; settings beyond it are marked. (default: 0.5)',
+    )
+    Decimation.add_argument(
+        '--proxies',
+        metavar='N',
+        type=int,
+        nargs='*',
+        default=[],
+        help='Proxy sizes in triangles to orient the full resolution vertebrae on, as --proxy-triangles of slopes_batch.py. (default: none)',
+    )
+
+    Centers = Commands.add_parser('centers', help='Time of the Dimensions endplate centers and curve extrema per vertebra.')
+    Centers.add_argument('filenames', metavar='FILES', type=str, nargs='+', help='Vertebra STL files of one spine.')
+    Centers.add_argument(
+        '--target',
+        metavar='US',
+        type=float,
+        default=100.0,
+        help='Target time of each array stage per vertebra in microseconds. (default: 100)',
+    )
+
+    Calibrate = Commands.add_parser('calibrate', help='Fit the cost model of slopes_batch.py --largest-first.')
+    Calibrate.add_argument(
+        'directories',
+        metavar='DIRS',
+        type=str,
+        nargs='+',
+        help='Spine directories as for slopes_batch.py, ideally of different sizes.',
+    )
+    Calibrate.add_argument(
+        '-o',
+        '--output',
+        metavar='FILE',
+        type=str,
+        default='cost_model.json',
+        help='File to save the cost model to. (default: cost_model.json)',
+    )
+
+    Arguments = Parser.parse_args()
+    Parameters = dict(
+        lateral_axis=array(Arguments.right),
+        slice_thickness=0.25,
+        max_angle=45.0,
+    )
+    if Arguments.command == 'workers':
+        benchmark_workers(Arguments.filenames, Arguments.workers, Arguments.repeat, **Parameters)
+    elif Arguments.command == 'smp':
+        benchmark_smp(Arguments.filenames, Arguments.backend, Arguments.threads, Arguments.repeat, **Parameters)
+    elif Arguments.command == 'imports':
+        benchmark_imports(
+            [os.path.abspath(f) for f in Arguments.filenames],
+            Arguments.repeat,
+            target_help=Arguments.target_help,
+            target_analysis=Arguments.target_analysis,
+            top=Arguments.top,
+        )
+    elif Arguments.command == 'decimation':
+        benchmark_decimation(
+            Arguments.directories,
+            Arguments.triangles,
+            Arguments.errors,
+            Arguments.repeat,
+            Arguments.max_drift,
+            Arguments.proxies,
+            **Parameters,
+        )
+    elif Arguments.command == 'centers':
+        benchmark_centers(Arguments.filenames, Arguments.repeat, Arguments.target, **Parameters)
+    elif Arguments.command == 'calibrate':
+        calibrate(Arguments.directories, Arguments.repeat, Arguments.output, **Parameters)
@@ -0,0 +1,357 @@
+"""
+Streaming statistics of the angles of a cohort.
+
+Per pair of adjacent vertebrae, e.g. "L1/L2", CohortStatistics keeps the
+running moments (Welford) and a histogram of fixed resolution. Both are
+updated per spine as it is analysed, merged exactly across workers by
+adding them up, and saved as one small .npz file. A new spine is then
+compared against the cohort without reading its CSV files again:
+
+    stats.percentile("L1/L2", -7.05)    # constant time
+
+Angles between endplates are bounded, so a histogram over [-180, 180]
+degrees serves as quantile sketch: unlike t-digest and friends, merging
+is exact and independent of order, and percentiles are off by at most
+half a bin ("resolution", 0.05 degrees by default).
+
+Every file records the parameters of the analysis and the ids of the
+spines counted, so that statistics of different settings are not mixed
+and a spine is counted only once.
+
+Usage:
+    python cohort_stats.py build results/*.csv -o cohort.npz --max-angle 45
+    python cohort_stats.py merge queue/stats/*.npz -o cohort.npz
+    python cohort_stats.py show cohort.npz
+    python cohort_stats.py lookup cohort.npz patient_042.csv
+"""
+from __future__ import annotations
+
+import csv
+import json
+import os
+import sys
+
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+import numpy as np
+
+LIMIT = 180.0
+
+
+@dataclass
+class RunningMoments:
+    """Count, mean, sum of squared deviations (m2), minimum and maximum of a stream."""
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    minimum: float = np.inf
+    maximum: float = -np.inf
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def merge(self, other: RunningMoments) -> None:
+        """Combine with the moments of another stream (Chan et al.)."""
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def variance(self) -> float:
+        """Sample variance, NaN below two values."""
+        return self.m2 / (self.count - 1) if self.count > 1 else float("nan")
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.variance))
+
+    def to_array(self) -> np.ndarray:
+        return np.array([self.count, self.mean, self.m2, self.minimum, self.maximum])
+
+    @classmethod
+    def from_array(cls, values: np.ndarray) -> RunningMoments:
+        count, mean, m2, minimum, maximum = values
+        return cls(int(count), float(mean), float(m2), float(minimum), float(maximum))
+
+
+class AngleHistogram:
+    """
+    Counts of angles in bins of width "resolution" over [-180, 180] degrees.
+
+    Percentiles interpolate linearly within a bin; the cumulative counts
+    are computed once after changes, so lookups take constant time.
+    """
+
+    def __init__(self, resolution: float = 0.05, counts: Optional[np.ndarray] = None) -> None:
+        self.resolution = resolution
+        bins = int(round(2 * LIMIT / resolution))
+        self.counts = np.zeros(bins, dtype=np.int64) if counts is None else counts
+        self._cumulative: Optional[np.ndarray] = None
+
+    def _bin(self, angle: float) -> int:
+        return min(max(int((angle + LIMIT) // self.resolution), 0), len(self.counts) - 1)
+
+    def add(self, angle: float) -> None:
+        self.counts[self._bin(angle)] += 1
+        self._cumulative = None
+
+    def merge(self, other: AngleHistogram) -> None:
+        if other.resolution != self.resolution:
+            raise ValueError(f"cannot merge histograms of resolution {self.resolution} and {other.resolution}")
+        self.counts += other.counts
+        self._cumulative = None
+
+    @property
+    def cumulative(self) -> np.ndarray:
+        """Number of angles below each bin edge, len(counts) + 1 values."""
+        if self._cumulative is None:
+            self._cumulative = np.concatenate([[0], np.cumsum(self.counts)])
+        return self._cumulative
+
+    def percentile(self, angle: float) -> float:
+        """Percentage of counted angles below "angle"."""
+        total = self.cumulative[-1]
+        if total == 0:
+            return float("nan")
+        if angle <= -LIMIT:
+            return 0.0
+        if angle >= LIMIT:
+            return 100.0
+        index = self._bin(angle)
+        fraction = (angle + LIMIT) / self.resolution - index
+        below = self.cumulative[index] + fraction * self.counts[index]
+        return float(100.0 * below / total)
+
+    def quantile(self, q: float) -> float:
+        """Angle below which the fraction "q" of the counted angles lies."""
+        total = self.cumulative[-1]
+        if total == 0:
+            return float("nan")
+        target = q * total
+        index = min(int(np.searchsorted(self.cumulative, target, side="left")), len(self.counts)) - 1
+        index = max(index, 0)
+        fraction = (target - self.cumulative[index]) / self.counts[index] if self.counts[index] else 0.0
+        return float(-LIMIT + (index + fraction) * self.resolution)
+
+
+class CohortStatistics:
+    """
+    Moments and histogram of the angles per segment pair of a cohort.
+
+    Keyword Arguments:
+    parameters - canonical text of the analysis parameters, see batch_journal.parameters_key
+    resolution - histogram bin width in degrees
+    """
+
+    def __init__(self, parameters: str = "", resolution: float = 0.05) -> None:
+        self.parameters = parameters
+        self.resolution = resolution
+        self.moments: Dict[str, RunningMoments] = {}
+        self.histograms: Dict[str, AngleHistogram] = {}
+        self.spine_ids: Set[str] = set()
+
+    @property
+    def pairs(self) -> List[str]:
+        return list(self.moments)
+
+    def add(self, spine_id: str, pairs: Sequence[str], angles: Sequence[float]) -> bool:
+        """Count the angles of a spine, unless it was counted before. Return whether it was added."""
+        if spine_id in self.spine_ids:
+            return False
+        self.spine_ids.add(spine_id)
+        for pair, angle in zip(pairs, angles):
+            if pair not in self.moments:
+                self.moments[pair] = RunningMoments()
+                self.histograms[pair] = AngleHistogram(self.resolution)
+            self.moments[pair].add(float(angle))
+            self.histograms[pair].add(float(angle))
+        return True
+
+    def add_result(self, spine_id: str, result, angles: Sequence[float]) -> bool:
+        """Count a spine given its SpineResult, as for ResultsStore.add."""
+        # deferred, results_store imports vtk through morphology
+        from results_store import segment_pairs  # pylint: disable=import-outside-toplevel
+
+        return self.add(spine_id, segment_pairs([str(level) for level in result.levels]), angles)
+
+    def merge(self, other: CohortStatistics) -> None:
+        """Add the statistics of disjoint spines, e.g. of another worker."""
+        if other.parameters != self.parameters:
+            raise ValueError("cannot merge statistics of different analysis parameters")
+        if other.resolution != self.resolution:
+            raise ValueError(f"cannot merge statistics of resolution {self.resolution} and {other.resolution}")
+        overlap = self.spine_ids & other.spine_ids
+        if overlap:
+            raise ValueError(f"spines counted twice: {', '.join(sorted(overlap)[:5])}")
+        for pair, moments in other.moments.items():
+            if pair not in self.moments:
+                self.moments[pair] = RunningMoments()
+                self.histograms[pair] = AngleHistogram(self.resolution)
+            self.moments[pair].merge(moments)
+            self.histograms[pair].merge(other.histograms[pair])
+        self.spine_ids |= other.spine_ids
+
+    def percentile(self, pair: str, angle: float) -> float:
+        """Percentage of the cohort's angles of "pair" below "angle"."""
+        if pair not in self.histograms:
+            raise KeyError(f"no angles of {pair} counted")
+        return self.histograms[pair].percentile(angle)
+
+    def quantile(self, pair: str, q: float) -> float:
+        """
+        Angle of "pair" below which the fraction "q" of the cohort lies,
+        clamped to the smallest and largest angle counted.
+        """
+        if pair not in self.histograms:
+            raise KeyError(f"no angles of {pair} counted")
+        moments = self.moments[pair]
+        return float(np.clip(self.histograms[pair].quantile(q), moments.minimum, moments.maximum))
+
+    def z_score(self, pair: str, angle: float) -> float:
+        """Standard deviations of "angle" from the cohort's mean, NaN without spread."""
+        moments = self.moments[pair]
+        if not moments.std > 0:
+            return float("nan")
+        return (angle - moments.mean) / moments.std
+
+    def save(self, filename: str) -> None:
+        """Save as compressed .npz, through a temporary file renamed into place."""
+        pairs = self.pairs
+        temporary = f"{filename}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            temporary,
+            header=np.array(json.dumps({"parameters": self.parameters, "resolution": self.resolution})),
+            pairs=np.array(pairs, dtype=str),
+            moments=np.array([self.moments[p].to_array() for p in pairs]).reshape(len(pairs), 5),
+            counts=np.array([self.histograms[p].counts for p in pairs], dtype=np.int64).reshape(len(pairs), -1),
+            spine_ids=np.array(sorted(self.spine_ids), dtype=str),
+        )
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> CohortStatistics:
+        with np.load(filename) as data:
+            header = json.loads(str(data["header"]))
+            stats = cls(header["parameters"], header["resolution"])
+            for pair, moments, counts in zip(data["pairs"], data["moments"], data["counts"]):
+                stats.moments[str(pair)] = RunningMoments.from_array(moments)
+                stats.histograms[str(pair)] = AngleHistogram(stats.resolution, counts.copy())
+            stats.spine_ids = {str(s) for s in data["spine_ids"]}
+        return stats
+
+    @classmethod
+    def open(cls, filename: str, parameters: str = "", resolution: float = 0.05) -> CohortStatistics:
+        """Load "filename" if it exists, else start empty statistics."""
+        if not os.path.exists(filename):
+            return cls(parameters, resolution)
+        stats = cls.load(filename)
+        if stats.parameters != parameters:
+            raise ValueError(f"{filename} holds statistics of different analysis parameters")
+        return stats
+
+    def add_csv(self, filename: str) -> bool:
+        """Count a CSV file written by Spine.write, the spine id being its file name."""
+        header, angles = read_angles(filename)
+        return self.add(os.path.splitext(os.path.basename(filename))[0], header, angles)
+
+    def summary(self, quantiles: Iterable[float] = (0.05, 0.5, 0.95)) -> List[dict]:
+        quantiles = list(quantiles)
+        return [
+            {
+                "pair": pair,
+                "count": moments.count,
+                "mean": moments.mean,
+                "std": moments.std,
+                **{f"q{round(q * 100):02d}": self.quantile(pair, q) for q in quantiles},
+            }
+            for pair, moments in self.moments.items()
+        ]
+
+
+def read_angles(filename: str) -> tuple:
+    """Segment pairs and angles of a CSV file written by Spine.write."""
+    with open(filename, newline="") as file:
+        rows = list(csv.reader(file))
+    return rows[0], [float(a) for a in rows[1]]
+
+
+if __name__ == '__main__':
+    from batch_journal import parameters_key
+    from slopes_batch import Parameters
+
+    Parser = ArgumentParser(
+        prog='Slopes cohort statistics',
+        description='Build, merge and query streaming statistics of the angles of a cohort.',
+    )
+    Commands = Parser.add_subparsers(dest='command', required=True)
+
+    Build = Commands.add_parser('build', help='Count existing CSV files, e.g. of earlier batch runs.')
+    Build.add_argument('filenames', metavar='CSV', type=str, nargs='+', help='CSV files written by slopes_batch.py.')
+    Build.add_argument('-o', '--output', metavar='FILE', type=str, required=True, help='Statistics file, extended if it exists.')
+    Build.add_argument('-r', '--right', metavar='FLOAT', type=float, nargs=3, default=[1.0, 0.0, 0.0], help='(default: 1 0 0)')
+    Build.add_argument('--thickness', metavar='THICK', type=float, default=0.25, help='(default: 0.25)')
+    Build.add_argument('--max-angle', metavar='ANGLE', type=float, default=45.0, help='(default: 45)')
+    Build.add_argument(
+        '--resolution',
+        metavar='DEGREES',
+        type=float,
+        default=0.05,
+        help='Histogram bin width of new statistics. (default: 0.05)',
+    )
+
+    Merge = Commands.add_parser('merge', help='Merge statistics of disjoint spines, e.g. one file per worker.')
+    Merge.add_argument('filenames', metavar='FILES', type=str, nargs='+', help='Statistics files.')
+    Merge.add_argument('-o', '--output', metavar='FILE', type=str, required=True, help='Merged statistics file.')
+
+    Show = Commands.add_parser('show', help='Print count, mean, standard deviation and quantiles per segment pair.')
+    Show.add_argument('stats', metavar='FILE', type=str, help='Statistics file.')
+
+    Lookup = Commands.add_parser('lookup', help='Print the percentile of each angle of a spine within the cohort.')
+    Lookup.add_argument('stats', metavar='FILE', type=str, help='Statistics file.')
+    Lookup.add_argument('spine', metavar='CSV', type=str, help='CSV file of one spine.')
+
+    Arguments = Parser.parse_args()
+    if Arguments.command == 'build':
+        Stats = CohortStatistics.open(
+            Arguments.output,
+            parameters_key(Parameters(tuple(Arguments.right), Arguments.thickness, Arguments.max_angle)),
+            Arguments.resolution,
+        )
+        Added = sum(Stats.add_csv(f) for f in Arguments.filenames)
+        Stats.save(Arguments.output)
+        print(f"added {Added} spines, {len(Stats.spine_ids)} in total", file=sys.stderr)
+    elif Arguments.command == 'merge':
+        Stats = CohortStatistics.load(Arguments.filenames[0])
+        for Filename in Arguments.filenames[1:]:
+            Stats.merge(CohortStatistics.load(Filename))
+        Stats.save(Arguments.output)
+        print(f"merged {len(Stats.spine_ids)} spines", file=sys.stderr)
+    elif Arguments.command == 'show':
+        Rows = CohortStatistics.load(Arguments.stats).summary()
+        print(f"{'pair':<10} {'count':>7} {'mean':>8} {'std':>8} {'5%':>8} {'50%':>8} {'95%':>8}")
+        for Row in Rows:
+            print(
+                f"{Row['pair']:<10} {Row['count']:>7} {Row['mean']:>8.2f} {Row['std']:>8.2f} "
+                f"{Row['q05']:>8.2f} {Row['q50']:>8.2f} {Row['q95']:>8.2f}"
+            )
+    else:
+        Stats = CohortStatistics.load(Arguments.stats)
+        print(f"{'pair':<10} {'angle':>8} {'percentile':>11} {'z':>7}")
+        for Pair, Angle in zip(*read_angles(Arguments.spine)):
+            if Pair not in Stats.moments:
+                print(f"{Pair:<10} {Angle:>8.2f} {'-':>11} {'-':>7}")
+                continue
+            print(f"{Pair:<10} {Angle:>8.2f} {Stats.percentile(Pair, Angle):>11.1f} {Stats.z_score(Pair, Angle):>7.2f}")
@@ -0,0 +1,228 @@
+"""
+Columnar binary export of analysed spines.
+
+The numeric results of a cohort are laid out as one flat array per
+column, instead of text per spine. Ragged data, the endplate curves and
+the angles between adjacent vertebrae, is concatenated and indexed by
+offsets, as in Arrow:
+
+    spine_ids (S,)               vertebra_offsets (S + 1,)
+    levels, widths, heights (N,) frames (N, 3, 3)  centers (N, 3)
+    regressions (N, 2, 3)        spine_index (N,)
+    angles (N - S,)              angle_offsets (S + 1,)
+    curve_points (M, 3)          curve_offsets (2 N + 1,)
+
+The vertebrae of spine s are vertebra_offsets[s]:vertebra_offsets[s + 1],
+its angles angle_offsets[s]:angle_offsets[s + 1], and the points of
+endplate e of vertebra i, sorted along its regression, are
+curve_points[curve_offsets[2 i + e]:curve_offsets[2 i + e + 1]].
+
+A directory of .npy files, one per column, is memory-mapped by
+load_columns, so a whole cohort is opened without reading it. A .npz
+file is a single-file alternative, and with pyarrow installed a .parquet
+file holds one row per vertebra.
+
+A batch run with a journal skips the spines of earlier runs, and may be
+killed before it writes the export. CohortColumns given a "parts"
+directory therefore saves every spine there as it is added, and joins
+all spines saved there, by this run or earlier ones.
+
+Usage:
+    columns = CohortColumns()
+    columns.add_spine("patient_042", spine)
+    write_columns(columns.columns(), "cohort.columns")
+
+    cohort = load_columns("cohort.columns")
+    cohort["frames"][cohort["vertebra_offsets"][3]]
+"""
+from __future__ import annotations
+
+import os
+import socket
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from morphology import Endplate, Spine
+from spine_result import SpineResult
+
+Columns = Dict[str, np.ndarray]
+
+
+def spine_curves(spine: Spine) -> List[np.ndarray]:
+    """Sorted points of both endplate curves of every vertebra, two arrays per vertebra."""
+    return [
+        vertebra.body.curve_records[endplate].sorted_points.reshape(-1, 3)
+        for vertebra in spine
+        for endplate in Endplate.options()
+    ]
+
+
+def offsets(lengths: Sequence[int]) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+
+
+class CohortColumns:
+    """
+    Collects spines one by one and joins them into columns once.
+
+    Keyword Arguments:
+    parts - directory to save every spine added to, replacing an earlier
+    part of the same spine id; columns then joins all parts in it, ordered
+    by spine id, instead of the spines added in memory
+    """
+
+    def __init__(self, parts: Optional[str] = None) -> None:
+        self.parts = parts
+        self.results: List[SpineResult] = []
+        self.angles: List[np.ndarray] = []
+        self.curves: List[np.ndarray] = []
+        if parts is not None:
+            os.makedirs(parts, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._part_names()) if self.parts is not None else len(self.results)
+
+    def add(self, result: SpineResult, angles: Sequence[float], curves: Sequence[np.ndarray]) -> None:
+        """
+        Keyword Arguments:
+        result - SpineResult of one spine
+        angles - angles between its adjacent vertebrae
+        curves - two curve point arrays per vertebra, see spine_curves
+        """
+        if len(curves) != 2 * len(result):
+            raise ValueError(f"expected {2 * len(result)} curves, got {len(curves)}")
+        angles = np.asarray(angles, dtype=float)
+        curves = [np.asarray(c, dtype=float).reshape(-1, 3) for c in curves]
+        if self.parts is not None:
+            self._save_part(result, angles, curves)
+            return
+        self.results.append(result)
+        self.angles.append(angles)
+        self.curves.extend(curves)
+
+    def add_spine(self, spine_id: str, spine: Spine) -> None:
+        self.add(SpineResult.from_spine(spine, spine_id=spine_id), spine.angles, spine_curves(spine))
+
+    def columns(self) -> Columns:
+        results, angles, curves = self._load_parts() if self.parts is not None else (self.results, self.angles, self.curves)
+        cohort = SpineResult.concatenate(results)
+        return {
+            **cohort.__getstate__(),
+            "vertebra_offsets": offsets([len(r) for r in results]),
+            "angles": np.concatenate(angles) if angles else np.zeros(0),
+            "angle_offsets": offsets([len(a) for a in angles]),
+            "curve_points": np.concatenate(curves) if curves else np.zeros((0, 3)),
+            "curve_offsets": offsets([len(c) for c in curves]),
+        }
+
+    def _part_names(self) -> List[str]:
+        return sorted(n for n in os.listdir(self.parts) if n.endswith(".npz") and not n.endswith(".tmp.npz"))
+
+    def _save_part(self, result: SpineResult, angles: np.ndarray, curves: List[np.ndarray]) -> None:
+        """Save one spine as "<spine id>.npz", through a temporary file renamed into place."""
+        filename = os.path.join(self.parts, f"{result.spine_ids[0]}.npz")
+        temporary = f"{filename}.{socket.gethostname()}-{os.getpid()}.tmp.npz"
+        np.savez(
+            temporary,
+            **result.__getstate__(),
+            angles=angles,
+            curve_points=np.concatenate(curves) if curves else np.zeros((0, 3)),
+            curve_lengths=np.array([len(c) for c in curves], dtype=np.int64),
+        )
+        os.replace(temporary, filename)
+
+    def _load_parts(self) -> Tuple[List[SpineResult], List[np.ndarray], List[np.ndarray]]:
+        results, angles, curves = [], [], []
+        for name in self._part_names():
+            with np.load(os.path.join(self.parts, name)) as part:
+                results.append(SpineResult(**{key: part[key] for key in SpineResult.__slots__}))
+                angles.append(part["angles"])
+                curves.extend(np.split(part["curve_points"], np.cumsum(part["curve_lengths"])[:-1]))
+        return results, angles, curves
+
+
+def write_columns(columns: Columns, path: str) -> None:
+    """
+    Write "columns" by the suffix of "path": ".npz" into one file,
+    ".parquet" as one row per vertebra (requires pyarrow), anything else
+    as a directory of one .npy file per column.
+    """
+    if path.endswith(".npz"):
+        np.savez(path, **columns)
+    elif path.endswith(".parquet"):
+        write_parquet(columns, path)
+    else:
+        os.makedirs(path, exist_ok=True)
+        for name, column in columns.items():
+            np.save(os.path.join(path, f"{name}.npy"), column)
+
+
+def load_columns(path: str, mmap: bool = True) -> Columns:
+    """Read columns written by write_columns as .npz or .npy directory, the latter memory-mapped."""
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return dict(data)
+    return {
+        name[: -len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r" if mmap else None)
+        for name in sorted(os.listdir(path))
+        if name.endswith(".npy")
+    }
+
+
+def vertebra_table(columns: Columns) -> Dict[str, object]:
+    """
+    One entry per vertebra: flat numeric columns, the angle to the next
+    vertebra (NaN for the last of a spine) and both curves as lists of points.
+    """
+    count = len(columns["levels"])
+    frames = columns["frames"].reshape(count, 9)
+    angle_to_next = np.full(count, np.nan)
+    for spine, (first, last) in enumerate(zip(columns["vertebra_offsets"], columns["vertebra_offsets"][1:])):
+        start = columns["angle_offsets"][spine]
+        angle_to_next[first : last - 1] = columns["angles"][start : start + last - first - 1]
+
+    table = {
+        "spine_id": columns["spine_ids"][columns["spine_index"]],
+        "level": columns["levels"],
+        "width": columns["widths"],
+        "height": columns["heights"],
+        "angle_to_next": angle_to_next,
+    }
+    for axis, name in enumerate("xyz"):
+        table[f"center_{name}"] = columns["centers"][:, axis]
+    for row, direction in enumerate(("right", "front", "up")):
+        for axis, name in enumerate("xyz"):
+            table[f"{direction}_{name}"] = frames[:, 3 * row + axis]
+    for endplate in Endplate.options():
+        for axis, name in enumerate("xyz"):
+            table[f"{endplate.name.lower()}_regression_{name}"] = columns["regressions"][:, endplate, axis]
+        bounds = columns["curve_offsets"]
+        table[f"{endplate.name.lower()}_curve"] = [
+            columns["curve_points"][bounds[2 * i + endplate] : bounds[2 * i + endplate + 1]].tolist()
+            for i in range(count)
+        ]
+    return table
+
+
+def check_format(path: str) -> None:
+    """Raise ImportError before any analysis if writing "path" requires a missing library."""
+    if path.endswith(".parquet"):
+        _pyarrow()
+
+
+def _pyarrow():
+    try:
+        import pyarrow  # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet  # pylint: disable=import-outside-toplevel,unused-import
+    except ImportError as error:
+        raise ImportError("writing Parquet files requires pyarrow, use .npz or a .npy directory instead") from error
+    return pyarrow
+
+
+def write_parquet(columns: Columns, filename: str) -> None:
+    """Write the vertebra_table of "columns" as Parquet file. Requires pyarrow."""
+    pyarrow = _pyarrow()
+    table = pyarrow.table({name: pyarrow.array(column) for name, column in vertebra_table(columns).items()})
+    pyarrow.parquet.write_table(table, filename)
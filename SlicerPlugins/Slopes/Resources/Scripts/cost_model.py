@@ -0,0 +1,192 @@
+"""
+Cost model and size-aware scheduling of batch runs.
+
+The time to load and analyse a spine grows with its number of levels and
+triangles. A CostModel predicts it linearly from both, read from the STL
+headers without loading the meshes, or estimated from the headers of
+labelled surfaces and the labels of label maps. Its coefficients are calibrated by
+"benchmark.py calibrate" on representative spines.
+
+plan_tasks orders the work largest first, so the long spines do not start
+last and leave cores idle at the end of a batch. A spine predicted to take
+longer than an even share of the whole batch per worker is split into one
+task per vertebra.
+
+Usage:
+    model = CostModel.load("cost_model.json")
+    plan = Plan(plan_tasks(jobs, model, workers=8), workers=8)
+    plan.predicted_makespan
+"""
+from __future__ import annotations
+
+import heapq
+import json
+import os
+import struct
+
+from collections import Counter
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from label_volume import is_volume_member, volume_member_triangles
+from labelled_surface import SEPARATOR, is_surface_member, surface_triangles
+from mesh_archive import is_member, member_triangles
+from mesh_pack import is_pack_member, pack_member_triangles
+
+BINARY_STL_HEADER = 84
+BINARY_STL_FACET = 50
+# typical size of one "facet normal ... endfacet" block of an ASCII STL
+ASCII_STL_FACET = 250
+
+
+def stl_triangles(filename: str) -> int:
+    """
+    Number of triangles of an STL file, read from the header of binary
+    files and estimated from the size of ASCII ones, or of a mesh in a
+    mesh archive or pack, read from its index, or of a level of a label
+    map, estimated from its labels. For a level of a labelled surface, it
+    is the number of the whole surface, see spine_triangles.
+    """
+    if is_member(filename):
+        return member_triangles(filename)
+    if is_pack_member(filename):
+        return pack_member_triangles(filename)
+    if is_volume_member(filename):
+        return volume_member_triangles(filename)
+    if is_surface_member(filename):
+        surface = filename.rpartition(SEPARATOR)[0]
+        count = surface_triangles(surface)
+        return count if count is not None else os.path.getsize(surface) // ASCII_STL_FACET
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as file:
+        header = file.read(BINARY_STL_HEADER)
+    if len(header) == BINARY_STL_HEADER:
+        (count,) = struct.unpack("<I", header[80:])
+        if BINARY_STL_HEADER + count * BINARY_STL_FACET == size:
+            return count
+    return size // ASCII_STL_FACET
+
+
+def spine_triangles(filenames: Sequence[str]) -> List[int]:
+    """
+    Number of triangles of every vertebra of a spine, see stl_triangles;
+    the levels of a labelled surface share its triangles evenly.
+    """
+    levels = Counter(f.rpartition(SEPARATOR)[0] for f in filenames if is_surface_member(f))
+    return [
+        stl_triangles(f) // levels[f.rpartition(SEPARATOR)[0]] if is_surface_member(f) else stl_triangles(f)
+        for f in filenames
+    ]
+
+
+@dataclass(frozen=True)
+class CostModel:
+    """
+    Predicted seconds of a spine:
+        per_spine + sum over its vertebrae of (per_vertebra + per_triangle * triangles)
+
+    The defaults were calibrated on a single core with meshes of about
+    4k triangles per vertebra; calibrate on the target machine for
+    meaningful makespans. Only the ratios matter for ordering.
+    """
+    per_spine: float = 0.0005
+    per_vertebra: float = 0.001
+    per_triangle: float = 2e-6
+
+    def predict_vertebra(self, triangles: int) -> float:
+        return self.per_vertebra + self.per_triangle * triangles
+
+    def predict(self, triangles: Sequence[int]) -> float:
+        return self.per_spine + sum(self.predict_vertebra(t) for t in triangles)
+
+    @classmethod
+    def fit(
+        cls, vertebra_triangles: Sequence[int], vertebra_seconds: Sequence[float], spine_overheads: Sequence[float]
+    ) -> CostModel:
+        """
+        Least squares fit of per_vertebra and per_triangle to timings of
+        single vertebrae; per_spine is the median of the remaining time per
+        spine (e.g. the up approximation). Coefficients are kept non-negative.
+        """
+        design = np.column_stack([np.ones(len(vertebra_triangles)), vertebra_triangles])
+        (per_vertebra, per_triangle), *_ = np.linalg.lstsq(design, np.asarray(vertebra_seconds), rcond=None)
+        return cls(
+            per_spine=max(float(np.median(spine_overheads)), 0.0) if len(spine_overheads) else 0.0,
+            per_vertebra=max(float(per_vertebra), 0.0),
+            per_triangle=max(float(per_triangle), 0.0),
+        )
+
+    def save(self, filename: str) -> None:
+        with open(filename, "w") as file:
+            json.dump(asdict(self), file, indent=2)
+
+    @classmethod
+    def load(cls, filename: str) -> CostModel:
+        with open(filename) as file:
+            return cls(**json.load(file))
+
+
+@dataclass(frozen=True)
+class Task:
+    """A whole spine, or the single vertebra "vertebra" of a split spine."""
+    job: object
+    cost: float
+    vertebra: Optional[int] = None
+
+    @property
+    def task_id(self) -> str:
+        if self.vertebra is None:
+            return self.job.spine_id
+        return f"{self.job.spine_id}[{self.vertebra}]"
+
+
+def plan_tasks(jobs: Sequence, model: CostModel, workers: int, split: bool = True) -> List[Task]:
+    """
+    Return the tasks of all jobs (objects with "filenames"), largest first.
+    With "split", a spine predicted to take longer than the total predicted
+    time per worker becomes one task per vertebra.
+    """
+    triangles = [spine_triangles(job.filenames) for job in jobs]
+    costs = [model.predict(t) for t in triangles]
+    share = sum(costs) / max(workers, 1)
+
+    tasks = []
+    for job, counts, cost in zip(jobs, triangles, costs):
+        if split and workers > 1 and cost > share and len(counts) > 1:
+            tasks.extend(Task(job, model.predict_vertebra(t), vertebra=i) for i, t in enumerate(counts))
+        else:
+            tasks.append(Task(job, cost))
+    return sorted(tasks, key=lambda task: -task.cost)
+
+
+def lpt_makespan(costs: Sequence[float], workers: int) -> float:
+    """Makespan of handing out "costs" in the given order to the earliest free of "workers"."""
+    finish_times = [0.0] * max(workers, 1)
+    for cost in costs:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + cost)
+    return max(finish_times)
+
+
+@dataclass(frozen=True)
+class Plan:
+    """Predicted schedule of a batch, to compare with the actual run."""
+    tasks: List[Task]
+    workers: int
+
+    @property
+    def predicted_busy(self) -> float:
+        return sum(task.cost for task in self.tasks)
+
+    @property
+    def predicted_makespan(self) -> float:
+        return lpt_makespan([task.cost for task in self.tasks], self.workers)
+
+    def report(self, makespan: float, busy: float) -> str:
+        split = len({t.job.spine_id for t in self.tasks if t.vertebra is not None})
+        return "\n".join([
+            f"plan: {len(self.tasks)} tasks, {split} spines split per vertebra",
+            f"makespan: predicted {self.predicted_makespan:.2f} s, actual {makespan:.2f} s including worker start-up",
+            f"busy: predicted {self.predicted_busy:.2f} s, actual {busy:.2f} s",
+        ])
@@ -0,0 +1,332 @@
+"""
+Compact archive of the vertebra meshes of one spine.
+
+STL files store every triangle with its own three float32 corners. An
+archive stores each vertebra once as welded mesh instead:
+
+    - identical corners are merged into shared vertices
+    - vertex coordinates are quantised to "bits" (16 or 32) per axis
+      within the vertebra's bounding box; no coordinate moves by more
+      than half a quantisation step, the "error_bound" given per member
+    - vertices are renumbered in order of first use, and both vertex
+      coordinates and triangle corners are stored as differences to
+      their predecessor, which compresses well
+    - every vertebra is compressed on its own, with zlib or lzma
+
+A JSON index at the end of the file lists the members by name, e.g. the
+level "L1", with their offset and size, so a single vertebra is decoded
+without reading the others:
+
+    <member> ... <member> <index JSON> <index offset: uint64> "SPZ1"
+
+load_stl reads members given as "<archive>#<name>", e.g.
+load_stl("patient_042.spz#L1"), and slopes_batch.py takes archives in
+place of spine directories.
+
+Usage:
+    python mesh_archive.py pack cohort/patient_042 -o patient_042.spz
+    python mesh_archive.py list patient_042.spz
+    python mesh_archive.py unpack patient_042.spz -o patient_042
+"""
+from __future__ import annotations
+
+import json
+import lzma
+import os
+import struct
+import zlib
+
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+SUFFIX = ".spz"
+SEPARATOR = "#"
+MAGIC = b"SPZ1"
+FOOTER = struct.Struct("<Q4s")
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+COORDINATE_TYPES = {16: np.uint16, 32: np.uint32}
+
+
+@dataclass(frozen=True)
+class Member:
+    """Index entry of one mesh in an archive."""
+    name: str
+    offset: int
+    size: int
+    points: int
+    triangles: int
+    origin: Tuple[float, float, float]
+    scale: Tuple[float, float, float]
+    error_bound: float
+
+
+def is_member(filename: str) -> bool:
+    """Whether "filename" names a mesh inside an archive, "<archive>.spz#<name>"."""
+    archive, separator, _ = filename.rpartition(SEPARATOR)
+    return bool(separator) and archive.endswith(SUFFIX)
+
+
+def triangles_array(polydata: vtkPolyData) -> np.ndarray:
+    """Point ids of all triangles of a geometry with shape (t, 3)."""
+    arrays = conv.polydata_to_arrays(polydata, copy=False)
+    if "polys_offsets" not in arrays:
+        return np.zeros((0, 3), dtype=np.int64)
+    if np.any(np.diff(arrays["polys_offsets"]) != 3):
+        raise ValueError("only triangle meshes can be archived")
+    return arrays["polys_connectivity"].reshape(-1, 3).astype(np.int64)
+
+
+def encode_mesh(points: np.ndarray, triangles: np.ndarray, bits: int) -> Tuple[bytes, dict]:
+    """
+    Weld, quantise and delta encode a triangle mesh. Return the
+    uncompressed payload and the fields of its Member, except name,
+    offset and size.
+    """
+    dtype = COORDINATE_TYPES[bits]
+    points, inverse = np.unique(np.asarray(points, dtype=float), axis=0, return_inverse=True)
+    triangles = inverse.reshape(-1)[triangles]
+
+    origin = points.min(axis=0) if len(points) else np.zeros(3)
+    extent = points.max(axis=0) - origin if len(points) else np.zeros(3)
+    scale = np.where(extent > 0, extent / (2**bits - 1), 1.0)
+    quantised = np.rint((points - origin) / scale).astype(dtype)
+
+    # corners closer than a quantisation step fall onto the same vertex
+    quantised, inverse = np.unique(quantised, axis=0, return_inverse=True)
+    triangles = inverse.reshape(-1)[triangles]
+    triangles = triangles[
+        (triangles[:, 0] != triangles[:, 1])
+        & (triangles[:, 1] != triangles[:, 2])
+        & (triangles[:, 0] != triangles[:, 2])
+    ]
+
+    corners = triangles.reshape(-1)
+    used, first_use = np.unique(corners, return_index=True)
+    order = used[np.argsort(first_use)]
+    renumbered = np.empty(len(quantised), dtype=np.int64)
+    renumbered[order] = np.arange(len(order))
+    quantised = quantised[order]
+    corners = renumbered[corners]
+
+    # unsigned differences wrap around and are undone by a wrapping cumsum
+    vertex_deltas = np.diff(quantised, axis=0, prepend=np.zeros((1, 3), dtype=dtype)).astype(dtype)
+    corner_deltas = np.diff(corners, prepend=0).astype(np.int32)
+    payload = np.ascontiguousarray(vertex_deltas.T).tobytes() + corner_deltas.tobytes()
+
+    return payload, {
+        "points": len(quantised),
+        "triangles": len(triangles),
+        "origin": tuple(float(o) for o in origin),
+        "scale": tuple(float(s) for s in scale),
+        "error_bound": float(np.linalg.norm(scale) / 2),
+    }
+
+
+def decode_mesh(payload: bytes, member: Member, bits: int) -> Dict[str, np.ndarray]:
+    """Inverse of encode_mesh, as arrays for vtk_convenience.polydata_from_arrays."""
+    dtype = COORDINATE_TYPES[bits]
+    coordinates = member.points * 3 * np.dtype(dtype).itemsize
+    vertex_deltas = np.frombuffer(payload, dtype=dtype, count=member.points * 3).reshape(3, member.points)
+    corner_deltas = np.frombuffer(payload, dtype=np.int32, offset=coordinates)
+
+    quantised = np.cumsum(vertex_deltas, axis=1, dtype=dtype).T
+    points = (np.asarray(member.origin) + quantised * np.asarray(member.scale)).astype(np.float32)
+    return {
+        "points": points,
+        "polys_offsets": np.arange(0, 3 * member.triangles + 1, 3, dtype=conv.ID_TYPE),
+        "polys_connectivity": np.cumsum(corner_deltas, dtype=conv.ID_TYPE),
+    }
+
+
+def write_archive(
+    filename: str, meshes: Iterable[Tuple[str, vtkPolyData]], bits: int = 16, codec: str = "lzma"
+) -> List[Member]:
+    """
+    Write named triangle meshes into an archive, through a temporary file
+    renamed into place once complete. Return their index entries.
+    """
+    if bits not in COORDINATE_TYPES:
+        raise ValueError(f"bits must be one of {sorted(COORDINATE_TYPES)}")
+    compress, _ = CODECS[codec]
+    members = []
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as file:
+            for name, polydata in meshes:
+                if SEPARATOR in name:
+                    raise ValueError(f"member name {name!r} must not contain {SEPARATOR!r}")
+                payload, fields = encode_mesh(conv.points_array(polydata), triangles_array(polydata), bits)
+                compressed = compress(payload)
+                members.append(Member(name, file.tell(), len(compressed), **fields))
+                file.write(compressed)
+            index = json.dumps({
+                "version": 1,
+                "bits": bits,
+                "codec": codec,
+                "members": [asdict(m) for m in members],
+            }).encode()
+            index_offset = file.tell()
+            file.write(index)
+            file.write(FOOTER.pack(index_offset, MAGIC))
+        os.replace(temporary, filename)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return members
+
+
+class MeshArchive:
+    """
+    Random access to the meshes of an archive; only the index is read on opening.
+
+    Usage:
+        with MeshArchive("patient_042.spz") as archive:
+            l1 = archive.read("L1")
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            end = self._file.seek(-FOOTER.size, os.SEEK_END)
+            index_offset, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{filename} is not a mesh archive")
+            self._file.seek(index_offset)
+            index = json.loads(self._file.read(end - index_offset))
+        except BaseException:
+            self._file.close()
+            raise
+        self.bits = index["bits"]
+        self.codec = index["codec"]
+        self.members = {
+            m["name"]: Member(**dict(m, origin=tuple(m["origin"]), scale=tuple(m["scale"])))
+            for m in index["members"]
+        }
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.members)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.members
+
+    def read_arrays(self, name: str) -> Dict[str, np.ndarray]:
+        if name not in self.members:
+            raise KeyError(f"{self.filename} has no member {name!r}")
+        member = self.members[name]
+        self._file.seek(member.offset)
+        _, decompress = CODECS[self.codec]
+        return decode_mesh(decompress(self._file.read(member.size)), member, self.bits)
+
+    def read(self, name: str) -> vtkPolyData:
+        return conv.polydata_from_arrays(self.read_arrays(name))
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> MeshArchive:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def split_member(filename: str) -> Tuple[str, str]:
+    archive, _, name = filename.rpartition(SEPARATOR)
+    return archive, name
+
+
+def load_member(filename: str) -> vtkPolyData:
+    """Load "<archive>#<name>"."""
+    archive, name = split_member(filename)
+    with MeshArchive(archive) as opened:
+        return opened.read(name)
+
+
+def member_filenames(archive: str) -> List[str]:
+    """"<archive>#<name>" of every member, in the order they were written."""
+    with MeshArchive(archive) as opened:
+        return [f"{archive}{SEPARATOR}{name}" for name in opened.names]
+
+
+def member_triangles(filename: str) -> int:
+    archive, name = split_member(filename)
+    with MeshArchive(archive) as opened:
+        return opened.members[name].triangles
+
+
+if __name__ == '__main__':
+    import sys
+
+    from argparse import ArgumentParser
+    from glob import glob
+
+    from vtkmodules.vtkIOGeometry import vtkSTLWriter
+
+    Parser = ArgumentParser(
+        prog='Slopes mesh archive',
+        description='Pack the STL files of a spine into one compact archive, list or unpack it.',
+    )
+    Commands = Parser.add_subparsers(dest='command', required=True)
+
+    Pack = Commands.add_parser('pack', help='Pack all STL files of a spine directory.')
+    Pack.add_argument('directory', metavar='DIR', type=str, help='Directory of vertebra STL files; their names become the member names.')
+    Pack.add_argument('-o', '--output', metavar='FILE', type=str, required=True, help=f'Archive to write, ending in {SUFFIX}.')
+    Pack.add_argument(
+        '--bits',
+        metavar='N',
+        type=int,
+        default=16,
+        choices=sorted(COORDINATE_TYPES),
+        help='Bits per quantised coordinate. (default: 16)',
+    )
+    Pack.add_argument('--codec', metavar='NAME', type=str, default='lzma', choices=sorted(CODECS), help='(default: lzma)')
+
+    List_ = Commands.add_parser('list', help='Print the members of an archive.')
+    List_.add_argument('archive', metavar='FILE', type=str, help='Mesh archive.')
+
+    Unpack = Commands.add_parser('unpack', help='Write every member as STL file.')
+    Unpack.add_argument('archive', metavar='FILE', type=str, help='Mesh archive.')
+    Unpack.add_argument('-o', '--output', metavar='DIR', type=str, required=True, help='Directory for the STL files.')
+
+    Arguments = Parser.parse_args()
+    if Arguments.command == 'pack':
+        Filenames = sorted(glob(os.path.join(Arguments.directory, "*.stl")) + glob(os.path.join(Arguments.directory, "*.STL")))
+        Members = write_archive(
+            Arguments.output,
+            ((os.path.splitext(os.path.basename(f))[0], conv.load_stl(f)) for f in Filenames),
+            bits=Arguments.bits,
+            codec=Arguments.codec,
+        )
+        Before = sum(os.path.getsize(f) for f in Filenames)
+        After = os.path.getsize(Arguments.output)
+        print(
+            f"{len(Members)} meshes, {Before / 1024:.0f} KiB -> {After / 1024:.0f} KiB ({Before / max(After, 1):.1f}x), "
+            f"error bound {max((m.error_bound for m in Members), default=0.0):.2g}",
+            file=sys.stderr,
+        )
+    elif Arguments.command == 'list':
+        with MeshArchive(Arguments.archive) as Archive:
+            print(f"{'name':<8} {'points':>8} {'triangles':>10} {'bytes':>9} {'error bound':>12}")
+            for Entry in Archive.members.values():
+                print(f"{Entry.name:<8} {Entry.points:>8} {Entry.triangles:>10} {Entry.size:>9} {Entry.error_bound:>12.2g}")
+    else:
+        os.makedirs(Arguments.output, exist_ok=True)
+        with MeshArchive(Arguments.archive) as Archive:
+            for Name in Archive.names:
+                Writer = vtkSTLWriter()
+                Writer.SetFileName(os.path.join(Arguments.output, f"{Name}.stl"))
+                Writer.SetInputData(Archive.read(Name))
+                Writer.SetFileTypeToBinary()
+                Writer.Write()
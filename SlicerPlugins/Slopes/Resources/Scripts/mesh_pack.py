@@ -0,0 +1,324 @@
+"""
+Memory-mapped pack of the meshes of a whole cohort.
+
+Opening thousands of small STL files costs more than analysing them in
+repeated experiments. A mesh pack concatenates the loaded meshes of all
+spines into four flat files, plus an index of where each mesh lies:
+
+    <pack>.meshpack/points.bin        float32 (P, 3) vertex positions
+    <pack>.meshpack/normals.bin       float32 (P, 3) point normals
+    <pack>.meshpack/offsets.bin       vtkIdType, triangle offsets, per mesh from 0
+    <pack>.meshpack/connectivity.bin  vtkIdType, point ids, per mesh from 0
+    <pack>.meshpack/index.json        per spine and level: start and stop in each file
+
+Readers map the files read-only, so every process shares the page cache
+instead of holding its own copy, and MeshPack.read returns a vtkPolyData
+whose arrays reference the mapping without copying. Such geometries must
+not be modified. The point normals are precomputed for consumers such as
+rendering; the analysis computes its own.
+
+A pack is extended by building into it again; spines already in it are
+skipped. The index is committed after every spine, and opening a pack
+for writing cuts its files back to what the index covers, so a build
+that was killed keeps the spines it finished and leaves no partial rows.
+open_pack maps a pack again once its index has changed.
+
+load_stl reads "<pack>.meshpack#<spine>/<level>", and slopes_batch.py
+takes a pack in place of spine directories, analysing all of its spines.
+
+Usage:
+    python mesh_pack.py build cohort/* -o cohort.meshpack
+    python mesh_pack.py list cohort.meshpack
+
+    pack = open_pack("cohort.meshpack")
+    l1 = pack.read("patient_042", "L1")
+"""
+from __future__ import annotations
+
+import json
+import os
+
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+SUFFIX = ".meshpack"
+SEPARATOR = "#"
+FILES = {
+    "points": (np.float32, 3),
+    "normals": (np.float32, 3),
+    "offsets": (conv.ID_TYPE, 1),
+    "connectivity": (conv.ID_TYPE, 1),
+}
+
+
+@dataclass(frozen=True)
+class PackEntry:
+    """Index entry of one mesh: [start, stop) in rows of each file."""
+    spine_id: str
+    level: str
+    points: Tuple[int, int]
+    offsets: Tuple[int, int]
+    connectivity: Tuple[int, int]
+
+    @property
+    def name(self) -> str:
+        return f"{self.spine_id}/{self.level}"
+
+
+def is_pack_member(filename: str) -> bool:
+    """Whether "filename" names a mesh inside a pack, "<pack>.meshpack#<spine>/<level>"."""
+    pack, separator, _ = filename.rpartition(SEPARATOR)
+    return bool(separator) and os.path.normpath(pack).endswith(SUFFIX)
+
+
+def mesh_arrays(polydata: vtkPolyData) -> Dict[str, np.ndarray]:
+    """The arrays of a triangle mesh as stored in a pack, normals computed if missing."""
+    arrays = conv.polydata_to_arrays(polydata, copy=False)
+    if "polys_offsets" not in arrays:
+        arrays["polys_offsets"] = np.zeros(1, dtype=conv.ID_TYPE)
+        arrays["polys_connectivity"] = np.zeros(0, dtype=conv.ID_TYPE)
+    normals = arrays.get("normals")
+    if normals is None:
+        normals = (
+            conv.vtk_to_numpy(conv._calc_normals(polydata))  # pylint: disable=protected-access
+            if polydata.GetNumberOfPoints()
+            else np.zeros((0, 3))
+        )
+    return {
+        "points": arrays["points"],
+        "normals": normals,
+        "offsets": arrays["polys_offsets"],
+        "connectivity": arrays["polys_connectivity"],
+    }
+
+
+class PackWriter:
+    """
+    Appends meshes to the files of a pack; the index is written by commit
+    and on close. Rows beyond the committed index, left by a writer that
+    was killed, are cut off on opening.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.entries: List[PackEntry] = read_index(directory) if os.path.exists(self._path("index.json")) else []
+        self._names = {entry.name for entry in self.entries}
+        self._rows = {
+            "points": max((e.points[1] for e in self.entries), default=0),
+            "normals": max((e.points[1] for e in self.entries), default=0),
+            "offsets": max((e.offsets[1] for e in self.entries), default=0),
+            "connectivity": max((e.connectivity[1] for e in self.entries), default=0),
+        }
+        self._files = {}
+        for name, (dtype, width) in FILES.items():
+            self._files[name] = open(self._path(f"{name}.bin"), "ab")
+            self._files[name].truncate(self._rows[name] * np.dtype(dtype).itemsize * width)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def __contains__(self, spine_id: str) -> bool:
+        return any(entry.spine_id == spine_id for entry in self.entries)
+
+    def add(self, spine_id: str, level: str, polydata: vtkPolyData) -> PackEntry:
+        if f"{spine_id}/{level}" in self._names:
+            raise ValueError(f"{spine_id}/{level} is already in {self.directory}")
+        ranges = {}
+        for name, array in mesh_arrays(polydata).items():
+            dtype, _ = FILES[name]
+            array = np.ascontiguousarray(array, dtype=dtype)
+            self._files[name].write(array.tobytes())
+            ranges[name] = (self._rows[name], self._rows[name] + len(array))
+            self._rows[name] += len(array)
+        entry = PackEntry(spine_id, level, ranges["points"], ranges["offsets"], ranges["connectivity"])
+        self.entries.append(entry)
+        self._names.add(entry.name)
+        return entry
+
+    def commit(self) -> None:
+        """Make the meshes added so far durable and list them in the index."""
+        for file in self._files.values():
+            file.flush()
+            os.fsync(file.fileno())
+        temporary = self._path(f"index.json.{os.getpid()}.tmp")
+        with open(temporary, "w") as file:
+            json.dump([asdict(entry) for entry in self.entries], file)
+        os.replace(temporary, self._path("index.json"))
+
+    def close(self) -> None:
+        self.commit()
+        for file in self._files.values():
+            file.close()
+
+    def __enter__(self) -> PackWriter:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def read_index(directory: str) -> List[PackEntry]:
+    with open(os.path.join(directory, "index.json")) as file:
+        return [
+            PackEntry(e["spine_id"], e["level"], tuple(e["points"]), tuple(e["offsets"]), tuple(e["connectivity"]))
+            for e in json.load(file)
+        ]
+
+
+class MeshPack:
+    """Read-only, memory-mapped access to the meshes of a pack."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.entries = {entry.name: entry for entry in read_index(directory)}
+        self._levels: Dict[str, List[str]] = {}
+        for entry in self.entries.values():
+            self._levels.setdefault(entry.spine_id, []).append(entry.level)
+        self._arrays = {}
+        for name, (dtype, width) in FILES.items():
+            filename = os.path.join(directory, f"{name}.bin")
+            rows = os.path.getsize(filename) // (np.dtype(dtype).itemsize * width)
+            shape = (rows, width) if width > 1 else (rows,)
+            # an empty file cannot be mapped
+            self._arrays[name] = np.memmap(filename, dtype=dtype, mode="r", shape=shape) if rows else np.zeros(shape, dtype)
+
+    @property
+    def spine_ids(self) -> List[str]:
+        return list(self._levels)
+
+    def levels(self, spine_id: str) -> List[str]:
+        return self._levels.get(spine_id, [])
+
+    def read_arrays(self, spine_id: str, level: str) -> Dict[str, np.ndarray]:
+        """Views onto the mapped files, as for vtk_convenience.polydata_from_arrays."""
+        name = f"{spine_id}/{level}"
+        if name not in self.entries:
+            raise KeyError(f"{self.directory} has no mesh {name!r}")
+        entry = self.entries[name]
+        return {
+            "points": self._arrays["points"][slice(*entry.points)],
+            "normals": self._arrays["normals"][slice(*entry.points)],
+            "polys_offsets": self._arrays["offsets"][slice(*entry.offsets)],
+            "polys_connectivity": self._arrays["connectivity"][slice(*entry.connectivity)],
+        }
+
+    def read(self, spine_id: str, level: str, normals: bool = False) -> vtkPolyData:
+        """
+        A geometry referencing the mapped files without copying; it must
+        not be modified. The stored point normals are attached on request
+        only: clip and cut filters interpolate existing normals, which
+        changes the results of the analysis compared to loading the STL.
+        """
+        arrays = self.read_arrays(spine_id, level)
+        if not normals:
+            del arrays["normals"]
+        return conv.polydata_from_arrays(arrays, deep=False)
+
+
+def open_pack(directory: str) -> MeshPack:
+    """The MeshPack of "directory", mapped once per process and again after its index changed."""
+    index = os.stat(os.path.join(directory, "index.json"))
+    return _cached_pack(directory, index.st_mtime_ns, index.st_size)
+
+
+@lru_cache(maxsize=8)
+def _cached_pack(directory: str, modified: int, size: int) -> MeshPack:
+    return MeshPack(directory)
+
+
+def split_pack_member(filename: str) -> Tuple[str, str, str]:
+    """Pack, spine id and level of "<pack>#<spine>/<level>"."""
+    pack, _, name = filename.rpartition(SEPARATOR)
+    spine_id, _, level = name.rpartition("/")
+    return os.path.normpath(pack), spine_id, level
+
+
+def load_pack_member(filename: str) -> vtkPolyData:
+    pack, spine_id, level = split_pack_member(filename)
+    return open_pack(pack).read(spine_id, level)
+
+
+def pack_member_triangles(filename: str) -> int:
+    pack, spine_id, level = split_pack_member(filename)
+    entry = open_pack(pack).entries[f"{spine_id}/{level}"]
+    return entry.offsets[1] - entry.offsets[0] - 1
+
+
+def pack_member_filenames(directory: str) -> Dict[str, List[str]]:
+    """"<pack>#<spine>/<level>" of every mesh, per spine id."""
+    pack = open_pack(os.path.normpath(directory))
+    return {
+        spine_id: [f"{pack.directory}{SEPARATOR}{spine_id}/{level}" for level in pack.levels(spine_id)]
+        for spine_id in pack.spine_ids
+    }
+
+
+def build_pack(directory: str, spines: Iterable[Tuple[str, Sequence[Tuple[str, str]]]]) -> Tuple[int, int]:
+    """
+    Add spines, given as spine id and (level, filename) pairs, to the pack
+    in "directory". Spines already in the pack are skipped. Return the
+    number of spines added and skipped.
+    """
+    added = skipped = 0
+    with PackWriter(directory) as writer:
+        for spine_id, meshes in spines:
+            if spine_id in writer:
+                skipped += 1
+                continue
+            for level, filename in meshes:
+                writer.add(spine_id, level, conv.load_stl(filename))
+            writer.commit()
+            added += 1
+    return added, skipped
+
+
+if __name__ == '__main__':
+    import sys
+
+    from argparse import ArgumentParser
+
+    Parser = ArgumentParser(
+        prog='Slopes mesh pack',
+        description='Concatenate the meshes of a cohort into memory-mapped files for fast repeated loading.',
+    )
+    Commands = Parser.add_subparsers(dest='command', required=True)
+
+    Build = Commands.add_parser('build', help='Create a pack, or add spines to it.')
+    Build.add_argument(
+        'directories',
+        metavar='DIRS',
+        type=str,
+        nargs='+',
+        help='One directory of STL files, or mesh archive, per spine.',
+    )
+    Build.add_argument('-o', '--output', metavar='DIR', type=str, required=True, help=f'Pack directory, ending in {SUFFIX}.')
+
+    List_ = Commands.add_parser('list', help='Print the spines and levels of a pack.')
+    List_.add_argument('pack', metavar='DIR', type=str, help='Pack directory.')
+
+    Arguments = Parser.parse_args()
+    if Arguments.command == 'build':
+        from slopes_batch import SpineJob, vertebra_name
+
+        Jobs = (SpineJob.from_directory(d) for d in Arguments.directories)
+        Added, Skipped = build_pack(
+            Arguments.output,
+            ((j.spine_id, [(os.path.splitext(vertebra_name(f))[0], f) for f in j.filenames]) for j in Jobs),
+        )
+        print(f"added {Added} spines, skipped {Skipped} already packed", file=sys.stderr)
+    else:
+        Pack = MeshPack(Arguments.pack)
+        print(f"{'spine':<20} {'levels':>6} {'points':>9} {'triangles':>10}")
+        for SpineId in Pack.spine_ids:
+            Entries = [Pack.entries[f"{SpineId}/{Level}"] for Level in Pack.levels(SpineId)]
+            Points = sum(e.points[1] - e.points[0] for e in Entries)
+            Triangles = sum(e.offsets[1] - e.offsets[0] - 1 for e in Entries)
+            print(f"{SpineId:<20} {len(Entries):>6} {Points:>9} {Triangles:>10}")
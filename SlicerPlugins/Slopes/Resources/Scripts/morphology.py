@@ -2,24 +2,30 @@ from __future__ import annotations
 
 import math
 import numpy as np
+import os
 import re
+import site
 import sys
 import vtk_convenience as conv
 
 from csv import DictWriter
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import IntEnum, auto
 from functools import reduce
-from typing import Dict, Tuple
+from itertools import count, repeat
+from typing import Dict, List, Optional, Tuple
 
-from scipy.interpolate import PchipInterpolator
-from vtk import vtkPolyData
+from vtkmodules.vtkCommonDataModel import vtkPolyData
 
 
 class Endplate(IntEnum):
     LOWER = 0
     UPPER = 1
 
+    @classmethod
+    def options(cls):
+        return cls.LOWER, cls.UPPER
+
 
 class Spine:
     VERTEBRAE = (
@@ -48,6 +54,10 @@ class Spine:
         "L4",
         "L5",
     )
+    REGIONS = {
+        "kyphosis": ("T4", "T12"),
+        "lordosis": ("L1", "L5"),
+    }
 
     def __init__(
         self,
@@ -55,35 +65,152 @@ class Spine:
         lateral_axis: np.ndarray,
         slice_thickness: float,
         max_angle: float,
+        lean: bool = False,
+        memory_report: bool = False,
+        workers: int = 0,
+        max_triangles: int = 0,
+        max_error: float = 0.0,
+        proxy_triangles: int = 0,
     ) -> None:
-        local_up = UpApproximator(geomemtries)
-        self.vertebrae = [
-            Vertebra(
-                g,
-                lateral_axis=lateral_axis,
-                up_approximator=local_up,
-                slice_thickness=slice_thickness,
-                max_angle=max_angle,
-            )
-            for g in geomemtries
-        ]
+        """
+        Analyse all vertebra geometries of a spine.
+
+        With "workers" greater than one, the vertebrae are constructed in
+        that many processes. The result is identical to the serial one.
+        "max_triangles" and "max_error" decimate every vertebra first, and
+        "proxy_triangles" estimates orientations and the up direction on a
+        sample of each, and "memory_report" gives each vertebra a
+        MemoryReport, see Vertebra.
+        """
+        local_up = approximate_up(geomemtries, proxy_triangles)
+        parameters = dict(
+            lateral_axis=lateral_axis,
+            up_approximator=local_up,
+            slice_thickness=slice_thickness,
+            max_angle=max_angle,
+            lean=lean,
+            memory_report=memory_report,
+            max_triangles=max_triangles,
+            max_error=max_error,
+            proxy_triangles=proxy_triangles,
+        )
+        if workers > 1:
+            self.vertebrae = Spine._build_in_pool(geomemtries, workers, parameters)
+        else:
+            self.vertebrae = [Vertebra(g, **parameters) for g in geomemtries]
+        self._levels = {}
+        self._angle_matrices = {}
+
+    @staticmethod
+    def _build_in_pool(
+        geometries: List[vtkPolyData], workers: int, parameters: dict
+    ) -> List[Vertebra]:
+        """
+        Construct vertebrae in a process pool. Geometries are shared with the
+        workers through shared memory, results keep the input order and
+        reference the original input geometry.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        from shared_mesh import SharedMesh
+
+        meshes = [SharedMesh(g) for g in geometries]
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=site.addsitedir,
+                initargs=(os.path.dirname(os.path.abspath(__file__)),),
+            ) as pool:
+                vertebrae = list(pool.map(
+                    _build_vertebra, [m.descriptor for m in meshes], repeat(parameters)
+                ))
+        finally:
+            for mesh in meshes:
+                mesh.close()
+
+        if not parameters["lean"]:
+            for vertebra, geometry in zip(vertebrae, geometries):
+                if vertebra.geometry is None:
+                    vertebra.geometry = geometry
+        return vertebrae
+
+    @classmethod
+    def from_vertebrae(cls, vertebrae: List[Vertebra]) -> Spine:
+        """Assemble a spine from vertebrae that were analysed separately."""
+        spine = cls.__new__(cls)
+        spine.vertebrae = list(vertebrae)
+        spine._levels = {}
+        spine._angle_matrices = {}
+        return spine
 
     def name_vertebrae(self, offset_to_c1: int) -> None:
-        for name, data in zip(self.VERTEBRAE[offset_to_c1:], self.vertebrae):
+        for index, name, data in zip(count(), self.VERTEBRAE[offset_to_c1:], self.vertebrae):
             setattr(self, name, data)
+            self._levels[name] = index
+
+    def angle_matrix(
+        self, first: Endplate = Endplate.UPPER, second: Endplate = Endplate.UPPER
+    ) -> np.ndarray:
+        """
+        Return the signed angles (in degrees) between all pairs of vertebrae.
+        Element [i, j] is the angle between endplate "first" of vertebra i and
+        endplate "second" of vertebra j, as in Vertebra.angle. The matrix is
+        calculated once per endplate combination.
+        """
+        key = (first, second)
+        if key not in self._angle_matrices:
+            self._angle_matrices[key] = calc_angle_matrix(
+                np.array([v.body.regressions[first] for v in self.vertebrae]),
+                np.array([v.body.regressions[second] for v in self.vertebrae]),
+                rotation_axes=np.array([v.orientation.right for v in self.vertebrae]),
+            )
+        return self._angle_matrices[key]
 
     @property
     def angles(self) -> Tuple[float]:
-        return [v1.angle(v2) for v1, v2 in zip(self.vertebrae, self.vertebrae[1:])]
+        return np.diagonal(self.angle_matrix(), offset=1).tolist()
 
     @property
     def named_angles(self) -> Dict[str, float]:
+        matrix = self.angle_matrix()
         return {
-            f"{first}/{second}": getattr(self, first).angle(getattr(self, second))
+            f"{first}/{second}": float(matrix[self._levels[first], self._levels[second]])
             for first, second in zip(self.VERTEBRAE, self.VERTEBRAE[1:])
-            if hasattr(self, first) and hasattr(self, second)
+            if first in self._levels and second in self._levels
         }
 
+    def cobb_angle(self, cranial: str, caudal: str) -> float:
+        """
+        Return the Cobb angle between the upper endplate of vertebra "cranial"
+        and the lower endplate of vertebra "caudal", given by their names.
+        """
+        matrix = self.angle_matrix(Endplate.UPPER, Endplate.LOWER)
+        return float(matrix[self._levels[cranial], self._levels[caudal]])
+
+    @property
+    def regional_angles(self) -> Dict[str, float]:
+        """Return the Cobb angle of all REGIONS this spine fully covers."""
+        return {
+            region: self.cobb_angle(cranial, caudal)
+            for region, (cranial, caudal) in self.REGIONS.items()
+            if cranial in self._levels and caudal in self._levels
+        }
+
+    def max_cobb_angle(self) -> CobbAngle:
+        """
+        Return the largest Cobb angle (by magnitude) between the upper endplate
+        of one vertebra and the lower endplate of any vertebra below it.
+        """
+        matrix = self.angle_matrix(Endplate.UPPER, Endplate.LOWER)
+        spanning = np.abs(np.triu(matrix, k=1))
+        cranial, caudal = np.unravel_index(spanning.argmax(), spanning.shape)
+
+        names = {index: name for name, index in self._levels.items()}
+        return CobbAngle(
+            cranial=names.get(cranial, str(cranial)),
+            caudal=names.get(caudal, str(caudal)),
+            angle=float(matrix[cranial, caudal]),
+        )
+
     def __getitem__(self, index: int) -> Vertebra:
         return self.vertebrae[index]
 
@@ -119,6 +246,13 @@ class Spine:
         ]
 
 
+@dataclass
+class CobbAngle:
+    cranial: str
+    caudal: str
+    angle: float
+
+
 @dataclass
 class Orientation:
     up: np.ndarray
@@ -132,12 +266,117 @@ class Orientation:
     width: float
 
 
+@dataclass
+class CurveRecord:
+    """
+    Numpy representation of one endplate curve, ordered along its regression.
+    """
+    points: np.ndarray
+    segments: np.ndarray
+    projection: np.ndarray
+    order: np.ndarray
+    extrema: Tuple[np.ndarray, np.ndarray]
+
+    @classmethod
+    def from_polydata(cls, curve: vtkPolyData, regression: np.ndarray) -> CurveRecord:
+        points = conv.points_array(curve)
+        projection = points.dot(regression)
+        order = projection.argsort()
+        if len(order) == 0:
+            extrema = (np.full(3, np.nan), np.full(3, np.nan))
+        else:
+            extrema = (points[order[0]], points[order[-1]])
+
+        return cls(
+            points=points,
+            segments=conv.line_segments(curve),
+            projection=projection,
+            order=order,
+            extrema=extrema,
+        )
+
+    @property
+    def sorted_points(self) -> np.ndarray:
+        return self.points[self.order]
+
+
 @dataclass
 class Body:
     center_portion: vtkPolyData
     endplates: vtkPolyData
     curves: Tuple[vtkPolyData, vtkPolyData]
     regressions: Tuple[np.ndarray, np.ndarray]
+    # numpy records of "curves", taken on construction so they outlive release
+    curve_records: Tuple[CurveRecord, CurveRecord] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.curve_records = tuple(
+            CurveRecord.from_polydata(self.curves[e], self.regressions[e])
+            for e in Endplate.options()
+        )
+
+    def __getstate__(self) -> dict:
+        """Replace vtk geometries by numpy arrays, e.g. to send it to another process."""
+        state = dict(vars(self))
+        state["center_portion"] = pack_polydata(self.center_portion)
+        state["endplates"] = pack_polydata(self.endplates)
+        if self.curves is not None:
+            state["curves"] = tuple(pack_polydata(c) for c in self.curves)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        state["center_portion"] = unpack_polydata(state["center_portion"])
+        state["endplates"] = unpack_polydata(state["endplates"])
+        if state["curves"] is not None:
+            state["curves"] = tuple(unpack_polydata(c) for c in state["curves"])
+        vars(self).update(state)
+
+    def release(self) -> None:
+        """Drop all vtk geometries, keeping only the numpy curve records."""
+        self.center_portion = None
+        self.endplates = None
+        self.curves = None
+
+
+class MemoryReport:
+    """
+    Estimate of the bytes a vertebra holds at each stage of its analysis.
+    "peak" is the most memory held at once between two stages, "retained"
+    is what remains after the analysis is finished. Sizes are vtk's
+    estimates, rounded up to KiB, and arrays shared between geometries
+    count once per geometry. The input geometry counts as held throughout,
+    as the caller still references it, unless it was decimated.
+    """
+
+    def __init__(self) -> None:
+        self._held = {}
+        self.retained = 0
+        self.peak = 0
+
+    def hold(self, name: str, data: object) -> None:
+        """Account for "data" under "name", replacing a previous entry."""
+        self.retained -= self._held.get(name, 0)
+        self._held[name] = self.size_of(data)
+        self.retained += self._held[name]
+        self.peak = max(self.peak, self.retained)
+
+    def release(self, name: str) -> None:
+        self.retained -= self._held.pop(name, 0)
+
+    @classmethod
+    def size_of(cls, data: object) -> int:
+        """Return the approximate number of bytes of numpy, vtk and dataclass objects."""
+        if data is None:
+            return 0
+        if hasattr(data, "GetActualMemorySize"):
+            return conv.memory_size(data)
+        if isinstance(data, np.ndarray):
+            return data.nbytes
+        if isinstance(data, (tuple, list)):
+            return sum(cls.size_of(d) for d in data)
+        if hasattr(data, "__dict__"):
+            return sum(cls.size_of(d) for d in vars(data).values())
+        return 0
 
 
 class Vertebra:
@@ -148,13 +387,57 @@ class Vertebra:
         up_approximator: UpApproximator,
         slice_thickness: float,
         max_angle: float,
+        lean: bool = False,
+        max_triangles: int = 0,
+        max_error: float = 0.0,
+        proxy_triangles: int = 0,
+        memory_report: bool = False,
     ) -> None:
+        """
+        Analyse a single vertebra geometry.
+
+        With "lean" set, every vtk geometry is dropped right after the
+        stage that uses it last: "geometry" once the appendix is clipped
+        off, the center portion once the endplates are selected, these
+        once cut, and the curves once their records are taken. Only
+        orientation, regressions and curve records (numpy arrays) remain;
+        "geometry" and the vtk members of "body" are None afterwards. The
+        caller's reference to "geometry" is of course not dropped.
+
+        With "memory_report" set, "memory" is a MemoryReport of the
+        stages, otherwise None.
+
+        With "max_triangles" or "max_error" set, the geometry is decimated
+        to at most that many triangles, or as far as its surface moves by
+        less than "max_error", before any other stage. "geometry" is then
+        the decimated one. See "benchmark.py decimation" for the drift of
+        the results.
+
+        With "proxy_triangles" set, the orientation (bounding box, center
+        of mass and up direction) is estimated on that many triangles of
+        the geometry, sampled evenly along the mesh, and only the slab of
+        the endplate curves is clipped at full resolution. Time and memory
+        then depend mostly on the slab. "up_approximator" should be built from the
+        same proxies, see approximate_up.
+        """
+        if max_triangles or max_error:
+            geometry = conv.decimate(geometry, triangles=max_triangles, max_error=max_error)
+        self.memory = MemoryReport() if memory_report else None
+        if self.memory is not None:
+            self.memory.hold("geometry", geometry)
         self.geometry = geometry
         self.orientation = Vertebra._calc_orientation(
-            geometry,
+            conv.subsample_polys(geometry, proxy_triangles) if proxy_triangles else geometry,
             up_approximator=up_approximator,
             approx_lateral_axis=lateral_axis,
         )
+        if proxy_triangles:
+            geometry = conv.extract_slab(
+                geometry,
+                plane_origin=self.orientation.center,
+                plane_normal=self.orientation.right,
+                half_width=slice_thickness * self.orientation.width / 2.0,
+            )
 
         # TODO clip_plane "plane_normal" param seems inverted
         vertebra_without_appendix = conv.clip_plane(
@@ -162,13 +445,35 @@ class Vertebra:
             plane_origin=self.orientation.center,
             plane_normal=self.orientation.front,
         )
+        if self.memory is not None:
+            self.memory.hold("orientation", self.orientation)
+            self.memory.hold("vertebra_without_appendix", vertebra_without_appendix)
+        if lean:
+            geometry = self.geometry = None
+            # unless decimated here, the caller still holds it
+            if self.memory is not None and (max_triangles or max_error):
+                self.memory.release("geometry")
 
         self.body = Vertebra._extract_body(
             vertebra_without_appendix,
             orientation=self.orientation,
             width=slice_thickness,
             max_angle=max_angle,
+            lean=lean,
+            memory=self.memory,
         )
+        if self.memory is not None:
+            self.memory.hold("body", self.body)
+            self.memory.release("vertebra_without_appendix")
+
+    def __getstate__(self) -> dict:
+        state = dict(vars(self))
+        state["geometry"] = pack_polydata(self.geometry)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        state["geometry"] = unpack_polydata(state["geometry"])
+        vars(self).update(state)
 
     def angle(self, other: Vertebra):
         rotation_axis = conv.normalize(self.orientation.right)
@@ -212,14 +517,27 @@ class Vertebra:
 
     @staticmethod
     def _extract_body(
-        body: vtkPolyData, orientation: Orientation, width: float, max_angle: float
+        body: vtkPolyData,
+        orientation: Orientation,
+        width: float,
+        max_angle: float,
+        lean: bool = False,
+        memory: Optional[MemoryReport] = None,
     ) -> Body:
         center_portion = Vertebra._extract_center(
             body, orientation=orientation, width=width
         )
+        if memory is not None:
+            memory.hold("center_portion", center_portion)
         endplates = conv.eliminate_misaligned_faces(
             center_portion, direction=orientation.up, max_angle=max_angle
         )
+        if memory is not None:
+            memory.hold("endplates", endplates)
+        if lean:
+            center_portion = None
+            if memory is not None:
+                memory.release("center_portion")
         curves = conv.cut_plane(
             endplates,
             plane_origin=orientation.center,
@@ -237,18 +555,30 @@ class Vertebra:
                 plane_normal=orientation.up,
             ),
         )
+        if memory is not None:
+            memory.hold("curves", curves)
+        if lean:
+            endplates = None
+            if memory is not None:
+                memory.release("endplates")
         regressions = [conv.normalize(calc_main_component(s)) for s in curves]
         regressions = [
             -direction if direction.dot(orientation.front) < 0 else direction
             for direction in regressions
         ]
 
-        return Body(
+        body = Body(
             center_portion=center_portion,
             endplates=endplates,
             curves=curves,
             regressions=regressions,
         )
+        if lean:
+            body.release()
+        if memory is not None:
+            for stage in ("center_portion", "endplates", "curves"):
+                memory.release(stage)
+        return body
 
     @staticmethod
     def _extract_center(
@@ -288,6 +618,34 @@ class Vertebra:
         )
 
 
+def _build_vertebra(descriptor: MeshDescriptor, parameters: dict) -> Vertebra:
+    """Construct a Vertebra from a geometry in shared memory, inside a worker process."""
+    from shared_mesh import AttachedMesh
+
+    with AttachedMesh(descriptor) as mesh:
+        vertebra = Vertebra(mesh.polydata, **parameters)
+        # a decimated geometry is the worker's own, the shared one is reattached
+        if vertebra.geometry is mesh.polydata:
+            vertebra.geometry = None
+    return vertebra
+
+
+def approximate_up(geometries: List[vtkPolyData], proxy_triangles: int = 0) -> UpApproximator:
+    """UpApproximator of the geometries, or of proxies of "proxy_triangles" each, as used by Vertebra."""
+    if proxy_triangles:
+        geometries = [conv.subsample_polys(g, proxy_triangles) for g in geometries]
+    return UpApproximator(geometries)
+
+
+def pack_polydata(polydata: vtkPolyData) -> Dict[str, np.ndarray]:
+    """Return a picklable representation of a geometry, which may be None."""
+    return None if polydata is None else conv.polydata_to_arrays(polydata)
+
+
+def unpack_polydata(arrays: Dict[str, np.ndarray]) -> vtkPolyData:
+    return None if arrays is None else conv.polydata_from_arrays(arrays)
+
+
 class UpApproximator:
     """
     For a set of vertebra geoemtries, guess the most probable up-vector.
@@ -308,6 +666,9 @@ class UpApproximator:
     """
 
     def __init__(self, geomemtries: vtkPolyData) -> None:
+        # scipy is slow to import, and only needed from here on
+        from scipy.interpolate import PchipInterpolator
+
         centers_of_mass = np.array([conv.calc_center_of_mass(g) for g in geomemtries])
         self.most_significant_column = self.column_with_widest_spread(centers_of_mass)
         centers_of_mass = self.sort_by_column(
@@ -357,6 +718,31 @@ class UpApproximator:
         )
 
 
+def calc_angle_matrix(
+    first_regressions: np.ndarray,
+    second_regressions: np.ndarray,
+    rotation_axes: np.ndarray,
+) -> np.ndarray:
+    """
+    Return the signed angles in degrees between every row of "first_regressions"
+    and every row of "second_regressions" as matrix of shape (n, n). The sign of
+    element [i, j] is given by the rotation about "rotation_axes[i]".
+
+    Keyword Arguments:
+    first_regressions - (n, 3) directions, one per vertebra
+    second_regressions - (n, 3) directions, one per vertebra
+    rotation_axes - (n, 3) lateral axes, one per vertebra
+    """
+    first = first_regressions / np.linalg.norm(first_regressions, axis=1, keepdims=True)
+    second = second_regressions / np.linalg.norm(second_regressions, axis=1, keepdims=True)
+    axes = rotation_axes / np.linalg.norm(rotation_axes, axis=1, keepdims=True)
+
+    # (second_j x first_i) . axis_i == second_j . (first_i x axis_i)
+    sines = np.einsum("jk,ik->ij", second, np.cross(first, axes))
+    cosines = np.einsum("ik,jk->ij", first, second)
+    return np.degrees(np.arctan2(sines, cosines))
+
+
 def calc_main_component(geometry: vtk.vtkPolyData):
     """
     Return the main component of singular value decomposition through
@@ -0,0 +1,352 @@
+"""
+SQLite store of cohort results.
+
+Instead of one CSV row per spine, whose columns depend on the levels
+present, all spines of a cohort go into one indexed database:
+
+    parameter_sets  one row per combination of analysis parameters
+    spines          one row per spine id and parameter set
+    angles          one row per pair of adjacent vertebrae, e.g. "L4/L5"
+    vertebrae       center, axes, width, height and endplate regressions
+
+Writes are collected and committed in batches, except in batch runs with
+a journal, which commit every spine before the journal marks it done. The
+database runs in WAL mode, so readers are not blocked while a batch run
+is writing.
+
+Usage:
+    with ResultsStore("cohort.sqlite") as store:
+        store.add_spine("patient_042", spine, Parameters(max_angle=45.0))
+
+    store = ResultsStore("cohort.sqlite")
+    store.angles("L4/L5", max_angle=45.0)   # numpy array over all spines
+    store.angles("L4/L5", max_triangles=20000)  # of spines decimated to 20000 triangles
+
+Queries return results at full resolution unless a decimation or proxy
+parameter is given; None for a parameter matches any value.
+    store.export_wide_csv("cohort.csv")
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+
+from csv import writer
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from batch_journal import parameters_key
+from morphology import Endplate, Spine
+from spine_result import SpineResult
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parameter_sets (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    right_x REAL, right_y REAL, right_z REAL,
+    thickness REAL,
+    max_angle REAL,
+    max_triangles INTEGER NOT NULL DEFAULT 0,
+    max_error REAL NOT NULL DEFAULT 0,
+    proxy_triangles INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS spines (
+    id INTEGER PRIMARY KEY,
+    spine_id TEXT NOT NULL,
+    parameter_set INTEGER NOT NULL REFERENCES parameter_sets (id),
+    UNIQUE (spine_id, parameter_set)
+);
+CREATE TABLE IF NOT EXISTS angles (
+    spine INTEGER NOT NULL REFERENCES spines (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    pair TEXT NOT NULL,
+    angle REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vertebrae (
+    spine INTEGER NOT NULL REFERENCES spines (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    level TEXT NOT NULL,
+    center_x REAL, center_y REAL, center_z REAL,
+    right_x REAL, right_y REAL, right_z REAL,
+    front_x REAL, front_y REAL, front_z REAL,
+    up_x REAL, up_y REAL, up_z REAL,
+    width REAL,
+    height REAL,
+    upper_x REAL, upper_y REAL, upper_z REAL,
+    lower_x REAL, lower_y REAL, lower_z REAL
+);
+CREATE INDEX IF NOT EXISTS spines_by_id ON spines (spine_id);
+CREATE INDEX IF NOT EXISTS spines_by_parameters ON spines (parameter_set);
+CREATE INDEX IF NOT EXISTS angles_by_pair ON angles (pair, spine, angle);
+CREATE INDEX IF NOT EXISTS angles_by_spine ON angles (spine);
+CREATE INDEX IF NOT EXISTS vertebrae_by_spine ON vertebrae (spine);
+CREATE INDEX IF NOT EXISTS vertebrae_by_level ON vertebrae (level);
+"""
+
+VERTEBRA_COLUMNS = 23
+# endplates in the order of the upper_* and lower_* regression columns
+REGRESSION_COLUMNS = [Endplate.UPPER, Endplate.LOWER]
+# PRAGMA user_version of the schema
+SCHEMA_VERSION = 1
+# parameter_sets columns queries filter on, with the value they default to, None for any
+PARAMETER_FILTERS = {"thickness": None, "max_angle": None, "max_triangles": 0, "max_error": 0.0, "proxy_triangles": 0}
+PARAMETER_TYPES = {"max_triangles": "INTEGER", "max_error": "REAL", "proxy_triangles": "INTEGER"}
+
+
+def segment_pairs(levels: Sequence[str]) -> List[str]:
+    """Names of adjacent pairs, "L4/L5", or by position, "3/4", for unnamed vertebrae."""
+    return [
+        f"{first}/{second}" if first and second else f"{i}/{i + 1}"
+        for i, (first, second) in enumerate(zip(levels, levels[1:]))
+    ]
+
+
+class ResultsStore:
+    """
+    Keyword Arguments:
+    filename - SQLite database, created if missing
+    batch_size - number of spines per transaction
+    """
+
+    def __init__(self, filename: str, batch_size: int = 100) -> None:
+        self.filename = filename
+        self.batch_size = batch_size
+        self._pending = 0
+        self._parameter_sets: Dict[str, int] = {}
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(SCHEMA)
+        self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._connection.commit()
+
+    def parameter_set(self, parameters: object) -> int:
+        """Row id of a Parameters dataclass, keyed by batch_journal.parameters_key."""
+        key = parameters_key(parameters)
+        if key not in self._parameter_sets:
+            names = ", ".join(PARAMETER_TYPES)
+            self._connection.execute(
+                f"INSERT OR IGNORE INTO parameter_sets (key, right_x, right_y, right_z, thickness, max_angle, {names}) "
+                f"VALUES (?, ?, ?, ?, ?, ?{', ?' * len(PARAMETER_TYPES)})",
+                (
+                    key,
+                    *parameters.right,
+                    parameters.thickness,
+                    parameters.max_angle,
+                    *(getattr(parameters, name, 0) for name in PARAMETER_TYPES),
+                ),
+            )
+            (self._parameter_sets[key],) = self._connection.execute(
+                "SELECT id FROM parameter_sets WHERE key = ?", (key,)
+            ).fetchone()
+        return self._parameter_sets[key]
+
+    def add(self, spine_id: str, result: SpineResult, angles: Sequence[float], parameters: object) -> None:
+        """
+        Add or replace a spine analysed with "parameters", given its
+        SpineResult and the angles between adjacent vertebrae.
+        """
+        parameter_set = self.parameter_set(parameters)
+        self._connection.execute(
+            "DELETE FROM spines WHERE spine_id = ? AND parameter_set = ?", (spine_id, parameter_set)
+        )
+        spine = self._connection.execute(
+            "INSERT INTO spines (spine_id, parameter_set) VALUES (?, ?)", (spine_id, parameter_set)
+        ).lastrowid
+
+        levels = [str(level) for level in result.levels]
+        self._connection.executemany(
+            "INSERT INTO angles (spine, position, pair, angle) VALUES (?, ?, ?, ?)",
+            [(spine, i, pair, float(angle)) for i, (pair, angle) in enumerate(zip(segment_pairs(levels), angles))],
+        )
+        rows = np.column_stack([
+            result.centers,
+            result.frames.reshape(-1, 9),
+            result.widths,
+            result.heights,
+            result.regressions[:, REGRESSION_COLUMNS].reshape(-1, 6),
+        ])
+        self._connection.executemany(
+            f"INSERT INTO vertebrae VALUES (?, ?, ?{', ?' * (VERTEBRA_COLUMNS - 3)})",
+            [(spine, i, level, *map(float, row)) for i, (level, row) in enumerate(zip(levels, rows))],
+        )
+
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def add_spine(self, spine_id: str, spine: Spine, parameters: object) -> None:
+        self.add(spine_id, SpineResult.from_spine(spine, spine_id=spine_id), spine.angles, parameters)
+
+    def flush(self) -> None:
+        self._connection.commit()
+        self._pending = 0
+
+    def _where(self, spine_id: Optional[str], parameters: Dict[str, Optional[float]]) -> tuple:
+        """
+        SQL conditions on a spine id and on parameters, see PARAMETER_FILTERS;
+        unless given, only results at full resolution match.
+        """
+        clauses, values = [], []
+        if spine_id is not None:
+            clauses.append("s.spine_id = ?")
+            values.append(spine_id)
+        unknown = set(parameters) - set(PARAMETER_FILTERS)
+        if unknown:
+            raise ValueError(f"unknown parameter {sorted(unknown)[0]!r}")
+        for name, value in {**PARAMETER_FILTERS, **parameters}.items():
+            if value is None:
+                continue
+            clauses.append(f"p.{name} = ?")
+            values.append(value)
+        return (" AND " + " AND ".join(clauses) if clauses else ""), values
+
+    def angles(self, pair: str, **parameters: Optional[float]) -> np.ndarray:
+        """All angles of "pair" (e.g. "L4/L5"), filtered by parameters as in PARAMETER_FILTERS."""
+        where, values = self._where(None, parameters)
+        rows = self._connection.execute(
+            "SELECT a.angle FROM angles a "
+            "JOIN spines s ON s.id = a.spine JOIN parameter_sets p ON p.id = s.parameter_set "
+            f"WHERE a.pair = ?{where}",
+            [pair, *values],
+        ).fetchall()
+        return np.array([row[0] for row in rows], dtype=float)
+
+    def to_arrays(self, **parameters: Optional[float]) -> Dict[str, np.ndarray]:
+        """
+        Return the angles of all matching spines as a wide matrix.
+
+        Keys:
+            spine_ids -- (S,) spine ids
+            parameter_sets -- (S,) parameter set of each row
+            pairs -- (P,) level pairs, cranial to caudal
+            angles -- (S, P) angles, NaN where a spine lacks a pair
+        """
+        where, values = self._where(None, parameters)
+        rows = self._connection.execute(
+            "SELECT s.id, s.spine_id, s.parameter_set, a.pair, a.angle FROM spines s "
+            "JOIN parameter_sets p ON p.id = s.parameter_set LEFT JOIN angles a ON a.spine = s.id "
+            f"WHERE 1{where} ORDER BY s.spine_id, s.parameter_set",
+            values,
+        ).fetchall()
+
+        spines: Dict[int, int] = {}
+        spine_ids, parameter_sets = [], []
+        for spine, spine_id, parameter_set, *_ in rows:
+            if spine not in spines:
+                spines[spine] = len(spines)
+                spine_ids.append(spine_id)
+                parameter_sets.append(parameter_set)
+
+        order = {pair: i for i, pair in enumerate(Spine.generate_headers())}
+        pairs = sorted({row[3] for row in rows if row[3] is not None}, key=lambda p: (order.get(p, len(order)), p))
+        columns = {pair: i for i, pair in enumerate(pairs)}
+        angles = np.full((len(spines), len(pairs)), np.nan)
+        for spine, _, _, pair, angle in rows:
+            if pair is not None:
+                angles[spines[spine], columns[pair]] = angle
+        return {
+            "spine_ids": np.array(spine_ids, dtype=str),
+            "parameter_sets": np.array(parameter_sets, dtype=np.int64),
+            "pairs": np.array(pairs, dtype=str),
+            "angles": angles,
+        }
+
+    def spine_result(self, spine_id: Optional[str] = None, **parameters: Optional[float]) -> SpineResult:
+        """Vertebrae of all matching spines, or of a single "spine_id", as a SpineResult."""
+        where, values = self._where(spine_id, parameters)
+        rows = self._connection.execute(
+            "SELECT s.id, s.spine_id, v.* FROM vertebrae v "
+            "JOIN spines s ON s.id = v.spine JOIN parameter_sets p ON p.id = s.parameter_set "
+            f"WHERE 1{where} ORDER BY s.id, v.position",
+            values,
+        ).fetchall()
+        if not rows:
+            return SpineResult.empty()
+
+        spines = {spine: i for i, spine in enumerate(dict.fromkeys(row[0] for row in rows))}
+        spine_ids = list(dict.fromkeys((row[0], row[1]) for row in rows))
+        data = np.array([row[5:] for row in rows], dtype=float)
+        regressions = np.empty((len(rows), 2, 3))
+        regressions[:, REGRESSION_COLUMNS] = data[:, 14:20].reshape(-1, 2, 3)
+        return SpineResult(
+            levels=np.array([row[4] for row in rows], dtype=str),
+            centers=data[:, 0:3],
+            frames=data[:, 3:12],
+            widths=data[:, 12],
+            heights=data[:, 13],
+            regressions=regressions,
+            spine_index=np.array([spines[row[0]] for row in rows]),
+            spine_ids=np.array([spine_id for _, spine_id in spine_ids], dtype=str),
+        )
+
+    def export_wide_csv(self, filename: str, **parameters: Optional[float]) -> None:
+        """One row per spine and parameter set, one column per level pair."""
+        arrays = self.to_arrays(**parameters)
+        with open(filename, "w", newline="") as csv_file:
+            rows = writer(csv_file)
+            rows.writerow(["spine_id", "parameter_set", *arrays["pairs"]])
+            for spine_id, parameter_set, angles in zip(arrays["spine_ids"], arrays["parameter_sets"], arrays["angles"]):
+                rows.writerow([spine_id, parameter_set, *("" if np.isnan(a) else repr(float(a)) for a in angles)])
+
+    def close(self) -> None:
+        self.flush()
+        self._connection.close()
+
+    def __enter__(self) -> ResultsStore:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    Parser = ArgumentParser(
+        prog='Slopes results',
+        description='Export the angles of a results store as a wide CSV file or as NumPy arrays.',
+    )
+    Parser.add_argument('store', metavar='FILE', type=str, help='SQLite results store.')
+    Parser.add_argument('--csv', metavar='FILE', type=str, help='Write one row per spine and parameter set.')
+    Parser.add_argument('--npz', metavar='FILE', type=str, help='Write the arrays of ResultsStore.to_arrays.')
+    Parser.add_argument('--thickness', metavar='THICK', type=float, help='Only spines analysed with this thickness.')
+    Parser.add_argument('--max-angle', metavar='ANGLE', type=float, help='Only spines analysed with this maximum angle.')
+    Parser.add_argument(
+        '--max-triangles',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Only spines decimated to this many triangles per vertebra. (default: 0, full resolution)',
+    )
+    Parser.add_argument(
+        '--max-error',
+        metavar='MM',
+        type=float,
+        default=0.0,
+        help='Only spines decimated with this error bound. (default: 0, full resolution)',
+    )
+    Parser.add_argument(
+        '--proxy-triangles',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Only spines oriented on proxies of this many triangles. (default: 0, full resolution)',
+    )
+
+    Arguments = Parser.parse_args()
+    Filters = dict(
+        thickness=Arguments.thickness,
+        max_angle=Arguments.max_angle,
+        max_triangles=Arguments.max_triangles,
+        max_error=Arguments.max_error,
+        proxy_triangles=Arguments.proxy_triangles,
+    )
+    with ResultsStore(Arguments.store) as Store:
+        if Arguments.csv:
+            Store.export_wide_csv(Arguments.csv, **Filters)
+        if Arguments.npz:
+            np.savez(Arguments.npz, **Store.to_arrays(**Filters))
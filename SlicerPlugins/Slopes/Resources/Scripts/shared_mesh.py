@@ -0,0 +1,144 @@
+"""
+Shared memory transport of vtk geometries between processes.
+
+The owning process copies a geometry's point, cell and normal arrays
+once into multiprocessing.shared_memory segments and hands a small,
+picklable MeshDescriptor to its workers. Workers rebuild a vtkPolyData
+that references the segments without copying.
+
+Only the owner unlinks segments: on SharedMesh.close, when leaving its
+with-block, or when it is garbage collected. A crashing worker therefore
+leaks nothing, and should the owner crash itself, the multiprocessing
+resource tracker removes its segments.
+
+Usage:
+    # owner
+    with SharedMesh(load_stl("L1.stl")) as shared:
+        pool.submit(work, shared.descriptor)
+
+    # worker
+    def work(descriptor):
+        with AttachedMesh(descriptor) as mesh:
+            return calc_center_of_mass(mesh.polydata)
+"""
+from __future__ import annotations
+
+import weakref
+
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+
+
+@dataclass(frozen=True)
+class ArrayDescriptor:
+    segment: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+@dataclass(frozen=True)
+class MeshDescriptor:
+    """Names of shared memory segments per array, see polydata_to_arrays."""
+    arrays: Dict[str, ArrayDescriptor]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            int(np.prod(a.shape)) * np.dtype(a.dtype).itemsize
+            for a in self.arrays.values()
+        )
+
+
+class SharedMesh:
+    """
+    Owner side of a geometry in shared memory. The geometry's arrays are
+    copied once into new segments, which live until this object is closed.
+    """
+
+    def __init__(self, polydata: vtkPolyData) -> None:
+        self._segments: List[SharedMemory] = []
+        self._finalizer = weakref.finalize(self, _unlink, self._segments)
+
+        descriptors = {}
+        for name, array in conv.polydata_to_arrays(polydata, copy=False).items():
+            segment = SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._segments.append(segment)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+            descriptors[name] = ArrayDescriptor(segment.name, array.shape, array.dtype.str)
+        self.descriptor = MeshDescriptor(descriptors)
+
+    def close(self) -> None:
+        """Release and unlink all segments. Attached workers keep their mapping."""
+        self._finalizer()
+
+    def __enter__(self) -> SharedMesh:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class AttachedMesh:
+    """
+    Worker side of a geometry in shared memory. "polydata" references
+    the segments directly; it must not be modified.
+    """
+
+    def __init__(self, descriptor: MeshDescriptor) -> None:
+        self._segments = []
+        arrays = {}
+        for name, array in descriptor.arrays.items():
+            segment = _attach(array.segment)
+            self._segments.append(segment)
+            arrays[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+        self.polydata = conv.polydata_from_arrays(arrays, deep=False)
+
+    def close(self) -> None:
+        """
+        Detach from all segments. While vtk objects derived from "polydata"
+        still reference the memory, the mapping stays until they are gone.
+        """
+        self.polydata = None
+        for segment in self._segments:
+            try:
+                segment.close()
+            except BufferError:
+                pass
+        self._segments = []
+
+    def __enter__(self) -> AttachedMesh:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def _attach(name: str) -> SharedMemory:
+    """
+    Attach to an existing segment. Where supported, the segment is not
+    registered with this process' resource tracker, so it outlives the worker.
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+def _unlink(segments: List[SharedMemory]) -> None:
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            pass
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+    segments.clear()
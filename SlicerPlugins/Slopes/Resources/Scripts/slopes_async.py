@@ -0,0 +1,186 @@
+"""
+Asyncio interface to the spine analysis.
+
+Loading and analysing vertebrae is blocking and takes seconds, so all of
+it runs in an executor. Results are streamed per vertebra while the
+remaining ones are still being analysed. An AsyncAnalyzer bounds the
+number of loads and vertebra analyses running at the same time across
+all spines it serves, so one event loop can accept many requests without
+overloading the machine. The bound holds per event loop, an analyzer may
+serve several loops one after another, as repeated asyncio.run calls do.
+
+Cancelling the consuming task, or leaving the async for loop early,
+cancels all work of that spine that has not started yet. Work already
+running in the executor finishes, but its result is discarded.
+
+Usage:
+    async for result in analyze_spine(paths, max_angle=40.0):
+        print(result.level, result.vertebra.orientation.up)
+
+    spine = await collect_spine(paths)
+    spine.named_angles
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import weakref
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from morphology import Spine, Vertebra, approximate_up
+from vtk_convenience import load_stl
+
+
+@dataclass(frozen=True)
+class VertebraResult:
+    index: int
+    filename: str
+    level: str
+    vertebra: Vertebra
+
+
+class AsyncAnalyzer:
+    """
+    Runs analyses in "executor", at most "max_concurrency" steps at a time.
+
+    Keyword Arguments:
+    max_concurrency - maximum number of loads and vertebra analyses in flight
+    executor - concurrent.futures executor to run them in (default: a thread
+    pool of "max_concurrency" threads, shut down by close)
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, executor: Optional[Executor] = None) -> None:
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="slopes"
+        )
+        # a semaphore is bound to the loop it is first used in
+        self._slots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    async def _run(self, func: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        slots = self._slots.get(loop)
+        if slots is None:
+            slots = self._slots[loop] = asyncio.Semaphore(self.max_concurrency)
+        async with slots:
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def analyze_spine(
+        self,
+        paths: Sequence[str],
+        right: Tuple[float, float, float] = (1.0, 0.0, 0.0),
+        thickness: float = 0.25,
+        max_angle: float = 45.0,
+        lean: bool = True,
+        max_triangles: int = 0,
+        max_error: float = 0.0,
+        proxy_triangles: int = 0,
+    ) -> AsyncIterator[VertebraResult]:
+        """
+        Yield the analysed vertebrae of the STL files "paths" in the order
+        they are finished. Parameters are those of Spine.
+        """
+        paths = list(paths)
+        if len(paths) < 2:
+            raise ValueError("a spine needs at least two vertebrae")
+
+        geometries = await _all_or_nothing([self._run(load_stl, p) for p in paths])
+        up_approximator = await self._run(approximate_up, geometries, proxy_triangles)
+        parameters = dict(
+            lateral_axis=np.array(right),
+            up_approximator=up_approximator,
+            slice_thickness=thickness,
+            max_angle=max_angle,
+            lean=lean,
+            max_triangles=max_triangles,
+            max_error=max_error,
+            proxy_triangles=proxy_triangles,
+        )
+
+        offset = Spine.offset_from_filename(os.path.basename(paths[0]))
+        levels = Spine.VERTEBRAE[offset:] if offset is not None else ()
+        tasks = [
+            asyncio.ensure_future(_indexed(i, self._run(Vertebra, g, **parameters)))
+            for i, g in enumerate(geometries)
+        ]
+        del geometries
+        try:
+            for finished in asyncio.as_completed(tasks):
+                index, vertebra = await finished
+                level = levels[index] if index < len(levels) else ""
+                yield VertebraResult(index, paths[index], level, vertebra)
+        finally:
+            await _cancel(tasks)
+
+    def close(self) -> None:
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self) -> AsyncAnalyzer:
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        self.close()
+
+
+async def _indexed(index: int, awaitable: Awaitable) -> Tuple[int, object]:
+    return index, await awaitable
+
+
+async def _all_or_nothing(awaitables: List[Awaitable]) -> list:
+    """Like asyncio.gather, but cancels the others as soon as one fails."""
+    tasks = [asyncio.ensure_future(a) for a in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        await _cancel(tasks)
+
+
+async def _cancel(tasks: List[asyncio.Future]) -> None:
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_default_analyzer: Optional[AsyncAnalyzer] = None
+
+
+def default_analyzer() -> AsyncAnalyzer:
+    """Shared analyzer of analyze_spine and collect_spine, created on first use."""
+    global _default_analyzer
+    if _default_analyzer is None:
+        _default_analyzer = AsyncAnalyzer()
+    return _default_analyzer
+
+
+def analyze_spine(
+    paths: Sequence[str], analyzer: Optional[AsyncAnalyzer] = None, **parameters
+) -> AsyncIterator[VertebraResult]:
+    """Stream the vertebrae of a spine, see AsyncAnalyzer.analyze_spine."""
+    return (analyzer or default_analyzer()).analyze_spine(paths, **parameters)
+
+
+async def collect_spine(
+    paths: Sequence[str], analyzer: Optional[AsyncAnalyzer] = None, **parameters
+) -> Spine:
+    """Analyse a whole spine and return it named by its first file, as Spine does."""
+    vertebrae: List[Optional[Vertebra]] = [None] * len(paths)
+    results = analyze_spine(paths, analyzer, **parameters)
+    try:
+        async for result in results:
+            vertebrae[result.index] = result.vertebra
+    finally:
+        await results.aclose()
+
+    spine = Spine.from_vertebrae(vertebrae)
+    offset = Spine.offset_from_filename(os.path.basename(paths[0]))
+    if offset is not None:
+        spine.name_vertebrae(offset_to_c1=offset)
+    return spine
@@ -0,0 +1,854 @@
+"""
+Batch analysis of whole cohorts.
+
+Each spine is a directory holding one STL file per vertebra, named by its
+level (e.g. "L1.stl"). The angles of each spine are written to
+"<output>/<spine id>.csv" the same way Spine.write does for a single spine.
+
+Loading and analysis overlap: a bounded pool of loader threads reads the
+meshes of the next spines while the current one is analysed. At most
+"prefetch" loaded spines wait in memory; loaders block once that limit is
+reached. Per-stage utilisation is reported at the end, to size both pools.
+
+With "--workers", spines are instead loaded and analysed in supervised
+worker processes (see worker_pool.py). A worker stuck on a spine or a
+single vertebra longer than the given timeouts is killed and replaced, and
+the spine is reported as failed. Workers are also replaced after a number
+of spines or once their memory exceeds a ceiling.
+
+Output files are written to a temporary file first and renamed into
+place, so a killed run never leaves a truncated CSV. With "--journal",
+finished spines are recorded in a SQLite file; a restarted run skips them
+and retries failed or crashed spines up to "--max-attempts" times.
+
+Usage:
+    python slopes_batch.py cohort/* -o results --io-threads 4 --prefetch 2
+    python slopes_batch.py cohort/* -o results --journal results/journal.sqlite
+    python slopes_batch.py cohort/* -o results -j 8 --spine-timeout 600 --vertebra-timeout 120 --max-rss 2000
+"""
+from __future__ import annotations
+
+import os
+import socket
+import sys
+
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from glob import glob
+from operator import attrgetter
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from batch_journal import Journal, RetryPolicy, file_hash, parameters_key
+from cohort_stats import CohortStatistics
+from columnar import CohortColumns, check_format, spine_curves, write_columns
+from cost_model import CostModel, Plan, Task, plan_tasks
+from label_volume import METHODS, configure_extraction, is_volume, is_volume_member, volume_members, volume_name
+from labelled_surface import expand_surfaces, is_surface, is_surface_member
+from mesh_archive import SUFFIX, is_member, member_filenames
+from mesh_pack import SUFFIX as PACK_SUFFIX, is_pack_member, pack_member_filenames
+from morphology import Spine, UpApproximator, Vertebra, approximate_up
+from results_store import ResultsStore
+from spine_result import SpineResult
+from vtkmodules.vtkCommonDataModel import vtkPolyData
+from vtk_convenience import configure_smp, load_stl
+from worker_pool import MIB, Limits, SupervisedPool
+
+
+@dataclass(frozen=True)
+class SpineJob:
+    spine_id: str
+    filenames: Tuple[str, ...]
+
+    @classmethod
+    def from_directory(cls, directory: str) -> SpineJob:
+        """
+        Collect all STL files in "directory", or all members of a mesh
+        archive, or all levels of a labelled surface file or label map,
+        ordered from cranial to caudal.
+        """
+        if is_volume(directory):
+            return cls(spine_id=volume_name(directory), filenames=tuple(volume_members(directory)))
+        if is_surface(directory):
+            return cls(
+                spine_id=os.path.splitext(os.path.basename(directory))[0],
+                filenames=tuple(expand_surfaces([directory])),
+            )
+        if directory.endswith(SUFFIX) and os.path.isfile(directory):
+            return cls(
+                spine_id=os.path.basename(directory)[: -len(SUFFIX)],
+                filenames=tuple(sorted(member_filenames(directory), key=level_order)),
+            )
+        filenames = glob(os.path.join(directory, "*.stl")) + glob(os.path.join(directory, "*.STL"))
+        return cls(
+            spine_id=os.path.basename(os.path.normpath(directory)),
+            filenames=tuple(sorted(filenames, key=level_order)),
+        )
+
+
+def spine_jobs(paths: Iterable[str]) -> Iterator[SpineJob]:
+    """A job per spine directory or mesh archive, and per spine of a mesh pack."""
+    for path in paths:
+        if os.path.normpath(path).endswith(PACK_SUFFIX):
+            for spine_id, filenames in pack_member_filenames(path).items():
+                yield SpineJob(spine_id, tuple(sorted(filenames, key=level_order)))
+        else:
+            yield SpineJob.from_directory(path)
+
+
+def vertebra_name(filename: str) -> str:
+    """File name of an STL file, or level of a mesh within a mesh archive, pack, labelled surface or label map."""
+    if any(member(filename) for member in (is_member, is_pack_member, is_surface_member, is_volume_member)):
+        filename = filename.rpartition("#")[2]
+    return os.path.basename(filename)
+
+
+def level_order(filename: str) -> Tuple[bool, int, str]:
+    """Sort key placing files named after a vertebra first, cranial to caudal."""
+    offset = Spine.offset_from_filename(vertebra_name(filename))
+    return offset is None, offset or 0, filename
+
+
+@dataclass(frozen=True)
+class Parameters:
+    right: Tuple[float, float, float] = (1.0, 0.0, 0.0)
+    thickness: float = 0.25
+    max_angle: float = 45.0
+    max_triangles: int = 0
+    max_error: float = 0.0
+    proxy_triangles: int = 0
+
+
+def analyse(
+    job: SpineJob,
+    geometries: List[vtkPolyData],
+    parameters: Parameters,
+    progress: Optional[Callable[[int], None]] = None,
+) -> Spine:
+    """
+    Return the lean Spine of a job, named by its first file if possible.
+    "progress" is called with the index of each vertebra before it is analysed.
+    """
+    if progress is None:
+        spine = Spine(
+            geometries,
+            lateral_axis=np.array(parameters.right),
+            slice_thickness=parameters.thickness,
+            max_angle=parameters.max_angle,
+            lean=True,
+            max_triangles=parameters.max_triangles,
+            max_error=parameters.max_error,
+            proxy_triangles=parameters.proxy_triangles,
+        )
+    else:
+        up_approximator = approximate_up(geometries, parameters.proxy_triangles)
+        vertebrae = []
+        for index, geometry in enumerate(geometries):
+            progress(index)
+            vertebrae.append(analyse_vertebra(geometry, up_approximator, parameters))
+        spine = Spine.from_vertebrae(vertebrae)
+    return name_spine(spine, job)
+
+
+def analyse_vertebra(geometry: vtkPolyData, up_approximator: UpApproximator, parameters: Parameters) -> Vertebra:
+    return Vertebra(
+        geometry,
+        lateral_axis=np.array(parameters.right),
+        up_approximator=up_approximator,
+        slice_thickness=parameters.thickness,
+        max_angle=parameters.max_angle,
+        lean=True,
+        max_triangles=parameters.max_triangles,
+        max_error=parameters.max_error,
+        proxy_triangles=parameters.proxy_triangles,
+    )
+
+
+def name_spine(spine: Spine, job: SpineJob) -> Spine:
+    """Name the vertebrae of "spine" by the first file of its job, if possible."""
+    offset = Spine.offset_from_filename(vertebra_name(job.filenames[0]))
+    if offset is not None:
+        spine.name_vertebrae(offset_to_c1=offset)
+    return spine
+
+
+def warm_up() -> None:
+    """Import what the first analysis of a fresh worker process would otherwise import."""
+    from scipy.interpolate import PchipInterpolator  # pylint: disable=import-outside-toplevel,unused-import
+
+
+def load_job(job: SpineJob) -> List[vtkPolyData]:
+    return [load_stl(f) for f in job.filenames]
+
+
+@dataclass
+class StageClock:
+    """Busy time of one pipeline stage with "workers" parallel workers."""
+    workers: int
+    busy: float = 0.0
+    items: int = 0
+    _lock: Lock = field(default_factory=Lock, repr=False)
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.busy += perf_counter() - start
+                self.items += 1
+
+    def utilisation(self, wall_time: float) -> float:
+        return self.busy / (wall_time * self.workers) if wall_time > 0 else 0.0
+
+
+class SpinePipeline:
+    """
+    Producer/consumer pipeline over spine jobs. Loader threads fill a
+    bounded queue with loaded meshes, iteration hands them out in job order.
+
+    Usage:
+        pipeline = SpinePipeline(jobs, io_threads=4, prefetch=2)
+        for job, geometries in pipeline:
+            spine = analyse(job, geometries.result(), parameters)
+        print(pipeline.report())
+    """
+
+    def __init__(self, jobs: Iterable[SpineJob], io_threads: int = 2, prefetch: int = 2) -> None:
+        self.jobs = jobs
+        self.io_threads = io_threads
+        self.io = StageClock(workers=io_threads)
+        self.compute = StageClock(workers=1)
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.wall_time = 0.0
+        self._queue: Queue = Queue(maxsize=max(prefetch, 1))
+        self._stop = Event()
+
+    def _load(self, job: SpineJob) -> List[vtkPolyData]:
+        with self.io.measure():
+            return load_job(job)
+
+    def _put(self, item: Optional[Tuple[SpineJob, Future]]) -> bool:
+        """Put "item" on the queue unless the consumer stopped; return whether it was put."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce(self, pool: ThreadPoolExecutor) -> None:
+        try:
+            for job in self.jobs:
+                if self._stop.is_set():
+                    return
+                future = pool.submit(self._load, job)
+                start = perf_counter()
+                if not self._put((job, future)):
+                    future.cancel()
+                    return
+                self.blocked += perf_counter() - start
+        finally:
+            # also when listing the jobs fails, so the consumer never waits forever
+            self._put(None)
+
+    def _drain(self) -> None:
+        """Cancel the loads still queued."""
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                return
+            if item is not None:
+                item[1].cancel()
+
+    def __iter__(self) -> Iterator[Tuple[SpineJob, Future]]:
+        """
+        Yield each job with the future of its loaded meshes, which is already
+        done. Time spent by the caller until the next item counts as compute.
+        A caller that stops iterating early also stops the loader threads.
+        """
+        start = perf_counter()
+        self._stop.clear()
+        try:
+            with ThreadPoolExecutor(max_workers=self.io_threads) as pool:
+                producer = Thread(target=self._produce, args=(pool,), daemon=True)
+                producer.start()
+                try:
+                    while True:
+                        waiting = perf_counter()
+                        item = self._queue.get()
+                        if item is None:
+                            break
+                        job, future = item
+                        future.exception()
+                        self.starved += perf_counter() - waiting
+
+                        with self.compute.measure():
+                            yield job, future
+                finally:
+                    self._stop.set()
+                    self._drain()
+                    producer.join()
+                    self._drain()
+        finally:
+            self.wall_time = perf_counter() - start
+
+    def report(self) -> str:
+        return "\n".join([
+            f"wall time: {self.wall_time:.2f} s",
+            f"io: {self.io.items} spines, busy {self.io.busy:.2f} s, "
+            f"utilisation {self.io.utilisation(self.wall_time):.0%} of {self.io_threads} threads, "
+            f"blocked by full queue {self.blocked:.2f} s",
+            f"compute: {self.compute.items} spines, busy {self.compute.busy:.2f} s, "
+            f"utilisation {self.compute.utilisation(self.wall_time):.0%}, "
+            f"waiting for io {self.starved:.2f} s",
+        ])
+
+
+def write_atomically(spine: Spine, filename: str) -> str:
+    """
+    Write "spine" like Spine.write, but through a temporary file renamed
+    into place once complete. Return the SHA-256 of the written file.
+    """
+    # unique across the nodes of a shared output directory, see slopes_queue.py
+    temporary = f"{filename}.{socket.gethostname()}-{os.getpid()}.tmp"
+    try:
+        Spine.write(spine, temporary)
+        with open(temporary, "rb") as file:
+            os.fsync(file.fileno())
+        digest = file_hash(temporary)
+        os.replace(temporary, filename)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return digest
+
+
+@dataclass(frozen=True)
+class UpJob:
+    """The up approximation of a split spine, which its vertebra jobs wait for."""
+    job: SpineJob
+
+    @property
+    def spine_id(self) -> str:
+        return f"{self.job.spine_id}[up]"
+
+
+@dataclass(frozen=True)
+class VertebraJob:
+    """A single vertebra of a spine that the scheduler split into one task per vertebra."""
+    job: SpineJob
+    index: int
+    up_approximator: UpApproximator
+
+    @property
+    def spine_id(self) -> str:
+        return f"{self.job.spine_id}[{self.index}]"
+
+
+@dataclass(frozen=True)
+class Written:
+    """A spine written to its CSV file, with the hash of the file and the numeric results."""
+    digest: str
+    result: SpineResult
+    angles: List[float]
+    curves: List[np.ndarray]
+
+
+def write_spine(spine: Spine, job: SpineJob, output: str) -> Written:
+    digest = write_atomically(spine, output_file(output, job.spine_id))
+    return Written(digest, SpineResult.from_spine(spine, spine_id=job.spine_id), spine.angles, spine_curves(spine))
+
+
+def process_job(
+    job: Union[SpineJob, UpJob, VertebraJob], progress: Callable[[int], None], parameters: Parameters, output: str
+) -> Union[Written, UpApproximator, Vertebra]:
+    """
+    Inside a worker, load, analyse and write a spine, approximate the up
+    direction of a split spine, or analyse and return a single vertebra.
+    """
+    if isinstance(job, UpJob):
+        progress(0)
+        return approximate_up(load_job(job.job), parameters.proxy_triangles)
+    if isinstance(job, VertebraJob):
+        progress(0)
+        geometry = load_stl(job.job.filenames[job.index])
+        return analyse_vertebra(geometry, job.up_approximator, parameters)
+
+    spine = analyse(job, load_job(job), parameters, progress=progress)
+    return write_spine(spine, job, output)
+
+
+def output_file(output: str, spine_id: str) -> str:
+    return os.path.join(output, f"{spine_id}.csv")
+
+
+class Bookkeeping:
+    """Journal entries, stored results, statistics, columns and failure messages of a batch run, kept by the thread running it."""
+
+    def __init__(
+        self,
+        journal: Optional[Journal],
+        store: Optional[ResultsStore],
+        parameters: Parameters,
+        stats: Optional[CohortStatistics] = None,
+        columns: Optional[CohortColumns] = None,
+        stats_file: Optional[str] = None,
+    ) -> None:
+        self.journal = journal
+        self.store = store
+        self.stats = stats
+        self.stats_file = stats_file
+        self.columns = columns
+        self.parameters = parameters
+        self._started = set()
+
+    def start(self, job: SpineJob) -> None:
+        if self.journal is not None and job.spine_id not in self._started:
+            self.journal.start(job.spine_id, self.parameters)
+        self._started.add(job.spine_id)
+
+    def record(self, job: SpineJob, written: Optional[Written], error: Optional[str]) -> None:
+        if error is not None:
+            print(f"{job.spine_id}: failed, {error}", file=sys.stderr)
+        else:
+            if self.store is not None:
+                self.store.add(job.spine_id, written.result, written.angles, self.parameters)
+            if self.stats is not None:
+                self.stats.add_result(job.spine_id, written.result, written.angles)
+                if self.stats_file is not None:
+                    self.stats.save(self.stats_file)
+            if self.columns is not None:
+                self.columns.add(written.result, written.angles, written.curves)
+        if self.journal is None:
+            return
+        if error is None:
+            # committed first, a spine the journal has done is never missing from the store
+            if self.store is not None:
+                self.store.flush()
+            self.journal.finish(job.spine_id, self.parameters, written.digest)
+        else:
+            self.journal.fail(job.spine_id, self.parameters, error)
+
+
+def run_batch(
+    jobs: Iterable[SpineJob],
+    parameters: Parameters,
+    output: str,
+    io_threads: int = 2,
+    prefetch: int = 2,
+    journal: Optional[Journal] = None,
+    policy: RetryPolicy = RetryPolicy(),
+    workers: int = 0,
+    limits: Limits = Limits(),
+    cost_model: Optional[CostModel] = None,
+    split: bool = True,
+    store: Optional[ResultsStore] = None,
+    stats: Optional[CohortStatistics] = None,
+    columns: Optional[CohortColumns] = None,
+    stats_file: Optional[str] = None,
+) -> Union[SpinePipeline, SupervisedPool]:
+    """
+    Analyse all jobs and write one CSV per spine into directory "output".
+    With a "journal", spines already done are skipped and failed ones are
+    retried according to "policy".
+
+    With "workers", spines are analysed in that many supervised processes,
+    which are killed or replaced as given by "limits". Given a "cost_model",
+    they are handed out largest first and, with "split", oversized spines
+    are analysed per vertebra. Otherwise spines are analysed in this process
+    while the next ones are loaded. Return the pipeline or pool, to report on.
+
+    With a "store", the numeric results are also added to that database,
+    with "stats" the angles are counted in those cohort statistics, and
+    with "columns" all numeric results and curves are collected there.
+    With "stats_file", the statistics are saved there after every spine,
+    before the journal marks it done.
+    """
+    os.makedirs(output, exist_ok=True)
+    if journal is not None:
+        # filtered up front: the journal's connection belongs to this thread
+        jobs = list(journal.pending(jobs, parameters, policy, partial(output_file, output)))
+    books = Bookkeeping(journal, store, parameters, stats, columns, stats_file)
+
+    if workers > 0:
+        return run_supervised(jobs, parameters, output, books, workers, limits, cost_model, split)
+
+    pipeline = SpinePipeline(jobs, io_threads=io_threads, prefetch=prefetch)
+    for job, geometries in pipeline:
+        books.start(job)
+        try:
+            spine = analyse(job, geometries.result(), parameters)
+            written = write_spine(spine, job, output)
+        except Exception as error:
+            books.record(job, None, repr(error))
+            continue
+        books.record(job, written, None)
+    return pipeline
+
+
+def run_supervised(
+    jobs: Iterable[SpineJob],
+    parameters: Parameters,
+    output: str,
+    books: Bookkeeping,
+    workers: int,
+    limits: Limits,
+    cost_model: Optional[CostModel],
+    split: bool,
+) -> SupervisedPool:
+    """
+    Run the jobs in a SupervisedPool, see run_batch. The up approximation of
+    a split spine needs all of its meshes; it runs as a task of its own,
+    handed out in place of the spine's first vertebra, and the vertebrae
+    wait for it while other tasks go ahead.
+    """
+    pool = SupervisedPool(
+        partial(process_job, parameters=parameters, output=output),
+        workers=workers,
+        limits=limits,
+        job_id=attrgetter("spine_id"),
+        initializer=warm_up,
+    )
+    if cost_model is not None:
+        pool.plan = Plan(plan_tasks(list(jobs), cost_model, workers, split=split), workers)
+        tasks = pool.plan.tasks
+    else:
+        tasks = [Task(job, cost=0.0) for job in jobs]
+
+    parts: Dict[str, List[Optional[Vertebra]]] = {}
+    up_approximators: Dict[str, UpApproximator] = {}
+    # vertebrae of spines whose up approximation is running, and those it has freed
+    waiting: Dict[str, List[int]] = {}
+    ready: Deque[VertebraJob] = deque()
+    failed = set()
+
+    def released() -> Iterator[VertebraJob]:
+        while ready:
+            vertebra = ready.popleft()
+            if vertebra.job.spine_id not in failed:
+                yield vertebra
+
+    def hand_out() -> Iterator[Union[SpineJob, UpJob, VertebraJob, None]]:
+        for task in tasks:
+            yield from released()
+            job = task.job
+            if job.spine_id in failed:
+                continue
+            books.start(job)
+            if task.vertebra is None:
+                yield job
+            elif job.spine_id in up_approximators:
+                yield VertebraJob(job, task.vertebra, up_approximators[job.spine_id])
+            elif job.spine_id in waiting:
+                waiting[job.spine_id].append(task.vertebra)
+            else:
+                waiting[job.spine_id] = [task.vertebra]
+                parts[job.spine_id] = [None] * len(job.filenames)
+                yield UpJob(job)
+        while waiting or ready:
+            if ready:
+                yield from released()
+            else:
+                # nothing to hand out until an up approximation finishes
+                yield None
+
+    for outcome in pool.map(hand_out()):
+        if isinstance(outcome.job, SpineJob):
+            books.record(outcome.job, outcome.result, outcome.error)
+            continue
+        if isinstance(outcome.job, UpJob):
+            job = outcome.job.job
+            indices = waiting.pop(job.spine_id)
+            if not outcome.ok:
+                failed.add(job.spine_id)
+                del parts[job.spine_id]
+                books.record(job, None, f"up approximation: {outcome.error}")
+                continue
+            up_approximators[job.spine_id] = outcome.result
+            ready.extend(VertebraJob(job, index, outcome.result) for index in indices)
+            continue
+
+        job = outcome.job.job
+        if job.spine_id in failed:
+            continue
+        if not outcome.ok:
+            failed.add(job.spine_id)
+            books.record(job, None, f"vertebra {outcome.job.index}: {outcome.error}")
+            continue
+
+        vertebrae = parts[job.spine_id]
+        vertebrae[outcome.job.index] = outcome.result
+        if any(v is None for v in vertebrae):
+            continue
+        del parts[job.spine_id], up_approximators[job.spine_id]
+        try:
+            spine = name_spine(Spine.from_vertebrae(vertebrae), job)
+            written = write_spine(spine, job, output)
+        except Exception as error:
+            books.record(job, None, repr(error))
+            continue
+        books.record(job, written, None)
+    return pool
+
+
+if __name__ == '__main__':
+    Parser = ArgumentParser(
+        prog='Slopes batch',
+        description='Calculate the superior endplate angles for a cohort of spines.',
+    )
+    Parser.add_argument(
+        'directories',
+        metavar='DIRS',
+        type=str,
+        nargs='+',
+        help='One directory per spine, each containing one STL file per vertebra named by its level, or a mesh archive, labelled surface file or NIfTI/NRRD label map per spine, or mesh packs of many spines.',
+    )
+    Parser.add_argument(
+        '-o',
+        '--output',
+        metavar='DIR',
+        type=str,
+        default='.',
+        help='Directory to write one CSV file per spine to. (default: .)',
+    )
+    Parser.add_argument(
+        '-r',
+        '--right',
+        metavar='FLOAT',
+        type=float,
+        nargs=3,
+        default=[1.0, 0.0, 0.0],
+        help='Direction of that axis, where a subjects right shoulder would point towards. (default: 1 0 0)',
+    )
+    Parser.add_argument(
+        '--thickness',
+        metavar='THICK',
+        type=float,
+        default=0.25,
+        help="Thickness of the centroid excerpt to consider. Given in ratio to the vertebra's absolute width (default: 0.25)",
+    )
+    Parser.add_argument(
+        '--max-angle',
+        metavar='ANGLE',
+        type=float,
+        default=45.0,
+        help="Maximum angle a face's normal can diverge from the general up direction to be considered part of the superior endplate. (default: 45)",
+    )
+    Parser.add_argument(
+        '--max-triangles',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Decimate every vertebra to at most N triangles before the analysis, see "benchmark.py decimation" for the accuracy. (default: 0, full resolution)',
+    )
+    Parser.add_argument(
+        '--max-error',
+        metavar='MM',
+        type=float,
+        default=0.0,
+        help='Decimate every vertebra as far as its surface moves by less than MM before the analysis. (default: 0, full resolution)',
+    )
+    Parser.add_argument(
+        '--proxy-triangles',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Estimate the orientation of every vertebra on N of its triangles and clip only the endplate slab at full resolution. (default: 0, full resolution throughout)',
+    )
+    Parser.add_argument(
+        '--io-threads',
+        metavar='N',
+        type=int,
+        default=2,
+        help='Number of threads loading STL files. (default: 2)',
+    )
+    Parser.add_argument(
+        '--prefetch',
+        metavar='N',
+        type=int,
+        default=2,
+        help='Maximum number of loaded spines waiting for analysis. (default: 2)',
+    )
+    Parser.add_argument(
+        '--smp-backend',
+        metavar='NAME',
+        type=str,
+        help='vtkSMPTools backend for multithreaded vtk filters. (default: $SLOPES_SMP_BACKEND or vtk default)',
+    )
+    Parser.add_argument(
+        '--threads',
+        metavar='N',
+        type=int,
+        help='Maximum number of threads per vtk filter. (default: $SLOPES_SMP_THREADS or all cores)',
+    )
+    Parser.add_argument(
+        '--volume-method',
+        choices=METHODS,
+        help='Surface extraction from label maps. (default: $SLOPES_VOLUME_METHOD or flying-edges)',
+    )
+    Parser.add_argument(
+        '--volume-smoothing',
+        metavar='N',
+        type=int,
+        help='Windowed sinc iterations per vertebra extracted from a label map, 0 for none. (default: $SLOPES_VOLUME_SMOOTHING or 20)',
+    )
+    Parser.add_argument(
+        '--volume-triangles',
+        metavar='N',
+        type=int,
+        help='Decimate every vertebra extracted from a label map to at most N triangles, 0 for no decimation. (default: $SLOPES_VOLUME_TRIANGLES or 0)',
+    )
+    Parser.add_argument(
+        '--journal',
+        metavar='FILE',
+        type=str,
+        help='SQLite file recording finished spines. A restarted run skips them. (default: no journal)',
+    )
+    Parser.add_argument(
+        '--max-attempts',
+        metavar='N',
+        type=int,
+        default=2,
+        help='Attempts per spine before a journaled run gives up on it, including crashed runs. (default: 2)',
+    )
+
+    Parser.add_argument(
+        '-j',
+        '--workers',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Analyse spines in N supervised worker processes. Implied as 1 by the options below. (default: 0, in this process)',
+    )
+    Parser.add_argument(
+        '--spine-timeout',
+        metavar='SECONDS',
+        type=float,
+        help='Kill a worker that spends longer on a single spine. (default: no limit)',
+    )
+    Parser.add_argument(
+        '--vertebra-timeout',
+        metavar='SECONDS',
+        type=float,
+        help='Kill a worker that spends longer on a single vertebra, or on loading a spine. (default: no limit)',
+    )
+    Parser.add_argument(
+        '--max-tasks-per-worker',
+        metavar='N',
+        type=int,
+        help='Replace a worker after N spines. (default: no limit)',
+    )
+    Parser.add_argument(
+        '--max-rss',
+        metavar='MIB',
+        type=float,
+        help='Replace a worker whose resident memory exceeds MIB after a spine. (default: no limit)',
+    )
+
+    Parser.add_argument(
+        '--largest-first',
+        action='store_true',
+        help='Hand out spines to workers largest first, as predicted from their triangle counts, and analyse oversized spines per vertebra. Implies --workers 1.',
+    )
+    Parser.add_argument(
+        '--cost-model',
+        metavar='FILE',
+        type=str,
+        help='Cost model calibrated by "benchmark.py calibrate" for --largest-first. (default: built-in coefficients)',
+    )
+    Parser.add_argument(
+        '--no-split',
+        action='store_true',
+        help='With --largest-first, never split a spine into per-vertebra tasks.',
+    )
+
+    Parser.add_argument(
+        '--store',
+        metavar='FILE',
+        type=str,
+        help='Also add all results to this SQLite results store, see results_store.py. (default: CSV files only)',
+    )
+    Parser.add_argument(
+        '--stats',
+        metavar='FILE',
+        type=str,
+        help='Count the angles in these cohort statistics, created or extended, see cohort_stats.py.',
+    )
+    Parser.add_argument(
+        '--export',
+        metavar='PATH',
+        type=str,
+        help='Also write axes, regressions, curves and angles of all analysed spines as columns: a .npz file, a .parquet file (requires pyarrow) or a directory of .npy files, see columnar.py. With --journal, every spine is also kept in PATH.parts, so that the export of a resumed run includes the spines of earlier runs.',
+    )
+
+    Arguments = Parser.parse_args()
+    Limited = Limits(
+        job_timeout=Arguments.spine_timeout,
+        step_timeout=Arguments.vertebra_timeout,
+        max_tasks=Arguments.max_tasks_per_worker,
+        max_rss=int(Arguments.max_rss * MIB) if Arguments.max_rss else None,
+    )
+    Planned = Arguments.largest_first or Arguments.cost_model is not None
+    Workers = max(Arguments.workers, 1) if Limited != Limits() or Planned else Arguments.workers
+    configure_smp(Arguments.smp_backend, Arguments.threads)
+    configure_extraction(Arguments.volume_method, Arguments.volume_smoothing, Arguments.volume_triangles)
+    Jobs = spine_jobs(Arguments.directories)
+    Journaled = Journal(Arguments.journal) if Arguments.journal else None
+    Stored = ResultsStore(Arguments.store) if Arguments.store else None
+    Analysis = Parameters(
+        tuple(Arguments.right),
+        Arguments.thickness,
+        Arguments.max_angle,
+        Arguments.max_triangles,
+        Arguments.max_error,
+        Arguments.proxy_triangles,
+    )
+    Stats = CohortStatistics.open(Arguments.stats, parameters_key(Analysis)) if Arguments.stats else None
+    Exported = None
+    if Arguments.export:
+        check_format(Arguments.export)
+        Exported = CohortColumns(f"{Arguments.export}.parts" if Journaled is not None else None)
+    try:
+        Pipeline = run_batch(
+            Jobs,
+            Analysis,
+            output=Arguments.output,
+            io_threads=Arguments.io_threads,
+            prefetch=Arguments.prefetch,
+            journal=Journaled,
+            policy=RetryPolicy(max_attempts=Arguments.max_attempts),
+            workers=Workers,
+            limits=Limited,
+            cost_model=(CostModel.load(Arguments.cost_model) if Arguments.cost_model else CostModel()) if Planned else None,
+            split=not Arguments.no_split,
+            store=Stored,
+            stats=Stats,
+            columns=Exported,
+            stats_file=Arguments.stats,
+        )
+        print(Pipeline.report(), file=sys.stderr)
+        if Journaled is not None:
+            print(f"journal: skipped {Journaled.skipped} spines, {Journaled.summary()}", file=sys.stderr)
+    finally:
+        if Journaled is not None:
+            Journaled.close()
+        if Stored is not None:
+            Stored.close()
+        if Stats is not None:
+            Stats.save(Arguments.stats)
+        if Exported is not None:
+            write_columns(Exported.columns(), Arguments.export)
@@ -1,12 +1,11 @@
+from __future__ import annotations
+
 from argparse import ArgumentParser, FileType
 from json import dumps
-from sys import exit
+from sys import exit, stderr
 
 from numpy import array, inf, ndarray, set_printoptions
 
-from morphology import Spine
-from vtk_convenience import load_stl
-
 def extract_axis(spine: Spine, index: int) -> ndarray:
     vertebra = spine[index]
     orientation = vertebra.orientation
@@ -28,7 +27,7 @@ if __name__ == '__main__':
         metavar='FILES',
         type=str,
         nargs='+',
-        help='Path to STL files, each containing a single vertebra. Minimum number of files is two.',
+        help='Path to STL files, each containing a single vertebra. Minimum number of files is two. A single labelled VTP/PLY surface, multi-solid STL file or NIfTI/NRRD label map holding all vertebrae is split per level.',
     )
     Parser.add_argument(
         '-r',
@@ -53,12 +52,86 @@ if __name__ == '__main__':
         default=45.0,
         help="Maximum angle a face's normal can diverge from the general up direction to be considered part of the superior endplate. (default: 45)",
     )
+    Parser.add_argument(
+        '--max-triangles',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Decimate every vertebra to at most N triangles before the analysis, see "benchmark.py decimation" for the accuracy. (default: 0, full resolution)',
+    )
+    Parser.add_argument(
+        '--max-error',
+        metavar='MM',
+        type=float,
+        default=0.0,
+        help='Decimate every vertebra as far as its surface moves by less than MM before the analysis. (default: 0, full resolution)',
+    )
+    Parser.add_argument(
+        '--proxy-triangles',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Estimate the orientation of every vertebra on N of its triangles and clip only the endplate slab at full resolution. (default: 0, full resolution throughout)',
+    )
+    Parser.add_argument(
+        '-j',
+        '--workers',
+        metavar='N',
+        type=int,
+        default=0,
+        help='Number of processes to analyse the vertebrae in parallel. (default: serial)',
+    )
+    Parser.add_argument(
+        '--smp-backend',
+        metavar='NAME',
+        type=str,
+        help='vtkSMPTools backend for multithreaded vtk filters, e.g. STDThread or TBB. (default: $SLOPES_SMP_BACKEND or vtk default)',
+    )
+    Parser.add_argument(
+        '--threads',
+        metavar='N',
+        type=int,
+        help='Maximum number of threads per vtk filter. (default: $SLOPES_SMP_THREADS or all cores)',
+    )
+    Parser.add_argument(
+        '--volume-method',
+        choices=('flying-edges', 'surface-nets'),
+        help='Surface extraction from a label map. (default: $SLOPES_VOLUME_METHOD or flying-edges)',
+    )
+    Parser.add_argument(
+        '--volume-smoothing',
+        metavar='N',
+        type=int,
+        help='Windowed sinc iterations per vertebra extracted from a label map, 0 for none. (default: $SLOPES_VOLUME_SMOOTHING or 20)',
+    )
+    Parser.add_argument(
+        '--volume-triangles',
+        metavar='N',
+        type=int,
+        help='Decimate every vertebra extracted from a label map to at most N triangles, 0 for no decimation. (default: $SLOPES_VOLUME_TRIANGLES or 0)',
+    )
+    Parser.add_argument(
+        '--lean',
+        action='store_true',
+        help='Drop every intermediate geometry right after its last use, which lowers peak and retained memory, and keep only the numeric results per vertebra.',
+    )
+    Parser.add_argument(
+        '--memory-report',
+        action='store_true',
+        help='Print peak and retained memory per vertebra to stderr.',
+    )
     Parser.add_argument(
         '-p',
         '--output-local-axes',
         action='store_true',
         help='Print all set of local axes for each individual vertebra',
     )
+    Parser.add_argument(
+        '--export',
+        metavar='PATH',
+        type=str,
+        help='Write axes, regressions, curves and angles as binary columns instead of text: a .npz file, a .parquet file (requires pyarrow) or a directory of .npy files.',
+    )
     Parser.add_argument(
         '-o',
         '--output-axis',
@@ -68,13 +141,46 @@ if __name__ == '__main__':
     )
 
     Arguments = Parser.parse_args()
+
+    # imported after parsing, so that --help does not wait for vtk
+    from morphology import Spine
+    from vtk_convenience import configure_smp, load_stl
+
+    if Arguments.export:
+        from columnar import CohortColumns, check_format, write_columns
+
+        check_format(Arguments.export)
+
+    configure_smp(Arguments.smp_backend, Arguments.threads)
+    if len(Arguments.filenames) == 1:
+        from label_volume import configure_extraction, expand_volumes
+        from labelled_surface import expand_surfaces
+
+        configure_extraction(Arguments.volume_method, Arguments.volume_smoothing, Arguments.volume_triangles)
+        Arguments.filenames = expand_volumes(expand_surfaces(Arguments.filenames))
     Vertebrae = [load_stl(file) for file in Arguments.filenames]
     SpineRepr = Spine(
         Vertebrae,
         lateral_axis=array(Arguments.right),
         slice_thickness=Arguments.thickness,
         max_angle=Arguments.max_angle,
+        lean=Arguments.lean,
+        memory_report=Arguments.memory_report,
+        workers=Arguments.workers,
+        max_triangles=Arguments.max_triangles,
+        max_error=Arguments.max_error,
+        proxy_triangles=Arguments.proxy_triangles,
     )
+    if Arguments.memory_report:
+        for file, vertebra in zip(Arguments.filenames, SpineRepr):
+            print(
+                f"{file}: peak {vertebra.memory.peak / 1024:.1f} KiB, retained {vertebra.memory.retained / 1024:.1f} KiB",
+                file=stderr,
+            )
+    if Arguments.export:
+        Columns = CohortColumns()
+        Columns.add_spine("", SpineRepr)
+        write_columns(Columns.columns(), Arguments.export)
     if not Arguments.output_axis is None:
         print(dumps(extract_axis(SpineRepr, Arguments.output_axis).tolist()))
         exit()
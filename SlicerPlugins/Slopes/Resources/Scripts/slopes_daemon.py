@@ -0,0 +1,427 @@
+"""
+Long-lived analysis daemon.
+
+Keeps interpreter, vtk and a pool of worker processes warm, so that other
+services can analyse spines without paying the start-up cost per spine.
+Jobs are JSON over HTTP, served on localhost or on a Unix domain socket.
+
+Endpoints:
+    POST /analyze  {"files": [...], "right": [1, 0, 0], "thickness": 0.25, "max_angle": 45}
+                   optionally "max_triangles" and "max_error" to decimate first,
+                   "proxy_triangles" to orient on a sample of the triangles
+                   -> {"angles": [...], "named_angles": {...}, "axes": [...], "seconds": ...}
+                   400 for unknown fields or values of the wrong type or sign
+    GET  /health   -> {"status": "ok", "uptime": ..., "workers": ..., "restarts": ...}
+                   503 with "status" "broken" or "recovering" after a worker died
+    GET  /metrics  -> job counters and timings
+
+Usage:
+    python slopes_daemon.py serve --socket /tmp/slopes.sock --workers 4
+    python slopes_daemon.py client --socket /tmp/slopes.sock L1.stl L2.stl L3.stl
+"""
+from __future__ import annotations
+
+import json
+import math
+import os
+import signal
+import socket
+import sys
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock
+from time import monotonic, perf_counter
+from typing import Callable, List, Optional, Tuple
+
+from slopes_batch import Parameters, SpineJob, analyse, load_job, warm_up
+from slopes_cli import extract_axes
+from vtk_convenience import mesh_exists
+
+
+def analyze_request(request: dict) -> dict:
+    """Run a single job as given by the JSON body of POST /analyze."""
+    start = perf_counter()
+    job = SpineJob(spine_id=request.get("id", ""), filenames=tuple(request["files"]))
+    parameters = Parameters(
+        right=tuple(request.get("right", Parameters.right)),
+        thickness=request.get("thickness", Parameters.thickness),
+        max_angle=request.get("max_angle", Parameters.max_angle),
+        max_triangles=request.get("max_triangles", Parameters.max_triangles),
+        max_error=request.get("max_error", Parameters.max_error),
+        proxy_triangles=request.get("proxy_triangles", Parameters.proxy_triangles),
+    )
+    spine = analyse(job, load_job(job), parameters)
+    return {
+        "id": job.spine_id,
+        "angles": spine.angles,
+        "named_angles": spine.named_angles,
+        "axes": extract_axes(spine).tolist(),
+        "parameters": asdict(parameters),
+        "seconds": perf_counter() - start,
+    }
+
+
+# numeric fields of POST /analyze: whether they must be integers, and whether zero is allowed
+NUMERIC_FIELDS = {
+    "thickness": (False, False),
+    "max_angle": (False, False),
+    "max_triangles": (True, True),
+    "max_error": (False, True),
+    "proxy_triangles": (True, True),
+}
+FIELDS = {"id", "files", "right", *NUMERIC_FIELDS}
+
+
+def is_number(value: object, integer: bool = False) -> bool:
+    """Whether a JSON value is a finite number, or an integer; booleans are neither."""
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+        return False
+    return math.isfinite(value)
+
+
+def validate(request: object) -> None:
+    """Raise ValueError for a request that POST /analyze cannot run, so that it is answered with 400."""
+    if not isinstance(request, dict):
+        raise ValueError("request must be a JSON object")
+    unknown = sorted(set(request) - FIELDS)
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    files = request.get("files")
+    if not isinstance(files, list) or len(files) < 2 or not all(isinstance(f, str) for f in files):
+        raise ValueError("'files' must list at least two STL files or members, e.g. \"spine.spz#L1\"")
+    if not isinstance(request.get("id", ""), str):
+        raise ValueError("'id' must be a string")
+    right = request.get("right", [1, 0, 0])
+    if not isinstance(right, list) or len(right) != 3 or not all(is_number(c) for c in right):
+        raise ValueError("'right' must have three numeric components")
+    if not any(right):
+        raise ValueError("'right' must not be zero")
+    for name, (integer, zero) in NUMERIC_FIELDS.items():
+        if name not in request:
+            continue
+        value = request[name]
+        if not is_number(value, integer):
+            raise ValueError(f"'{name}' must be {'an integer' if integer else 'a number'}")
+        if value < 0 or (value == 0 and not zero):
+            raise ValueError(f"'{name}' must be {'zero or ' if zero else ''}positive")
+    missing = [f for f in files if not mesh_exists(f)]
+    if missing:
+        raise ValueError(f"files not found: {', '.join(missing)}")
+
+
+class Metrics:
+    """Thread-safe job counters of a running daemon."""
+
+    def __init__(self) -> None:
+        self.started = monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+        self.max_seconds = 0.0
+        self._lock = Lock()
+
+    def begin(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self, seconds: float, failed: bool) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if failed:
+                self.failed += 1
+                return
+            self.completed += 1
+            self.busy_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def reject(self) -> None:
+        with self._lock:
+            self.rejected += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "uptime": monotonic() - self.started,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "in_flight": self.in_flight,
+                "mean_seconds": self.busy_seconds / self.completed if self.completed else 0.0,
+                "max_seconds": self.max_seconds,
+            }
+
+
+class AnalysisPool:
+    """
+    Warm pool of analysis processes that replaces itself once a worker
+    died, e.g. killed by the OOM killer, instead of failing every later
+    job with BrokenProcessPool.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.restarts = 0
+        self.status = "starting"
+        self._lock = Lock()
+        self._executor = self._start()
+        self.status = "ok"
+
+    def _start(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+        # start all workers now, not with the first job
+        for future in [executor.submit(warm_up) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def _replace(self, broken: ProcessPoolExecutor) -> None:
+        """Replace "broken" unless another thread did so already."""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self.status = "recovering"
+            broken.shutdown(wait=False, cancel_futures=True)
+            try:
+                self._executor = self._start()
+            except Exception:
+                self.status = "broken"
+                raise
+            self.restarts += 1
+            self.status = "ok"
+
+    def run(self, function: Callable, *arguments):
+        """
+        Run "function" in a worker and return its result. If the pool
+        breaks meanwhile, it is replaced and the job retried once; a job
+        that breaks the fresh pool too fails alone.
+        """
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                return executor.submit(function, *arguments).result()
+            except BrokenProcessPool:
+                self._replace(executor)
+                if attempt:
+                    raise
+
+    def health(self) -> str:
+        """"ok", "recovering", or "broken" if a worker died and no job has replaced the pool yet."""
+        # ProcessPoolExecutor marks itself broken once it notices a dead worker
+        if self.status == "ok" and getattr(self._executor, "_broken", False):
+            return "broken"
+        return self.status
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    server_version = "SlopesDaemon/1.0"
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            status = self.server.pool.health()
+            self.respond(200 if status == "ok" else 503, {
+                "status": status,
+                "uptime": self.server.metrics.as_dict()["uptime"],
+                "workers": self.server.workers,
+                "restarts": self.server.pool.restarts,
+                **({} if status == "ok" else {"error": f"worker pool {status}"}),
+            })
+        elif self.path == "/metrics":
+            self.respond(200, self.server.metrics.as_dict())
+        else:
+            self.respond(404, {"error": f"unknown endpoint {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.path != "/analyze":
+            self.respond(404, {"error": f"unknown endpoint {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            validate(request)
+        except (ValueError, TypeError) as error:
+            self.server.metrics.reject()
+            self.respond(400, {"error": str(error)})
+            return
+
+        metrics = self.server.metrics
+        metrics.begin()
+        start = perf_counter()
+        try:
+            result = self.server.pool.run(analyze_request, request)
+        except Exception as error:
+            metrics.end(perf_counter() - start, failed=True)
+            self.respond(500, {"error": repr(error)})
+            return
+        metrics.end(perf_counter() - start, failed=False)
+        self.respond(200, result)
+
+    def respond(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        # Unix domain sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format: str, *args) -> None:
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self) -> Tuple[socket.socket, str]:
+        request, _ = super().get_request()
+        return request, ""
+
+
+def make_server(
+    workers: int, port: Optional[int] = None, unix_socket: Optional[str] = None, quiet: bool = False
+):
+    """
+    Return an HTTP server on localhost:"port" or on "unix_socket", with a
+    warm AnalysisPool of "workers" processes as attribute "pool".
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, AnalysisHandler)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", port or 0), AnalysisHandler)
+        server.daemon_threads = True
+
+    server.pool = AnalysisPool(workers)
+    server.workers = workers
+    server.metrics = Metrics()
+    server.quiet = quiet
+    return server
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path: str, timeout: Optional[float] = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class DaemonClient:
+    """
+    Minimal client of a running daemon, e.g. for tests and scripts.
+
+    Usage:
+        client = DaemonClient(unix_socket="/tmp/slopes.sock")
+        client.analyze(["L1.stl", "L2.stl"], max_angle=40.0)["angles"]
+    """
+
+    def __init__(
+        self, port: Optional[int] = None, unix_socket: Optional[str] = None, timeout: Optional[float] = None
+    ) -> None:
+        self.port = port
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+
+    def _connect(self) -> HTTPConnection:
+        if self.unix_socket:
+            return UnixHTTPConnection(self.unix_socket, timeout=self.timeout)
+        return HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body: Optional[dict] = None) -> dict:
+        """Send a request and return the decoded answer. Raises RuntimeError on errors."""
+        connection = self._connect()
+        try:
+            payload = json.dumps(body).encode() if body is not None else None
+            headers = {"Content-Type": "application/json"} if payload else {}
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            answer = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f"{response.status}: {answer.get('error')}")
+        return answer
+
+    def analyze(self, files: List[str], **parameters) -> dict:
+        return self.request("POST", "/analyze", {"files": [os.path.abspath(f) for f in files], **parameters})
+
+    def health(self) -> dict:
+        return self.request("GET", "/health")
+
+    def metrics(self) -> dict:
+        return self.request("GET", "/metrics")
+
+
+if __name__ == '__main__':
+    Parser = ArgumentParser(
+        prog='Slopes daemon',
+        description='Serve spine analyses over HTTP on localhost or a Unix domain socket.',
+    )
+    Commands = Parser.add_subparsers(dest='command', required=True)
+    for Name, Help in (('serve', 'Run the daemon.'), ('client', 'Send a single job to a running daemon.')):
+        Command = Commands.add_parser(Name, help=Help)
+        Address = Command.add_mutually_exclusive_group(required=True)
+        Address.add_argument('--port', metavar='PORT', type=int, help='Port on 127.0.0.1.')
+        Address.add_argument('--socket', metavar='PATH', type=str, help='Path of a Unix domain socket.')
+
+    Serve = Commands.choices['serve']
+    Serve.add_argument(
+        '-j',
+        '--workers',
+        metavar='N',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of analysis processes. (default: all cores)',
+    )
+    Serve.add_argument('-q', '--quiet', action='store_true', help='Do not log requests.')
+
+    Client = Commands.choices['client']
+    Client.add_argument('filenames', metavar='FILES', type=str, nargs='*', help='Vertebra STL files of one spine.')
+    Client.add_argument('--health', action='store_true', help='Query /health instead of analysing.')
+    Client.add_argument('--metrics', action='store_true', help='Query /metrics instead of analysing.')
+    Client.add_argument('--max-angle', metavar='ANGLE', type=float, default=45.0, help='(default: 45)')
+    Client.add_argument('--thickness', metavar='THICK', type=float, default=0.25, help='(default: 0.25)')
+
+    Arguments = Parser.parse_args()
+    if Arguments.command == 'serve':
+        Server = make_server(Arguments.workers, port=Arguments.port, unix_socket=Arguments.socket, quiet=Arguments.quiet)
+        print(f"serving on {Arguments.socket or Server.server_address}", file=sys.stderr)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        try:
+            Server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            Server.server_close()
+            Server.pool.shutdown()
+            if Arguments.socket:
+                os.unlink(Arguments.socket)
+        sys.exit()
+
+    Connection = DaemonClient(port=Arguments.port, unix_socket=Arguments.socket)
+    if Arguments.health:
+        print(json.dumps(Connection.health()))
+    elif Arguments.metrics:
+        print(json.dumps(Connection.metrics()))
+    else:
+        print(json.dumps(Connection.analyze(
+            Arguments.filenames, max_angle=Arguments.max_angle, thickness=Arguments.thickness
+        )))
@@ -0,0 +1,370 @@
+"""
+Distributed batch analysis through a shared directory.
+
+Nodes sharing a (network) file system run cohorts without a job broker.
+All coordination is done by renaming files, which is atomic within one
+file system, so exactly one worker wins each claim:
+
+    <queue>/queue.json                      output directory and parameters
+    <queue>/pending/<spine>~<attempt>.json  jobs waiting for a worker
+    <queue>/running/<spine>~<attempt>@<worker>.json
+    <queue>/running/<spine>~<attempt>@<worker>.closing  while its result is recorded
+    <queue>/heartbeats/<worker>             touched while the worker lives
+    <queue>/done/<spine>.json               output file, its hash and timing
+    <queue>/failed/<spine>.json             error of the last attempt
+    <queue>/stats/<worker>.npz              angle statistics of the worker's spines
+
+A worker whose heartbeat is older than "--stale-after" seconds is
+considered dead; any other worker moves its running jobs back to pending,
+counting the attempt. Jobs that exceed "--max-attempts" end up in failed.
+Heartbeats use file modification times, so node clocks must agree to well
+within "--stale-after". A worker that missed its heartbeats, e.g. in a
+long VTK call, may find its job reclaimed when done; it then drops its
+result and leaves the job to the new claim.
+
+Scaling out means starting "work" on another node; "--processes" starts
+several workers on one machine. The statistics of all workers are merged
+by "python cohort_stats.py merge <queue>/stats/*.npz -o cohort.npz".
+
+Usage:
+    python slopes_queue.py submit /shared/queue cohort/* -o /shared/results
+    python slopes_queue.py work /shared/queue --processes 8
+    python slopes_queue.py status /shared/queue
+"""
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from threading import Event, Thread
+from time import perf_counter, sleep, time
+from typing import Dict, Iterable, Optional, Tuple
+
+from batch_journal import parameters_key
+from cohort_stats import CohortStatistics
+from slopes_batch import Parameters, SpineJob, process_job, spine_jobs
+
+STATES = ("pending", "running", "done", "failed")
+
+
+@dataclass(frozen=True)
+class Claim:
+    """A job taken from pending by this worker, as file running/<name>."""
+    job: SpineJob
+    attempt: int
+    path: str
+
+
+def write_json(filename: str, data: dict) -> None:
+    """Write "data" to a temporary file first and rename it into place."""
+    temporary = f"{filename}.{socket.gethostname()}-{os.getpid()}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(data, file)
+    os.replace(temporary, filename)
+
+
+def read_json(filename: str) -> dict:
+    with open(filename) as file:
+        return json.load(file)
+
+
+class WorkQueue:
+    """The directory layout of a queue and its atomic transitions."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def path(self, *parts: str) -> str:
+        return os.path.join(self.directory, *parts)
+
+    def create(self, output: str, parameters: Parameters) -> None:
+        for name in STATES + ("heartbeats", "stats"):
+            os.makedirs(self.path(name), exist_ok=True)
+        write_json(self.path("queue.json"), {"output": os.path.abspath(output), "parameters": asdict(parameters)})
+
+    def settings(self) -> Tuple[str, Parameters]:
+        settings = read_json(self.path("queue.json"))
+        parameters = settings["parameters"]
+        parameters["right"] = tuple(parameters["right"])
+        return settings["output"], Parameters(**parameters)
+
+    def submit(self, jobs: Iterable[SpineJob]) -> int:
+        """Add jobs not known to the queue yet. Return their number."""
+        known = {self.parse(name)[0] for state in STATES for name in os.listdir(self.path(state))}
+        count = 0
+        for job in jobs:
+            if job.spine_id in known:
+                continue
+            write_json(self.path("pending", f"{job.spine_id}~1.json"), {
+                "spine_id": job.spine_id,
+                "filenames": [os.path.abspath(f) for f in job.filenames],
+            })
+            count += 1
+        return count
+
+    @staticmethod
+    def parse(name: str) -> Tuple[str, int, Optional[str]]:
+        """Split a file name into spine id, attempt and worker."""
+        stem = os.path.splitext(name)[0]
+        worker = None
+        if "@" in stem:
+            stem, worker = stem.rsplit("@", 1)
+        if "~" not in stem:
+            return stem, 0, worker
+        spine_id, attempt = stem.rsplit("~", 1)
+        return spine_id, int(attempt), worker
+
+    def claim(self, worker: str) -> Optional[Claim]:
+        """Move a pending job to running for "worker"; None if there is none left."""
+        names = [n for n in os.listdir(self.path("pending")) if n.endswith(".json")]
+        # random order, so that concurrent workers rarely compete for the same file
+        random.shuffle(names)
+        for name in names:
+            spine_id, attempt, _ = self.parse(name)
+            running = self.path("running", f"{spine_id}~{attempt}@{worker}.json")
+            try:
+                os.rename(self.path("pending", name), running)
+            except FileNotFoundError:
+                continue
+            if os.path.exists(self.path("done", f"{spine_id}.json")):
+                os.remove(running)
+                continue
+            data = read_json(running)
+            return Claim(SpineJob(data["spine_id"], tuple(data["filenames"])), attempt, running)
+        return None
+
+    def _close(self, claim: Claim) -> Optional[str]:
+        """
+        Take "claim" out of reach of reclaim by renaming it to .closing;
+        None if it was reclaimed already.
+        """
+        closing = f"{os.path.splitext(claim.path)[0]}.closing"
+        try:
+            os.rename(claim.path, closing)
+        except FileNotFoundError:
+            return None
+        return closing
+
+    def finish(self, claim: Claim, worker: str, record: dict) -> bool:
+        """Record the job as done; False, recording nothing, if the claim was lost to reclaim."""
+        closing = self._close(claim)
+        if closing is None:
+            return False
+        write_json(self.path("done", f"{claim.job.spine_id}.json"), dict(record, worker=worker, attempt=claim.attempt))
+        os.remove(closing)
+        return True
+
+    def fail(self, claim: Claim, worker: str, error: str) -> bool:
+        """Record the job as failed; False, recording nothing, if the claim was lost to reclaim."""
+        closing = self._close(claim)
+        if closing is None:
+            return False
+        write_json(self.path("failed", f"{claim.job.spine_id}.json"), {"error": error, "worker": worker, "attempt": claim.attempt})
+        os.remove(closing)
+        return True
+
+    def heartbeat(self, worker: str) -> None:
+        beat = self.path("heartbeats", worker)
+        with open(beat, "a"):
+            pass
+        os.utime(beat)
+
+    def reclaim(self, stale_after: float, max_attempts: int) -> int:
+        """
+        Move the running jobs of workers without a recent heartbeat back to
+        pending, or to failed once they used up their attempts. Return the
+        number of jobs moved.
+        """
+        now = time()
+        moved = 0
+        for name in os.listdir(self.path("running")):
+            if not name.endswith((".json", ".closing")):
+                continue
+            spine_id, attempt, worker = self.parse(name)
+            try:
+                alive = now - os.path.getmtime(self.path("heartbeats", worker)) < stale_after
+            except FileNotFoundError:
+                alive = False
+            if alive:
+                continue
+
+            source = self.path("running", name)
+            if attempt >= max_attempts:
+                target = self.path("failed", f"{spine_id}.json")
+            else:
+                target = self.path("pending", f"{spine_id}~{attempt + 1}.json")
+            try:
+                os.rename(source, target)
+            except FileNotFoundError:
+                continue
+            if attempt >= max_attempts:
+                write_json(target, {"error": f"worker {worker} died, attempts used up", "worker": worker, "attempt": attempt})
+            moved += 1
+        return moved
+
+    def status(self) -> Dict[str, int]:
+        return {
+            state: len([n for n in os.listdir(self.path(state)) if n.endswith(".json")])
+            for state in STATES
+        }
+
+
+class QueueWorker:
+    """
+    Claims and analyses jobs until the queue is drained, while a background
+    thread keeps its heartbeat fresh.
+    """
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        heartbeat: float = 10.0,
+        stale_after: float = 60.0,
+        max_attempts: int = 2,
+        wait: bool = False,
+    ) -> None:
+        self.queue = queue
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.wait = wait
+        self.done = 0
+        self.failed = 0
+        self.stats: Optional[CohortStatistics] = None
+
+    def _beat(self, stop: Event) -> None:
+        while not stop.wait(self.heartbeat):
+            self.queue.heartbeat(self.name)
+
+    def run(self) -> None:
+        output, parameters = self.queue.settings()
+        self.stats = CohortStatistics(parameters_key(parameters))
+        self.queue.heartbeat(self.name)
+        stop = Event()
+        beating = Thread(target=self._beat, args=(stop,), daemon=True)
+        beating.start()
+        try:
+            while True:
+                self.queue.reclaim(self.stale_after, self.max_attempts)
+                claim = self.queue.claim(self.name)
+                if claim is None:
+                    if self.wait or self.queue.status()["running"]:
+                        # others may still die and leave work behind
+                        sleep(self.heartbeat)
+                        continue
+                    return
+                self._process(claim, output, parameters)
+        finally:
+            stop.set()
+            beating.join()
+            os.remove(self.queue.path("heartbeats", self.name))
+
+    def _process(self, claim: Claim, output: str, parameters: Parameters) -> None:
+        start = perf_counter()
+        try:
+            written = process_job(claim.job, lambda _: None, parameters, output)
+        except Exception as error:
+            print(f"{claim.job.spine_id}: failed, {error!r}", file=sys.stderr)
+            if self.queue.fail(claim, self.name, repr(error)):
+                self.failed += 1
+            else:
+                print(f"{claim.job.spine_id}: claim lost to reclaim, error dropped", file=sys.stderr)
+            return
+        finished = self.queue.finish(claim, self.name, {
+            "output": os.path.join(output, f"{claim.job.spine_id}.csv"),
+            "sha256": written.digest,
+            "seconds": perf_counter() - start,
+        })
+        if not finished:
+            print(f"{claim.job.spine_id}: claim lost to reclaim, result dropped", file=sys.stderr)
+            return
+        self.stats.add_result(claim.job.spine_id, written.result, written.angles)
+        os.makedirs(self.queue.path("stats"), exist_ok=True)
+        self.stats.save(self.queue.path("stats", f"{self.name}.npz"))
+        self.done += 1
+
+
+def work(directory: str, **options) -> None:
+    """Entry point of one worker process."""
+    worker = QueueWorker(WorkQueue(directory), **options)
+    worker.run()
+    print(f"{worker.name}: {worker.done} done, {worker.failed} failed", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    Parser = ArgumentParser(
+        prog='Slopes queue',
+        description='Distribute a cohort analysis over several processes or nodes through a shared directory.',
+    )
+    Commands = Parser.add_subparsers(dest='command', required=True)
+
+    Submit = Commands.add_parser('submit', help='Create a queue, or add spines to it.')
+    Submit.add_argument('queue', metavar='QUEUE', type=str, help='Shared queue directory.')
+    Submit.add_argument('directories', metavar='DIRS', type=str, nargs='+', help='One directory of STL files or mesh archive per spine, or mesh packs.')
+    Submit.add_argument('-o', '--output', metavar='DIR', type=str, required=True, help='Shared directory for the CSV files.')
+    Submit.add_argument('-r', '--right', metavar='FLOAT', type=float, nargs=3, default=[1.0, 0.0, 0.0], help='(default: 1 0 0)')
+    Submit.add_argument('--thickness', metavar='THICK', type=float, default=0.25, help='(default: 0.25)')
+    Submit.add_argument('--max-angle', metavar='ANGLE', type=float, default=45.0, help='(default: 45)')
+    Submit.add_argument('--max-triangles', metavar='N', type=int, default=0, help='Decimate every vertebra to at most N triangles. (default: 0, full resolution)')
+    Submit.add_argument('--max-error', metavar='MM', type=float, default=0.0, help='Decimate every vertebra within MM of its surface. (default: 0, full resolution)')
+    Submit.add_argument('--proxy-triangles', metavar='N', type=int, default=0, help='Orient every vertebra on N of its triangles. (default: 0, full resolution)')
+
+    Work = Commands.add_parser('work', help='Process jobs until the queue is drained.')
+    Work.add_argument('queue', metavar='QUEUE', type=str, help='Shared queue directory.')
+    Work.add_argument('--processes', metavar='N', type=int, default=1, help='Worker processes on this node. (default: 1)')
+    Work.add_argument('--heartbeat', metavar='SECONDS', type=float, default=10.0, help='Heartbeat interval. (default: 10)')
+    Work.add_argument(
+        '--stale-after',
+        metavar='SECONDS',
+        type=float,
+        default=60.0,
+        help='Age of a heartbeat after which its worker counts as dead. (default: 60)',
+    )
+    Work.add_argument('--max-attempts', metavar='N', type=int, default=2, help='Attempts per spine after dead workers. (default: 2)')
+    Work.add_argument('--wait', action='store_true', help='Keep polling for new jobs instead of exiting.')
+
+    Status = Commands.add_parser('status', help='Print the number of jobs per state.')
+    Status.add_argument('queue', metavar='QUEUE', type=str, help='Shared queue directory.')
+
+    Arguments = Parser.parse_args()
+    Queue = WorkQueue(Arguments.queue)
+    if Arguments.command == 'submit':
+        if not os.path.exists(Queue.path("queue.json")):
+            Queue.create(
+                Arguments.output,
+                Parameters(
+                    tuple(Arguments.right),
+                    Arguments.thickness,
+                    Arguments.max_angle,
+                    Arguments.max_triangles,
+                    Arguments.max_error,
+                    Arguments.proxy_triangles,
+                ),
+            )
+        os.makedirs(Arguments.output, exist_ok=True)
+        Count = Queue.submit(spine_jobs(Arguments.directories))
+        print(f"submitted {Count} spines", file=sys.stderr)
+    elif Arguments.command == 'work':
+        Options = dict(
+            heartbeat=Arguments.heartbeat,
+            stale_after=Arguments.stale_after,
+            max_attempts=Arguments.max_attempts,
+            wait=Arguments.wait,
+        )
+        Processes = [
+            multiprocessing.Process(target=work, args=(Arguments.queue,), kwargs=Options)
+            for _ in range(Arguments.processes)
+        ]
+        for Process in Processes:
+            Process.start()
+        for Process in Processes:
+            Process.join()
+    else:
+        print(json.dumps(Queue.status()))
@@ -0,0 +1,258 @@
+"""
+Compact struct-of-arrays representation of analysed spines.
+
+A SpineResult keeps the numeric outcome of one or many Spine objects
+in a handful of contiguous numpy buffers. It holds no vtk objects, so it
+pickles cheaply between processes, and results of whole cohorts are
+joined with SpineResult.concatenate.
+
+Usage:
+    spine = Spine(geometries, lateral_axis=..., slice_thickness=0.25, max_angle=45.0)
+    spine.name_vertebrae(offset_to_c1=Spine.offset_from_filename(filenames[0]))
+    result = SpineResult.from_spine(spine, spine_id="patient_042")
+
+    cohort = SpineResult.concatenate([result, other_result])
+    cohort[3].up  # up-vector of the fourth vertebra in the cohort
+"""
+from __future__ import annotations
+
+import numpy as np
+
+from typing import Iterator, Optional, Sequence
+
+from morphology import Endplate, Spine
+
+
+class VertebraRecord:
+    """
+    Read-only view onto a single vertebra of a SpineResult.
+    Holds no data itself, only a reference to the result and an index.
+    """
+
+    __slots__ = ("_result", "_index")
+
+    def __init__(self, result: SpineResult, index: int) -> None:
+        self._result = result
+        self._index = index
+
+    @property
+    def level(self) -> str:
+        return str(self._result.levels[self._index])
+
+    @property
+    def spine_id(self) -> str:
+        return str(self._result.spine_ids[self._result.spine_index[self._index]])
+
+    @property
+    def frame(self) -> np.ndarray:
+        """Local axes as rows right, front and up."""
+        return self._result.frames[self._index]
+
+    @property
+    def right(self) -> np.ndarray:
+        return self.frame[SpineResult.RIGHT]
+
+    @property
+    def left(self) -> np.ndarray:
+        return -self.right
+
+    @property
+    def front(self) -> np.ndarray:
+        return self.frame[SpineResult.FRONT]
+
+    @property
+    def back(self) -> np.ndarray:
+        return -self.front
+
+    @property
+    def up(self) -> np.ndarray:
+        return self.frame[SpineResult.UP]
+
+    @property
+    def down(self) -> np.ndarray:
+        return -self.up
+
+    @property
+    def center(self) -> np.ndarray:
+        return self._result.centers[self._index]
+
+    @property
+    def regressions(self) -> np.ndarray:
+        """Endplate regressions, indexed by Endplate."""
+        return self._result.regressions[self._index]
+
+    @property
+    def width(self) -> float:
+        return float(self._result.widths[self._index])
+
+    @property
+    def height(self) -> float:
+        return float(self._result.heights[self._index])
+
+    def __repr__(self) -> str:
+        return f"VertebraRecord(spine_id={self.spine_id!r}, level={self.level!r})"
+
+
+class SpineResult:
+    """
+    Numeric results of N vertebrae from S spines in contiguous arrays.
+
+    Attributes:
+        levels -- (N,) vertebra names, empty if unknown
+        frames -- (N, 3, 3) local axes, rows indexed by RIGHT, FRONT and UP
+        centers -- (N, 3) centers of mass
+        regressions -- (N, 2, 3) endplate regressions, indexed by Endplate
+        widths -- (N,) lateral extent of the vertebra's oriented bounding box
+        heights -- (N,) distance of the endplate centers, NaN if not measured
+        spine_index -- (N,) index into spine_ids for each vertebra
+        spine_ids -- (S,) identifiers of the spines
+    """
+
+    RIGHT, FRONT, UP = range(3)
+
+    __slots__ = (
+        "levels",
+        "frames",
+        "centers",
+        "regressions",
+        "widths",
+        "heights",
+        "spine_index",
+        "spine_ids",
+    )
+
+    def __init__(
+        self,
+        levels: np.ndarray,
+        frames: np.ndarray,
+        centers: np.ndarray,
+        regressions: np.ndarray,
+        widths: np.ndarray,
+        heights: np.ndarray,
+        spine_index: np.ndarray,
+        spine_ids: np.ndarray,
+    ) -> None:
+        self.levels = np.ascontiguousarray(levels, dtype=str)
+        self.frames = np.ascontiguousarray(frames, dtype=float).reshape(-1, 3, 3)
+        self.centers = np.ascontiguousarray(centers, dtype=float).reshape(-1, 3)
+        self.regressions = np.ascontiguousarray(regressions, dtype=float).reshape(-1, 2, 3)
+        self.widths = np.ascontiguousarray(widths, dtype=float)
+        self.heights = np.ascontiguousarray(heights, dtype=float)
+        self.spine_index = np.ascontiguousarray(spine_index, dtype=np.int32)
+        self.spine_ids = np.ascontiguousarray(spine_ids, dtype=str)
+
+    @classmethod
+    def from_spine(
+        cls, spine: Spine, spine_id: str = "", levels: Optional[Sequence[str]] = None
+    ) -> SpineResult:
+        """
+        Collect the numeric results of an analysed Spine.
+
+        Keyword Arguments:
+        spine - analysed spine, lean or not
+        spine_id - identifier stored alongside the vertebrae
+        levels - vertebra names; if omitted, the names assigned by
+        Spine.name_vertebrae are used
+        """
+        if levels is None:
+            levels = cls._assigned_levels(spine)
+
+        orientations = [v.orientation for v in spine]
+        heights = [
+            np.linalg.norm(np.subtract(v.center[Endplate.UPPER], v.center[Endplate.LOWER]))
+            if hasattr(v, "center")
+            else np.nan
+            for v in spine
+        ]
+
+        return cls(
+            levels=np.array(levels, dtype=str).reshape(len(spine)),
+            frames=np.array([[o.right, o.front, o.up] for o in orientations]),
+            centers=np.array([o.center for o in orientations]),
+            regressions=np.array([
+                [v.body.regressions[e] for e in Endplate.options()] for v in spine
+            ]),
+            widths=np.array([o.width for o in orientations]),
+            heights=np.array(heights),
+            spine_index=np.zeros(len(spine)),
+            spine_ids=np.array([spine_id]),
+        )
+
+    @staticmethod
+    def _assigned_levels(spine: Spine) -> list:
+        names = {
+            id(getattr(spine, name)): name
+            for name in Spine.VERTEBRAE
+            if hasattr(spine, name)
+        }
+        return [names.get(id(vertebra), "") for vertebra in spine]
+
+    @classmethod
+    def concatenate(cls, results: Sequence[SpineResult]) -> SpineResult:
+        """Join many results into one, renumbering spine_index accordingly."""
+        if not results:
+            return cls.empty()
+
+        spine_offsets = np.cumsum([0] + [len(r.spine_ids) for r in results[:-1]])
+        return cls(
+            levels=np.concatenate([r.levels for r in results]),
+            frames=np.concatenate([r.frames for r in results]),
+            centers=np.concatenate([r.centers for r in results]),
+            regressions=np.concatenate([r.regressions for r in results]),
+            widths=np.concatenate([r.widths for r in results]),
+            heights=np.concatenate([r.heights for r in results]),
+            spine_index=np.concatenate([
+                r.spine_index + offset for r, offset in zip(results, spine_offsets)
+            ]),
+            spine_ids=np.concatenate([r.spine_ids for r in results]),
+        )
+
+    @classmethod
+    def empty(cls) -> SpineResult:
+        return cls(
+            levels=np.zeros(0, dtype=str),
+            frames=np.zeros((0, 3, 3)),
+            centers=np.zeros((0, 3)),
+            regressions=np.zeros((0, 2, 3)),
+            widths=np.zeros(0),
+            heights=np.zeros(0),
+            spine_index=np.zeros(0),
+            spine_ids=np.zeros(0, dtype=str),
+        )
+
+    def spine(self, index: int) -> SpineResult:
+        """Return the vertebrae of a single spine as their own SpineResult."""
+        mask = self.spine_index == index
+        return SpineResult(
+            levels=self.levels[mask],
+            frames=self.frames[mask],
+            centers=self.centers[mask],
+            regressions=self.regressions[mask],
+            widths=self.widths[mask],
+            heights=self.heights[mask],
+            spine_index=np.zeros(mask.sum()),
+            spine_ids=self.spine_ids[index : index + 1],
+        )
+
+    def __getstate__(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state: dict) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __getitem__(self, index: int) -> VertebraRecord:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("vertebra index out of range")
+        return VertebraRecord(self, index)
+
+    def __iter__(self) -> Iterator[VertebraRecord]:
+        return (VertebraRecord(self, i) for i in range(len(self)))
+
+    def __len__(self) -> int:
+        return len(self.levels)
+
+    def __repr__(self) -> str:
+        return f"SpineResult(spines={len(self.spine_ids)}, vertebrae={len(self)})"
@@ -0,0 +1,104 @@
+"""
+Shared fixtures: a synthetic spine of seven vertebrae, each a cylinder
+for the body and a box for the processes, tilted a little more per level.
+"""
+import math
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LEVELS = ("T11", "T12", "L1", "L2", "L3", "L4", "L5")
+PARAMETERS = dict(lateral_axis=np.array([1.0, 0.0, 0.0]), slice_thickness=0.25, max_angle=45.0)
+
+
+def vertebra_geometry(index: int, subdivisions: int = 1):
+    # pylint: disable=import-outside-toplevel
+    from vtkmodules.vtkCommonTransforms import vtkTransform
+    from vtkmodules.vtkFiltersCore import vtkAppendPolyData, vtkTriangleFilter
+    from vtkmodules.vtkFiltersGeneral import vtkTransformFilter
+    from vtkmodules.vtkFiltersModeling import vtkLinearSubdivisionFilter
+    from vtkmodules.vtkFiltersSources import vtkCubeSource, vtkCylinderSource
+
+    body = vtkCylinderSource()
+    body.SetRadius(20)
+    body.SetHeight(25)
+    body.SetResolution(64)
+    processes = vtkCubeSource()
+    processes.SetXLength(10)
+    processes.SetYLength(10)
+    processes.SetZLength(30)
+    processes.SetCenter(0, 0, -30)
+    append = vtkAppendPolyData()
+    append.AddInputConnection(body.GetOutputPort())
+    append.AddInputConnection(processes.GetOutputPort())
+    triangles = vtkTriangleFilter()
+    triangles.SetInputConnection(append.GetOutputPort())
+    subdivide = vtkLinearSubdivisionFilter()
+    subdivide.SetNumberOfSubdivisions(subdivisions)
+    subdivide.SetInputConnection(triangles.GetOutputPort())
+    # the spine runs along y, front is +z and right +x
+    transform = vtkTransform()
+    transform.Translate(0, -35 * index, 5 * math.sin(index / 2.0))
+    transform.RotateX(4 * index - 10)
+    transformed = vtkTransformFilter()
+    transformed.SetTransform(transform)
+    transformed.SetInputConnection(subdivide.GetOutputPort())
+    transformed.Update()
+    return transformed.GetOutput()
+
+
+def write_spine(directory: str, levels=LEVELS, subdivisions: int = 1) -> str:
+    from vtkmodules.vtkIOGeometry import vtkSTLWriter  # pylint: disable=import-outside-toplevel
+
+    os.makedirs(directory, exist_ok=True)
+    for index, level in enumerate(levels):
+        writer = vtkSTLWriter()
+        writer.SetFileName(os.path.join(directory, f"{level}.stl"))
+        writer.SetInputData(vertebra_geometry(index, subdivisions))
+        writer.SetFileTypeToBinary()
+        writer.Write()
+    return directory
+
+
+def read_outputs(directory: str) -> dict:
+    """Content of every file in "directory" by name."""
+    outputs = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as file:
+            outputs[name] = file.read()
+    return outputs
+
+
+@pytest.fixture(scope="session")
+def cohort(tmp_path_factory):
+    """Three spine directories; s1 is large enough to be split per vertebra among two workers."""
+    root = tmp_path_factory.mktemp("cohort")
+    return [
+        write_spine(str(root / "s1"), subdivisions=3),
+        write_spine(str(root / "s2"), LEVELS[:4]),
+        write_spine(str(root / "s3"), LEVELS[2:]),
+    ]
+
+
+@pytest.fixture(scope="session")
+def spine_directory(tmp_path_factory) -> str:
+    return write_spine(str(tmp_path_factory.mktemp("spine") / "s1"))
+
+
+@pytest.fixture(scope="session")
+def spine_files(spine_directory):
+    return [os.path.join(spine_directory, f"{level}.stl") for level in LEVELS]
+
+
+@pytest.fixture(scope="session")
+def spine(spine_files):
+    from morphology import Spine  # pylint: disable=import-outside-toplevel
+    from vtk_convenience import load_stl  # pylint: disable=import-outside-toplevel
+
+    result = Spine([load_stl(f) for f in spine_files], **PARAMETERS)
+    result.name_vertebrae(offset_to_c1=Spine.offset_from_filename("T11.stl"))
+    return result
@@ -0,0 +1,22 @@
+import numpy as np
+
+from morphology import Endplate
+
+
+def test_matches_serial_angles(spine):
+    matrix = spine.angle_matrix()
+    expected = [[first.angle(second) for second in spine] for first in spine]
+
+    np.testing.assert_allclose(matrix, expected, atol=1e-9)
+    np.testing.assert_allclose(spine.angles, [a.angle(b) for a, b in zip(spine, spine[1:])], atol=1e-9)
+    assert spine.angle_matrix() is matrix
+
+
+def test_cobb_angles(spine):
+    matrix = spine.angle_matrix(Endplate.UPPER, Endplate.LOWER)
+    spanning = np.abs(np.triu(matrix, k=1))
+
+    cobb = spine.max_cobb_angle()
+    assert abs(cobb.angle) == spanning.max()
+    assert spine.cobb_angle(cobb.cranial, cobb.caudal) == cobb.angle
+    assert spine.regional_angles == {"lordosis": spine.cobb_angle("L1", "L5")}
@@ -0,0 +1,26 @@
+import asyncio
+
+import numpy as np
+
+from conftest import PARAMETERS
+from morphology import Spine
+from slopes_async import AsyncAnalyzer, collect_spine
+from vtk_convenience import load_stl
+
+
+def test_repeated_event_loops(spine_files, spine):
+    for _ in range(2):
+        collected = asyncio.run(collect_spine(spine_files))
+        np.testing.assert_allclose(collected.angles, spine.angles)
+        assert collected.named_angles.keys() == spine.named_angles.keys()
+
+
+def test_decimation_parameters(spine_files):
+    decimation = dict(max_triangles=500, proxy_triangles=200)
+    expected = Spine([load_stl(f) for f in spine_files], lean=True, **decimation, **PARAMETERS)
+
+    async def collect():
+        async with AsyncAnalyzer(max_concurrency=2) as analyzer:
+            return await collect_spine(spine_files, analyzer, **decimation)
+
+    np.testing.assert_allclose(asyncio.run(collect()).angles, expected.angles)
@@ -0,0 +1,67 @@
+import os
+import threading
+
+from conftest import LEVELS, read_outputs
+from cost_model import CostModel
+from morphology import Spine
+from slopes_batch import Parameters, SpinePipeline, run_batch, spine_jobs
+from worker_pool import Limits
+
+
+def test_pipeline_matches_spine(spine_directory, spine, cohort, tmp_path):
+    expected = str(tmp_path / "expected.csv")
+    Spine.write(spine, expected)
+    run_batch(spine_jobs([spine_directory]), Parameters(), str(tmp_path / "single"))
+    with open(expected) as file:
+        assert read_outputs(str(tmp_path / "single")) == {"s1.csv": file.read()}
+
+    outputs = []
+    for io_threads, prefetch in [(1, 1), (3, 4)]:
+        output = str(tmp_path / f"{io_threads}_{prefetch}")
+        run_batch(spine_jobs(cohort), Parameters(), output, io_threads=io_threads, prefetch=prefetch)
+        outputs.append(read_outputs(output))
+    assert outputs[0] == outputs[1]
+    assert sorted(outputs[0]) == [f"{os.path.basename(d)}.csv" for d in cohort]
+
+
+def test_pipeline_stops_when_left_early(cohort):
+    threads = set(threading.enumerate())
+    jobs = list(spine_jobs(cohort)) * 10
+    pipeline = SpinePipeline(iter(jobs), io_threads=2, prefetch=2)
+    for job, geometries in pipeline:
+        assert len(geometries.result()) == len(job.filenames)
+        break
+
+    assert set(threading.enumerate()) <= threads
+    assert pipeline.wall_time > 0
+    assert pipeline.compute.items == 1
+    assert pipeline.io.items < len(jobs)
+
+
+def test_split_spine_matches_serial(cohort, tmp_path):
+    serial, supervised = str(tmp_path / "serial"), str(tmp_path / "supervised")
+    run_batch(spine_jobs(cohort), Parameters(), serial)
+    pool = run_batch(spine_jobs(cohort), Parameters(), supervised, workers=2, cost_model=CostModel())
+
+    tasks = pool.plan.tasks
+    assert sum(task.vertebra is not None for task in tasks) == len(LEVELS)
+    assert not pool.killed
+    assert read_outputs(supervised) == read_outputs(serial)
+    assert sorted(read_outputs(serial)) == ["s1.csv", "s2.csv", "s3.csv"]
+
+
+def test_supervised_matches_serial(cohort, tmp_path):
+    serial, supervised = str(tmp_path / "serial"), str(tmp_path / "supervised")
+    run_batch(spine_jobs(cohort), Parameters(), serial)
+    pool = run_batch(spine_jobs(cohort), Parameters(), supervised, workers=2, limits=Limits(max_tasks=1))
+
+    assert pool.recycled >= 1 and not pool.killed
+    assert read_outputs(supervised) == read_outputs(serial)
+
+
+def test_supervised_timeout(cohort, tmp_path, capsys):
+    pool = run_batch(spine_jobs(cohort[:1]), Parameters(), str(tmp_path), workers=1, limits=Limits(job_timeout=0.01))
+
+    assert [killed.job_id for killed in pool.killed] == ["s1"]
+    assert "s1: failed" in capsys.readouterr().err
+    assert read_outputs(str(tmp_path)) == {}
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from batch_journal import Journal, parameters_key
+from cohort_stats import CohortStatistics
+from slopes_batch import Parameters, run_batch, spine_jobs
+
+
+def test_quantiles_within_counted_angles(tmp_path):
+    stats = CohortStatistics()
+    for index, angle in enumerate([-7.03, -4.5, 2.25, 11.61]):
+        stats.add(f"s{index}", ["L1/L2"], [angle])
+    filename = str(tmp_path / "cohort.npz")
+    stats.save(filename)
+
+    for loaded in (stats, CohortStatistics.load(filename)):
+        assert loaded.quantile("L1/L2", 0.0) == -7.03
+        assert loaded.quantile("L1/L2", 1.0) == 11.61
+        assert np.isclose(loaded.quantile("L1/L2", 0.5), -4.5, atol=loaded.resolution)
+        summary, = loaded.summary((0.0, 1.0))
+        assert (summary["q00"], summary["q100"]) == (-7.03, 11.61)
+
+
+def random_stats(spine_ids, seed, parameters=""):
+    stats = CohortStatistics(parameters)
+    generator = np.random.default_rng(seed)
+    for spine_id in spine_ids:
+        stats.add(spine_id, ["L1/L2", "L2/L3"], generator.normal([-5.0, 8.0], 3.0))
+    return stats
+
+
+def test_merge_is_exact():
+    merged = random_stats(["a", "b", "c"], 1)
+    merged.merge(random_stats(["d", "e"], 2))
+    # the same angles counted by a single instance
+    together = random_stats(["a", "b", "c"], 1)
+    for spine_id, angles in zip("de", np.random.default_rng(2).normal([-5.0, 8.0], 3.0, size=(2, 2))):
+        together.add(spine_id, ["L1/L2", "L2/L3"], angles)
+
+    assert merged.spine_ids == together.spine_ids == set("abcde")
+    for pair in ("L1/L2", "L2/L3"):
+        np.testing.assert_array_equal(merged.histograms[pair].counts, together.histograms[pair].counts)
+        np.testing.assert_allclose(merged.moments[pair].to_array(), together.moments[pair].to_array())
+        assert merged.moments[pair].count == 5
+
+
+def test_merge_rejects_overlap_and_other_parameters():
+    stats = random_stats(["a", "b"], 1)
+    with pytest.raises(ValueError, match="counted twice: b"):
+        stats.merge(random_stats(["b", "c"], 2))
+    with pytest.raises(ValueError, match="parameters"):
+        stats.merge(random_stats(["c"], 2, parameters='{"max_angle": 40.0}'))
+    assert stats.spine_ids == {"a", "b"}
+    assert not stats.add("a", ["L1/L2"], [0.0])
+
+
+def test_percentile():
+    stats = CohortStatistics()
+    for index, angle in enumerate([-10.0, 0.0, 10.0, 20.0]):
+        stats.add(f"s{index}", ["L1/L2"], [angle])
+
+    assert stats.percentile("L1/L2", -180.0) == 0.0
+    assert stats.percentile("L1/L2", 5.0) == 50.0
+    assert stats.percentile("L1/L2", 180.0) == 100.0
+    assert np.isclose(stats.z_score("L1/L2", 5.0), 0.0)
+    with pytest.raises(KeyError):
+        stats.percentile("L4/L5", 0.0)
+
+
+def test_save_load_round_trip(tmp_path):
+    stats = random_stats(["a", "b", "c"], 3, parameters='{"max_angle": 40.0}')
+    filename = str(tmp_path / "cohort.npz")
+    stats.save(filename)
+    loaded = CohortStatistics.load(filename)
+
+    assert (loaded.parameters, loaded.resolution, loaded.spine_ids) == (stats.parameters, stats.resolution, stats.spine_ids)
+    assert loaded.summary() == stats.summary()
+    assert CohortStatistics.open(filename, stats.parameters).spine_ids == stats.spine_ids
+    with pytest.raises(ValueError):
+        CohortStatistics.open(filename, "")
+
+
+def test_saved_after_every_spine(cohort, tmp_path):
+    filename = str(tmp_path / "cohort.npz")
+    stats = CohortStatistics(parameters_key(Parameters()))
+    with Journal(str(tmp_path / "journal.sqlite")) as journal:
+        run_batch(spine_jobs(cohort), Parameters(), str(tmp_path / "out"), journal=journal, stats=stats, stats_file=filename)
+
+    # saved by the run itself, as if it had been killed right after
+    assert CohortStatistics.load(filename).spine_ids == {"s1", "s2", "s3"}
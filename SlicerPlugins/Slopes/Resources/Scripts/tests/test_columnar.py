@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from batch_journal import Journal
+from columnar import CohortColumns, check_format, load_columns, spine_curves, vertebra_table, write_columns
+from morphology import Endplate
+from slopes_batch import Parameters, run_batch, spine_jobs
+
+
+@pytest.mark.parametrize("suffix", [".npz", ".columns"])
+def test_round_trip(spine, tmp_path, suffix):
+    columns = CohortColumns()
+    columns.add_spine("a", spine)
+    columns.add_spine("b", spine)
+    path = str(tmp_path / f"cohort{suffix}")
+    write_columns(columns.columns(), path)
+    loaded = load_columns(path)
+
+    count = len(spine)
+    assert loaded["spine_ids"].tolist() == ["a", "b"]
+    np.testing.assert_array_equal(loaded["vertebra_offsets"], [0, count, 2 * count])
+    np.testing.assert_allclose(loaded["angles"][: count - 1], spine.angles)
+    curves = spine_curves(spine)
+    bounds = loaded["curve_offsets"]
+    for index in (0, 2 * count - 1):
+        np.testing.assert_allclose(loaded["curve_points"][bounds[2 * count + index] : bounds[2 * count + index + 1]], curves[index])
+    np.testing.assert_allclose(loaded["regressions"][count + 2, Endplate.UPPER], spine[2].body.regressions[Endplate.UPPER])
+
+
+def test_vertebra_table(spine):
+    columns = CohortColumns()
+    columns.add_spine("a", spine)
+    table = vertebra_table(columns.columns())
+
+    np.testing.assert_allclose(table["angle_to_next"][:-1], spine.angles)
+    assert np.isnan(table["angle_to_next"][-1])
+    assert table["level"].tolist() == ["T11", "T12", "L1", "L2", "L3", "L4", "L5"]
+    assert len(table["upper_curve"]) == len(spine)
+
+
+def test_parts_of_resumed_runs(cohort, tmp_path):
+    output, parts = str(tmp_path / "out"), str(tmp_path / "cohort.npz.parts")
+    with Journal(str(tmp_path / "journal.sqlite")) as journal:
+        run_batch(spine_jobs(cohort[:2]), Parameters(), output, journal=journal, columns=CohortColumns(parts))
+        resumed = CohortColumns(parts)
+        run_batch(spine_jobs(cohort), Parameters(), output, journal=journal, columns=resumed)
+        assert journal.skipped == 2
+
+    columns = resumed.columns()
+    assert len(resumed) == 3
+    assert columns["spine_ids"].tolist() == ["s1", "s2", "s3"]
+    in_memory = CohortColumns()
+    run_batch(spine_jobs(cohort), Parameters(), str(tmp_path / "again"), columns=in_memory)
+    for name, column in in_memory.columns().items():
+        np.testing.assert_array_equal(columns[name], column)
+
+
+def test_parquet_requires_pyarrow():
+    try:
+        import pyarrow  # pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        with pytest.raises(ImportError):
+            check_format("cohort.parquet")
+    else:
+        check_format("cohort.parquet")
+    check_format("cohort.npz")
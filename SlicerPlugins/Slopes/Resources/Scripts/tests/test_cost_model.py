@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+import labelled_surface
+
+from conftest import LEVELS
+from cost_model import ASCII_STL_FACET, CostModel, Plan, lpt_makespan, plan_tasks, spine_triangles, stl_triangles
+from labelled_surface import binary_stl_counts, surface_triangles
+from slopes_batch import spine_jobs
+from test_labelled_surface import write_ascii_solids, write_labelled
+from vtk_convenience import load_stl
+
+
+def test_surface_triangles_from_headers(tmp_path, spine_files):
+    geometries = [load_stl(f) for f in spine_files]
+    counts = [g.GetNumberOfPolys() for g in geometries]
+    vtp = str(tmp_path / "spine.vtp")
+    write_labelled(vtp, geometries, [18 + i for i in range(len(geometries))])
+    binary = str(tmp_path / "spine.stl")
+    with open(binary, "wb") as file:
+        for filename in spine_files:
+            with open(filename, "rb") as solid:
+                file.write(solid.read())
+
+    labelled_surface._cached_split.cache_clear()  # pylint: disable=protected-access
+    assert surface_triangles(vtp) == sum(counts)
+    assert binary_stl_counts(binary) == counts
+    assert binary_stl_counts(spine_files[0]) == counts[:1]
+    for surface in (vtp, binary):
+        members = [f"{surface}#{level}" for level in LEVELS]
+        assert spine_triangles(members) == [sum(counts) // len(LEVELS)] * len(LEVELS)
+    # estimated without splitting any surface
+    assert labelled_surface._cached_split.cache_info().currsize == 0  # pylint: disable=protected-access
+
+
+def test_ascii_surface_falls_back_to_file_size(tmp_path, spine_files):
+    filename = str(tmp_path / "spine.stl")
+    write_ascii_solids(filename, [("T11", load_stl(spine_files[0])), ("T12", load_stl(spine_files[1]))])
+
+    assert surface_triangles(filename) is None and binary_stl_counts(filename) is None
+    size = os.path.getsize(filename) // ASCII_STL_FACET
+    assert stl_triangles(f"{filename}#T11") == size
+    assert spine_triangles([f"{filename}#T11", f"{filename}#T12", spine_files[2]]) == [
+        size // 2, size // 2, load_stl(spine_files[2]).GetNumberOfPolys()
+    ]
+
+
+def test_fit_recovers_coefficients(tmp_path):
+    model = CostModel(per_spine=0.01, per_vertebra=0.002, per_triangle=3e-6)
+    triangles = [1000, 4000, 8000, 16000, 2500]
+    seconds = [model.predict_vertebra(t) for t in triangles]
+    fitted = CostModel.fit(triangles, seconds, [0.02, 0.01, 0.005])
+
+    assert fitted.per_spine == pytest.approx(0.01)
+    assert fitted.per_vertebra == pytest.approx(0.002)
+    assert fitted.per_triangle == pytest.approx(3e-6)
+    fitted.save(str(tmp_path / "cost_model.json"))
+    assert CostModel.load(str(tmp_path / "cost_model.json")) == fitted
+
+    # time falling with size is no reason for negative coefficients
+    falling = CostModel.fit([1000, 2000, 4000], [0.03, 0.02, 0.001], [])
+    assert falling.per_triangle == 0.0 and falling.per_spine == 0.0
+
+
+def test_plan_largest_first(cohort):
+    jobs = list(spine_jobs(cohort))
+    model = CostModel()
+    costs = {job.spine_id: model.predict(spine_triangles(job.filenames)) for job in jobs}
+
+    tasks = plan_tasks(jobs, model, workers=1)
+    assert [task.task_id for task in tasks] == sorted(costs, key=lambda s: -costs[s])
+
+    # s1 has four times the triangles of the others and is split among two workers
+    tasks = plan_tasks(jobs, model, workers=2)
+    split = [task for task in tasks if task.vertebra is not None]
+    assert {task.job.spine_id for task in split} == {"s1"}
+    assert sorted(task.vertebra for task in split) == list(range(len(LEVELS)))
+    assert [task.cost for task in tasks] == sorted((task.cost for task in tasks), reverse=True)
+    assert sum(task.cost for task in split) == pytest.approx(costs["s1"] - model.per_spine)
+    assert all(task.vertebra is None for task in plan_tasks(jobs, model, workers=2, split=False))
+
+    plan = Plan(tasks, workers=2)
+    assert plan.predicted_busy <= sum(costs.values())
+    assert plan.predicted_makespan < Plan(plan_tasks(jobs, model, workers=2, split=False), workers=2).predicted_makespan
+    assert "1 spines split per vertebra" in plan.report(1.0, 2.0)
+
+
+def test_lpt_makespan():
+    assert lpt_makespan([5, 4, 3, 3, 3], workers=2) == 10
+    assert lpt_makespan([5, 4, 3], workers=0) == 12
@@ -0,0 +1,92 @@
+import os
+import signal
+
+from threading import Thread
+from time import monotonic, sleep
+
+import numpy as np
+import pytest
+
+from mesh_archive import write_archive
+from slopes_daemon import DaemonClient, analyze_request, make_server, validate
+from vtk_convenience import load_stl
+
+
+def test_validate_members(tmp_path, spine_files):
+    archive = str(tmp_path / "spine.spz")
+    write_archive(archive, [(os.path.basename(f)[: -len(".stl")], load_stl(f)) for f in spine_files[:3]])
+    members = [f"{archive}#T11", f"{archive}#T12", f"{archive}#L1"]
+
+    validate({"files": members})
+    with pytest.raises(ValueError, match="not found"):
+        validate({"files": [str(tmp_path / "missing.spz#L1"), *members]})
+    with pytest.raises(ValueError, match="not found"):
+        validate({"files": [str(tmp_path / "L1.stl"), *members]})
+
+    answer = analyze_request({"files": members})
+    direct = analyze_request({"files": spine_files[:3]})
+    # the archive quantises coordinates to 16 bits
+    np.testing.assert_allclose(answer["angles"], direct["angles"], atol=1e-3)
+
+
+@pytest.mark.parametrize(
+    "fields, message",
+    [
+        ({"thickness": "0.25"}, "'thickness' must be a number"),
+        ({"thickness": 0}, "'thickness' must be positive"),
+        ({"max_angle": None}, "'max_angle' must be a number"),
+        ({"max_triangles": 2000.5}, "'max_triangles' must be an integer"),
+        ({"max_triangles": True}, "'max_triangles' must be an integer"),
+        ({"max_error": -0.1}, "'max_error' must be zero or positive"),
+        ({"proxy_triangles": "all"}, "'proxy_triangles' must be an integer"),
+        ({"right": [1, 0]}, "'right' must have three"),
+        ({"right": "x"}, "'right' must have three"),
+        ({"right": [0, 0, 0]}, "'right' must not be zero"),
+        ({"id": 7}, "'id' must be a string"),
+        ({"max_angel": 30}, "unknown fields: max_angel"),
+    ],
+)
+def test_validate_parameters(spine_files, fields, message):
+    with pytest.raises(ValueError, match=message):
+        validate({"files": spine_files[:3], **fields})
+
+
+def test_bad_parameters_rejected(spine_files):
+    server = make_server(1, port=0, quiet=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = DaemonClient(port=server.server_address[1], timeout=60)
+        with pytest.raises(RuntimeError, match="400"):
+            client.analyze(spine_files[:3], thickness="thick")
+        with pytest.raises(RuntimeError, match="400"):
+            client.request("POST", "/analyze", {"files": [1, 2]})
+        assert client.metrics()["rejected"] == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.pool.shutdown()
+
+
+def test_recovers_from_dead_worker(spine_files):
+    server = make_server(1, port=0, quiet=True)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = DaemonClient(port=server.server_address[1], timeout=60)
+        expected = client.analyze(spine_files[:3])["angles"]
+
+        for pid in list(server.pool._executor._processes):  # pylint: disable=protected-access
+            os.kill(pid, signal.SIGKILL)
+        deadline = monotonic() + 10
+        while server.pool.health() == "ok" and monotonic() < deadline:
+            sleep(0.05)
+        with pytest.raises(RuntimeError, match="503"):
+            client.health()
+
+        assert client.analyze(spine_files[:3])["angles"] == expected
+        assert client.health()["restarts"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.pool.shutdown()
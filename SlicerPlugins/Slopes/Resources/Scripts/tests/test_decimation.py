@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from conftest import LEVELS, PARAMETERS
+from morphology import Spine, Vertebra, approximate_up
+from vtk_convenience import load_stl
+
+from vtkmodules.vtkFiltersCore import vtkImplicitPolyDataDistance, vtkMassProperties
+
+
+def large_spine(cohort):
+    return [load_stl(os.path.join(cohort[0], f"{level}.stl")) for level in LEVELS]
+
+
+def volume(geometry) -> float:
+    properties = vtkMassProperties()
+    properties.SetInputData(geometry)
+    properties.Update()
+    return properties.GetVolume()
+
+
+def test_decimate_to_budget(cohort):
+    geometry = large_spine(cohort)[0]
+    count = geometry.GetNumberOfPolys()
+
+    assert conv.decimate(geometry) is geometry
+    assert conv.decimate(geometry, triangles=count) is geometry
+    decimated = conv.decimate(geometry, triangles=count // 10)
+    assert decimated.GetNumberOfPolys() <= count // 10
+    assert abs(volume(decimated) / volume(geometry) - 1.0) < 0.01
+    assert conv.decimate(geometry, triangles=count // 2, max_error=1e-9).GetNumberOfPolys() <= count // 2
+
+
+def test_error_bound(cohort):
+    geometry = large_spine(cohort)[0]
+    # the subdivided mesh is flat between the vertices of the original one, which no error bound keeps
+    decimated = conv.decimate(geometry, max_error=0.01)
+    assert decimated.GetNumberOfPolys() < geometry.GetNumberOfPolys() / 10
+
+    distance = vtkImplicitPolyDataDistance()
+    distance.SetInput(geometry)
+    assert max(abs(distance.EvaluateFunction(p)) for p in conv.points_array(decimated)) < 0.01
+
+
+def test_spine_decimates_every_vertebra_first(cohort):
+    geometries = large_spine(cohort)[:3]
+    counts = [g.GetNumberOfPolys() for g in geometries]
+    spine = Spine(geometries, max_triangles=2000, **PARAMETERS)
+
+    up = approximate_up(geometries)
+    for geometry, vertebra in zip(geometries, spine):
+        assert vertebra.geometry.GetNumberOfPolys() <= 2000
+        expected = Vertebra(conv.decimate(geometry, triangles=2000), up_approximator=up, **PARAMETERS)
+        np.testing.assert_array_equal(vertebra.orientation.center, expected.orientation.center)
+        np.testing.assert_array_equal(vertebra.body.regressions, expected.body.regressions)
+    # the caller's geometries are left alone
+    assert [g.GetNumberOfPolys() for g in geometries] == counts
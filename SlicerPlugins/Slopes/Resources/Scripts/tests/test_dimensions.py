@@ -0,0 +1,76 @@
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import vtk_convenience as conv
+
+from conftest import PARAMETERS
+from vtk_convenience import load_stl
+
+DIMENSIONS_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 4, "Dimensions", "Resources", "Scripts")
+
+
+@pytest.fixture(scope="module")
+def dimensions():
+    """The morphology module of the Dimensions plugin, next to the one of Slopes."""
+    spec = importlib.util.spec_from_file_location("dimensions_morphology", os.path.join(DIMENSIONS_SCRIPTS, "morphology.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    yield module
+    del sys.modules[spec.name]
+
+
+@pytest.fixture(scope="module")
+def dimensions_spine(dimensions, spine_files):
+    return dimensions.Spine([load_stl(f) for f in spine_files], **PARAMETERS)
+
+
+def test_line_crossing(dimensions):
+    crossing = dimensions.calc_line_crossing(
+        np.array([0.0, 0.0, 0.0]), np.array([1.0, 0.0, 0.0]), np.array([2.0, -1.0, 1.0]), np.array([0.0, 2.0, 0.0])
+    )
+    np.testing.assert_allclose(crossing, [2.0, 0.0, 0.5])
+    # parallel lines, halfway between the first point and the second line
+    crossing = dimensions.calc_line_crossing(
+        np.array([0.0, 0.0, 0.0]), np.array([1.0, 0.0, 0.0]), np.array([3.0, 0.0, 2.0]), np.array([2.0, 0.0, 0.0])
+    )
+    np.testing.assert_allclose(crossing, [0.0, 0.0, 1.0])
+
+
+def test_centers_match_vtk_cutter(dimensions, dimensions_spine):
+    """The analytic centers are the points vtkCutter finds on the sagittal curve in the frontal plane."""
+    for vertebra in dimensions_spine:
+        for endplate in dimensions.Endplate.options():
+            sagittal = vertebra.body.curve_records[endplate]
+            lateral = vertebra.body_laterally.curve_records[endplate]
+            crossing = dimensions.calc_line_crossing(
+                sagittal.points.mean(axis=0),
+                vertebra.body.regressions[endplate],
+                lateral.points.mean(axis=0),
+                vertebra.body_laterally.regressions[endplate],
+            )
+            cut = conv.points_array(
+                conv.cut_plane(vertebra.body.curves[endplate], plane_origin=crossing, plane_normal=vertebra.orientation.front)
+            )
+            if len(cut) == 0:
+                # the curve misses the plane
+                np.testing.assert_allclose(vertebra.center[endplate], crossing)
+                continue
+            nearest = cut[np.linalg.norm(cut - crossing, axis=1).argmin()]
+            np.testing.assert_allclose(vertebra.center[endplate], nearest, atol=1e-4)
+            # in the sagittal plane the curve was cut with
+            offset = vertebra.center[endplate] - vertebra.orientation.center
+            assert abs(offset.dot(vertebra.orientation.right)) < 1e-4
+
+
+def test_minmax_matches_curve_extrema(dimensions, dimensions_spine):
+    for vertebra in dimensions_spine:
+        for endplate, (first, last) in zip(dimensions.Endplate.options(), vertebra.body.minmax):
+            points = conv.points_array(vertebra.body.curves[endplate])
+            projection = points.dot(vertebra.body.regressions[endplate])
+            np.testing.assert_allclose(first.dot(vertebra.body.regressions[endplate]), projection.min())
+            np.testing.assert_allclose(last.dot(vertebra.body.regressions[endplate]), projection.max())
@@ -0,0 +1,56 @@
+import os
+import sqlite3
+
+from batch_journal import DONE, Journal, RetryPolicy
+from conftest import read_outputs
+from results_store import ResultsStore
+from slopes_batch import Parameters, run_batch, spine_jobs
+
+
+def test_skip_and_resume(cohort, tmp_path):
+    output = str(tmp_path / "out")
+    filename = str(tmp_path / "journal.sqlite")
+    with Journal(filename) as journal:
+        run_batch(spine_jobs(cohort), Parameters(), output, journal=journal)
+        assert journal.summary() == {DONE: 3}
+    written = read_outputs(output)
+
+    # a done spine is skipped unless its output was altered
+    with open(os.path.join(output, "s2.csv"), "a") as file:
+        file.write("altered\n")
+    with Journal(filename) as journal:
+        run_batch(spine_jobs(cohort), Parameters(), output, journal=journal)
+        assert journal.skipped == 2
+        assert journal.entry("s2", Parameters()).attempts == 2
+    assert read_outputs(output) == written
+
+    # a run killed in the middle of s3 leaves it running; it is retried while attempts remain
+    with Journal(filename) as journal:
+        journal.start("s3", Parameters())
+    with Journal(filename) as journal:
+        run_batch(spine_jobs(cohort), Parameters(), output, journal=journal, policy=RetryPolicy(max_attempts=1))
+        assert journal.skipped == 3
+        assert journal.entry("s3", Parameters()).status == "running"
+    with Journal(filename) as journal:
+        run_batch(spine_jobs(cohort), Parameters(), output, journal=journal, policy=RetryPolicy(max_attempts=3))
+        assert journal.skipped == 2
+        assert journal.entry("s3", Parameters()).status == DONE
+
+    # other parameters are a run of their own
+    with Journal(filename) as journal:
+        run_batch(spine_jobs(cohort[:1]), Parameters(max_angle=40.0), str(tmp_path / "other"), journal=journal)
+        assert journal.skipped == 0
+        assert journal.summary() == {DONE: 4}
+
+
+def test_store_committed_before_journal(cohort, tmp_path):
+    filename = str(tmp_path / "store.sqlite")
+    with Journal(str(tmp_path / "journal.sqlite")) as journal:
+        # the store is left open, as by a killed run; a batch of 100 spines is never reached
+        store = ResultsStore(filename, batch_size=100)
+        run_batch(spine_jobs(cohort), Parameters(), str(tmp_path / "out"), journal=journal, store=store)
+        assert journal.summary() == {DONE: 3}
+
+    with sqlite3.connect(filename) as connection:
+        assert sorted(row[0] for row in connection.execute("SELECT spine_id FROM spines")) == ["s1", "s2", "s3"]
+    store.close()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import label_volume
+
+from label_volume import Extraction, extract_levels, read_label_volume, volume_member_triangles
+
+# 30 degrees about the superior axis, anisotropic spacing
+ANGLE = np.radians(30)
+ROTATION = np.array([[np.cos(ANGLE), -np.sin(ANGLE), 0], [np.sin(ANGLE), np.cos(ANGLE), 0], [0, 0, 1]])
+DIRECTIONS = ROTATION @ np.diag([0.5, 0.6, 0.8])
+ORIGIN = np.array([10.0, -20.0, 30.0])
+
+
+def write_nrrd(filename: str, labels: np.ndarray, space: str = "left-posterior-superior") -> None:
+    directions = " ".join(f"({','.join(map(str, column.tolist()))})" for column in DIRECTIONS.T)
+    header = (
+        "NRRD0004\n"
+        "type: uint8\n"
+        "dimension: 3\n"
+        f"space: {space}\n"
+        f"sizes: {' '.join(map(str, labels.shape[::-1]))}\n"
+        f"space directions: {directions}\n"
+        "kinds: domain domain domain\n"
+        "encoding: raw\n"
+        f"space origin: ({','.join(map(str, ORIGIN.tolist()))})\n\n"
+    )
+    with open(filename, "wb") as file:
+        file.write(header.encode() + labels.tobytes())
+
+
+def block_labels() -> np.ndarray:
+    labels = np.zeros((24, 24, 24), dtype=np.uint8)
+    labels[8:16, 6:14, 4:20] = 20  # L1, indexed k, j, i
+    labels[2:5, 2:5, 2:5] = 26  # sacrum, ignored
+    return labels
+
+
+@pytest.mark.parametrize("space, signs", [("left-posterior-superior", (-1, -1, 1)), ("RAS", (1, 1, 1))])
+def test_oblique_nrrd_in_ras(tmp_path, space, signs):
+    filename = str(tmp_path / "labels.nrrd")
+    write_nrrd(filename, block_labels(), space)
+
+    grid, matrix = read_label_volume(filename)
+    np.testing.assert_allclose(grid.GetSpacing(), [0.5, 0.6, 0.8])
+    np.testing.assert_allclose(matrix[:3, :3] * [0.5, 0.6, 0.8], np.diag(signs) @ DIRECTIONS)
+
+    levels = extract_levels(filename, Extraction(smoothing=0))
+    assert list(levels) == ["L1"]
+    points, _ = levels["L1"]
+    # the center of the block, voxels 4..19, 6..13 and 8..15 along i, j and k
+    center = np.diag(signs) @ (ORIGIN + DIRECTIONS @ [11.5, 9.5, 11.5])
+    np.testing.assert_allclose(points.mean(axis=0), center, atol=0.05)
+
+
+def test_unsupported_space(tmp_path):
+    filename = str(tmp_path / "labels.nrrd")
+    write_nrrd(filename, block_labels(), "scanner-xyz")
+    with pytest.raises(ValueError, match="unsupported NRRD space"):
+        read_label_volume(filename)
+
+
+@pytest.mark.parametrize("method", label_volume.METHODS)
+def test_triangle_estimate(tmp_path, monkeypatch, method):
+    filename = str(tmp_path / "labels.nrrd")
+    labels = block_labels()
+    labels[16:24, 10:20, 0:24] = 21  # L2, next to L1 and on the border of the volume
+    write_nrrd(filename, labels)
+    monkeypatch.setattr(label_volume, "_extraction", Extraction(method, smoothing=0))
+    levels = extract_levels(filename, Extraction(method, smoothing=0))
+
+    for level in ("L1", "L2"):
+        assert volume_member_triangles(f"{filename}#{level}") == pytest.approx(len(levels[level][1]), rel=0.1)
+    monkeypatch.setattr(label_volume, "_extraction", Extraction(method, triangles=100))
+    assert volume_member_triangles(f"{filename}#L1") == 100
+    with pytest.raises(KeyError):
+        volume_member_triangles(f"{filename}#L3")
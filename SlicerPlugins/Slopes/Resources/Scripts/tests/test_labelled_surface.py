@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import LEVELS, PARAMETERS
+from labelled_surface import expand_surfaces, is_multi_solid, read_stl_solids, read_vertebrae
+from morphology import Spine
+from vtk_convenience import load_stl, points_array, polydata_to_arrays
+
+from vtkmodules.vtkCommonCore import vtkIntArray
+from vtkmodules.vtkFiltersCore import vtkAppendPolyData
+from vtkmodules.vtkIOXML import vtkXMLPolyDataWriter
+
+
+def write_labelled(filename: str, geometries, labels) -> None:
+    append = vtkAppendPolyData()
+    for geometry, label in zip(geometries, labels):
+        array = vtkIntArray()
+        array.SetName("label")
+        for _ in range(geometry.GetNumberOfCells()):
+            array.InsertNextValue(label)
+        geometry.GetCellData().AddArray(array)
+        append.AddInputData(geometry)
+    writer = vtkXMLPolyDataWriter()
+    writer.SetFileName(filename)
+    writer.SetInputConnection(append.GetOutputPort())
+    writer.Write()
+
+
+def write_ascii_solids(filename: str, named) -> None:
+    with open(filename, "w") as file:
+        for name, geometry in named:
+            arrays = polydata_to_arrays(geometry)
+            corners = arrays["points"][arrays["polys_connectivity"].reshape(-1, 3)]
+            file.write(f"solid {name}\n")
+            for triangle in corners:
+                file.write("facet normal 0 0 0\nouter loop\n")
+                file.writelines(f"vertex {x!r} {y!r} {z!r}\n" for x, y, z in triangle.tolist())
+                file.write("endloop\nendfacet\n")
+            file.write(f"endsolid {name}\n")
+
+
+def triangle_corners(geometry) -> np.ndarray:
+    """Triangles as sorted rows of corner coordinates, independent of point numbering."""
+    arrays = polydata_to_arrays(geometry)
+    corners = arrays["points"][arrays["polys_connectivity"].reshape(-1, 3)].reshape(-1, 9)
+    return corners[np.lexsort(corners.T[::-1])]
+
+
+def test_vtp_round_trip(tmp_path, spine_files, spine):
+    geometries = [load_stl(f) for f in spine_files]
+    filename = str(tmp_path / "spine.vtp")
+    # 26, the sacrum in VerSe, is skipped
+    write_labelled(filename, geometries + [load_stl(spine_files[0])], [18 + i for i in range(7)] + [26])
+
+    vertebrae = read_vertebrae(filename)
+    assert list(vertebrae) == list(LEVELS)
+    for geometry, vertebra in zip(geometries, vertebrae.values()):
+        np.testing.assert_array_equal(triangle_corners(vertebra), triangle_corners(geometry))
+
+    members = expand_surfaces([filename])
+    assert [os.path.basename(m) for m in members] == [f"spine.vtp#{level}" for level in LEVELS]
+    loaded = Spine([load_stl(m) for m in members], **PARAMETERS)
+    np.testing.assert_allclose(loaded.angles, spine.angles, atol=1e-9)
+
+
+def test_multi_solid_stl(tmp_path, spine_files):
+    geometries = [load_stl(f) for f in spine_files[:2]]
+    filename = str(tmp_path / "spine.stl")
+    write_ascii_solids(filename, [("T11", geometries[0]), ("T12", geometries[1]), ("sacrum", geometries[0])])
+
+    vertebrae = read_vertebrae(filename)
+    assert list(vertebrae) == ["T11", "T12"]
+    np.testing.assert_allclose(
+        np.sort(points_array(vertebrae["T12"]), axis=0), np.sort(points_array(geometries[1]), axis=0), atol=1e-6
+    )
+
+
+def test_is_multi_solid(tmp_path, spine_files):
+    geometry = load_stl(spine_files[0])
+    single, multiple = str(tmp_path / "single.stl"), str(tmp_path / "multiple.stl")
+    write_ascii_solids(single, [("L1", geometry)])
+    write_ascii_solids(multiple, [("L1", geometry), ("L2", geometry)])
+    assert not is_multi_solid(single)
+    assert is_multi_solid(multiple)
+
+    concatenated = str(tmp_path / "concatenated.stl")
+    with open(concatenated, "wb") as file:
+        for filename in spine_files[:2]:
+            with open(filename, "rb") as part:
+                file.write(part.read())
+    assert not is_multi_solid(spine_files[0])
+    assert is_multi_solid(concatenated)
+
+
+def test_duplicate_solids(tmp_path, spine_files):
+    geometry = load_stl(spine_files[0])
+    filename = str(tmp_path / "twice.stl")
+    write_ascii_solids(filename, [("L1", geometry), ("L1", geometry)])
+    with pytest.raises(ValueError, match="two solids"):
+        read_stl_solids(filename)
+
+    filename = str(tmp_path / "same_level.stl")
+    write_ascii_solids(filename, [("L1", geometry), ("vertebra_L1", geometry)])
+    with pytest.raises(ValueError, match="two solids"):
+        read_vertebrae(filename)
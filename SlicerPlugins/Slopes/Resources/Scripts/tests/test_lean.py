@@ -0,0 +1,29 @@
+import numpy as np
+
+from conftest import PARAMETERS
+from morphology import MemoryReport, Spine
+from vtk_convenience import load_stl
+
+
+def test_lean_lowers_peak(spine_files, spine):
+    reported = Spine([load_stl(f) for f in spine_files], memory_report=True, **PARAMETERS)
+    lean = Spine([load_stl(f) for f in spine_files], lean=True, memory_report=True, **PARAMETERS)
+
+    assert all(vertebra.memory is None for vertebra in spine)
+    for full, vertebra in zip(reported, lean):
+        assert vertebra.geometry is None
+        assert vertebra.body.center_portion is None and vertebra.body.endplates is None
+        assert vertebra.memory.peak < full.memory.peak
+        assert vertebra.memory.retained < full.memory.retained
+        np.testing.assert_allclose(vertebra.body.regressions, full.body.regressions)
+
+
+def test_caller_geometry_stays_held(spine_files):
+    geometries = [load_stl(f) for f in spine_files]
+    sizes = [MemoryReport.size_of(g) for g in geometries]
+    lean = Spine(geometries, lean=True, memory_report=True, **PARAMETERS)
+    decimated = Spine([load_stl(f) for f in spine_files], lean=True, memory_report=True, max_triangles=500, **PARAMETERS)
+
+    for size, vertebra, smaller in zip(sizes, lean, decimated):
+        assert vertebra.memory.retained >= size
+        assert smaller.memory.retained < size
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pytest
+
+import vtk_convenience as conv
+
+from conftest import LEVELS, PARAMETERS
+from mesh_archive import MeshArchive, member_filenames, triangles_array, write_archive
+from morphology import Spine
+from vtk_convenience import load_stl
+
+
+def corners(polydata):
+    return conv.points_array(polydata)[triangles_array(polydata)]
+
+
+@pytest.mark.parametrize("bits, codec", [(16, "lzma"), (32, "zlib")])
+def test_round_trip(spine_files, tmp_path, bits, codec):
+    filename = str(tmp_path / "s1.spz")
+    geometries = [load_stl(f) for f in spine_files]
+    members = write_archive(filename, zip(LEVELS, geometries), bits=bits, codec=codec)
+
+    with MeshArchive(filename) as archive:
+        assert archive.names == list(LEVELS)
+        for member, geometry in zip(members, geometries):
+            read = archive.read(member.name)
+            assert read.GetNumberOfPolys() == member.triangles == geometry.GetNumberOfPolys()
+            # float32 corners of the STL, quantised no further than the error bound
+            np.testing.assert_allclose(corners(read), corners(geometry), rtol=0, atol=member.error_bound + 1e-4)
+        with pytest.raises(KeyError):
+            archive.read("C1")
+
+
+def test_spine_from_archive(spine_files, spine, tmp_path):
+    filename = str(tmp_path / "s1.spz")
+    write_archive(filename, [(os.path.basename(f)[: -len(".stl")], load_stl(f)) for f in spine_files], bits=32)
+
+    filenames = member_filenames(filename)
+    from_archive = Spine([load_stl(f) for f in filenames], lean=True, **PARAMETERS)
+    assert filenames[0] == f"{filename}#T11"
+    np.testing.assert_allclose(from_archive.angles, spine.angles, atol=1e-6)
+
+
+def test_not_an_archive(spine_files):
+    with pytest.raises(ValueError):
+        MeshArchive(spine_files[0])
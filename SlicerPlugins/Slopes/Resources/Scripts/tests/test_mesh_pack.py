@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from conftest import read_outputs
+from mesh_pack import MeshPack, PackWriter, build_pack, open_pack, pack_member_filenames, pack_member_triangles
+from slopes_batch import Parameters, run_batch, spine_jobs, vertebra_name
+from vtk_convenience import load_stl
+
+
+def spine_meshes(directories):
+    """Spine ids and (level, filename) pairs as "mesh_pack.py build" adds them."""
+    for job in spine_jobs(directories):
+        yield job.spine_id, [(os.path.splitext(vertebra_name(f))[0], f) for f in job.filenames]
+
+
+def test_round_trip(cohort, tmp_path):
+    directory = str(tmp_path / "cohort.meshpack")
+    assert build_pack(directory, spine_meshes(cohort[:2])) == (2, 0)
+    assert build_pack(directory, spine_meshes(cohort)) == (1, 2)
+
+    pack = MeshPack(directory)
+    assert pack.spine_ids == ["s1", "s2", "s3"]
+    for spine_id, meshes in spine_meshes(cohort):
+        assert pack.levels(spine_id) == [level for level, _ in meshes]
+        for level, filename in meshes:
+            expected = conv.polydata_to_arrays(load_stl(filename))
+            arrays = pack.read_arrays(spine_id, level)
+            for name in ("points", "polys_offsets", "polys_connectivity"):
+                np.testing.assert_array_equal(arrays[name], expected[name])
+            assert isinstance(arrays["points"], np.memmap)
+            assert pack_member_triangles(f"{directory}#{spine_id}/{level}") == len(expected["polys_offsets"]) - 1
+
+
+def test_killed_build_keeps_committed_spines(cohort, tmp_path):
+    directory = str(tmp_path / "cohort.meshpack")
+    build_pack(directory, spine_meshes(cohort[:1]))
+    writer = PackWriter(directory)
+    spine_id, meshes = next(spine_meshes(cohort[1:2]))
+    for level, filename in meshes:
+        writer.add(spine_id, level, load_stl(filename))
+    for file in writer._files.values():
+        file.write(b"\0" * 5)
+        file.flush()
+    # The writer is never closed, as if the build had been killed.
+
+    assert MeshPack(directory).spine_ids == ["s1"]
+    assert build_pack(directory, spine_meshes(cohort)) == (2, 1)
+    pack = MeshPack(directory)
+    assert pack.spine_ids == ["s1", "s2", "s3"]
+    for spine_id, meshes in spine_meshes(cohort):
+        for level, filename in meshes:
+            expected = conv.polydata_to_arrays(load_stl(filename))
+            np.testing.assert_array_equal(pack.read_arrays(spine_id, level)["points"], expected["points"])
+
+
+def test_open_pack_sees_extension(cohort, tmp_path):
+    directory = str(tmp_path / "cohort.meshpack")
+    build_pack(directory, spine_meshes(cohort[:1]))
+    assert open_pack(directory) is open_pack(directory)
+    assert open_pack(directory).spine_ids == ["s1"]
+    build_pack(directory, spine_meshes(cohort))
+    assert open_pack(directory).spine_ids == ["s1", "s2", "s3"]
+
+
+def test_batch_from_pack(cohort, tmp_path):
+    directory = str(tmp_path / "cohort.meshpack")
+    build_pack(directory, spine_meshes(cohort))
+    from_pack, from_directories = str(tmp_path / "pack"), str(tmp_path / "directories")
+    run_batch(spine_jobs([directory]), Parameters(), from_pack)
+    run_batch(spine_jobs(cohort), Parameters(), from_directories)
+
+    assert sorted(pack_member_filenames(directory)) == ["s1", "s2", "s3"]
+    assert read_outputs(from_pack) == read_outputs(from_directories)
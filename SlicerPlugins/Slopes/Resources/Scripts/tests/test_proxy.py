@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from conftest import LEVELS, PARAMETERS
+from morphology import Spine
+from vtk_convenience import load_stl
+
+
+def large_spine(cohort):
+    return [load_stl(os.path.join(cohort[0], f"{level}.stl")) for level in LEVELS]
+
+
+def test_subsample_polys(cohort):
+    geometry = large_spine(cohort)[0]
+    sample = conv.subsample_polys(geometry, 1000)
+
+    assert sample.GetNumberOfPolys() == 1000
+    assert sample.GetNumberOfPoints() <= 3000
+    np.testing.assert_array_equal(conv.points_array(conv.subsample_polys(geometry, 1000)), conv.points_array(sample))
+    assert conv.subsample_polys(geometry, geometry.GetNumberOfPolys()) is geometry
+    np.testing.assert_allclose(conv.calc_center_of_mass(sample), conv.calc_center_of_mass(geometry), atol=1.0)
+
+
+def test_slab_clips_like_the_whole(cohort):
+    geometry = large_spine(cohort)[0]
+    center = np.array(conv.calc_center_of_mass(geometry))
+    right = np.array([1.0, 0.0, 0.0])
+    slab = conv.extract_slab(geometry, plane_origin=center, plane_normal=right, half_width=2.5)
+    assert 0 < slab.GetNumberOfPolys() < geometry.GetNumberOfPolys() / 4
+
+    for origin in (center + 2.5 * right, center - 2.5 * right):
+        normal = right if origin[0] > center[0] else -right
+        whole = conv.clip_plane(conv.clip_plane(geometry, origin, -normal), 2 * center - origin, normal)
+        clipped = conv.clip_plane(conv.clip_plane(slab, origin, -normal), 2 * center - origin, normal)
+        np.testing.assert_allclose(
+            np.sort(conv.points_array(clipped), axis=0), np.sort(conv.points_array(whole), axis=0)
+        )
+
+
+def test_proxy_spine_close_to_full(cohort):
+    geometries = large_spine(cohort)
+    full = Spine(geometries, **PARAMETERS)
+    proxied = Spine(geometries, proxy_triangles=2000, **PARAMETERS)
+
+    np.testing.assert_allclose(proxied.angles, full.angles, atol=0.5)
+    for vertebra, reference in zip(proxied, full):
+        np.testing.assert_allclose(vertebra.orientation.center, reference.orientation.center, atol=1.0)
+        # the curves are clipped at full resolution
+        assert vertebra.geometry is reference.geometry
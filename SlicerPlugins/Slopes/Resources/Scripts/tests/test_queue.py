@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import signal
+import socket
+
+from glob import glob
+from time import monotonic, sleep
+
+from batch_journal import parameters_key
+from cohort_stats import CohortStatistics
+from slopes_batch import Parameters, SpineJob
+from slopes_queue import QueueWorker, WorkQueue, read_json, work
+
+
+def make_queue(tmp_path, filenames=("L1.stl", "L2.stl")) -> WorkQueue:
+    queue = WorkQueue(str(tmp_path / "queue"))
+    queue.create(str(tmp_path / "output"), Parameters())
+    os.makedirs(tmp_path / "output")
+    assert queue.submit([SpineJob("s1", tuple(filenames))]) == 1
+    return queue
+
+
+def test_reclaim_from_dead_worker(tmp_path):
+    queue = make_queue(tmp_path)
+    claim = queue.claim("dead")
+    assert queue.status()["running"] == 1
+
+    # "dead" never had a heartbeat
+    assert queue.reclaim(stale_after=60.0, max_attempts=2) == 1
+    claim = queue.claim("alive")
+    assert claim.attempt == 2
+    assert queue.finish(claim, "alive", {})
+    assert queue.status() == {"pending": 0, "running": 0, "done": 1, "failed": 0}
+
+
+def test_attempts_used_up(tmp_path):
+    queue = make_queue(tmp_path)
+    for _ in range(2):
+        queue.claim("dead")
+        queue.reclaim(stale_after=60.0, max_attempts=2)
+    assert queue.status()["failed"] == 1
+
+
+def test_lost_claim_records_nothing(tmp_path):
+    queue = make_queue(tmp_path)
+    claim = queue.claim("slow")
+    # "slow" missed its heartbeats and another worker reclaimed its job
+    queue.reclaim(stale_after=60.0, max_attempts=2)
+    assert not queue.finish(claim, "slow", {})
+    assert not queue.fail(claim, "slow", "error")
+    assert queue.status() == {"pending": 1, "running": 0, "done": 0, "failed": 0}
+
+
+def test_reclaim_while_closing(tmp_path):
+    queue = make_queue(tmp_path)
+    claim = queue.claim("dead")
+    # died after taking the claim out of reach, before recording the result
+    os.rename(claim.path, f"{os.path.splitext(claim.path)[0]}.closing")
+    assert queue.reclaim(stale_after=60.0, max_attempts=2) == 1
+    assert queue.claim("alive").attempt == 2
+
+
+def test_worker_drains_queue(tmp_path, spine_files):
+    queue = make_queue(tmp_path, spine_files)
+    worker = QueueWorker(queue, heartbeat=0.1)
+    worker.run()
+    assert (worker.done, worker.failed) == (1, 0)
+    assert queue.status()["done"] == 1
+    assert os.path.exists(tmp_path / "output" / "s1.csv")
+
+
+def test_workers_survive_a_killed_worker(tmp_path, spine_files):
+    queue = make_queue(tmp_path, spine_files)
+    queue.submit([SpineJob(f"s{i}", tuple(spine_files)) for i in range(2, 7)])
+    options = dict(heartbeat=0.2, stale_after=1.0, max_attempts=3)
+    workers = [multiprocessing.Process(target=work, args=(queue.directory,), kwargs=options) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+
+    # kill a worker while it holds a claim
+    names = {f"{socket.gethostname()}-{worker.pid}": worker for worker in workers}
+    deadline = monotonic() + 60.0
+    killed = None
+    while killed is None and monotonic() < deadline:
+        for name in os.listdir(queue.path("running")):
+            _, _, owner = queue.parse(name)
+            if owner in names:
+                killed = names[owner]
+                os.kill(killed.pid, signal.SIGKILL)
+                break
+        else:
+            sleep(0.01)
+    assert killed is not None
+    for worker in workers:
+        worker.join(timeout=120.0)
+        assert not worker.is_alive()
+
+    spine_ids = {f"s{i}" for i in range(1, 7)}
+    assert queue.status() == {"pending": 0, "running": 0, "done": 6, "failed": 0}
+    assert {read_json(queue.path("done", f"{s}.json"))["attempt"] for s in spine_ids} <= {1, 2}
+    assert all(os.path.exists(tmp_path / "output" / f"{s}.csv") for s in spine_ids)
+    # the statistics of all workers, the killed one included, count every spine once
+    stats = CohortStatistics(parameters_key(queue.settings()[1]))
+    for filename in glob(queue.path("stats", "*.npz")):
+        stats.merge(CohortStatistics.load(filename))
+    assert stats.spine_ids == spine_ids
@@ -0,0 +1,56 @@
+import sqlite3
+
+import numpy as np
+
+from conftest import PARAMETERS
+from morphology import Endplate
+from results_store import ResultsStore
+from slopes_batch import Parameters
+from spine_result import SpineResult
+
+
+def test_regression_columns(tmp_path, spine):
+    filename = str(tmp_path / "store.sqlite")
+    with ResultsStore(filename) as store:
+        store.add_spine("s1", spine, Parameters())
+
+    with sqlite3.connect(filename) as connection:
+        rows = connection.execute(
+            "SELECT upper_x, upper_y, upper_z, lower_x, lower_y, lower_z FROM vertebrae ORDER BY position"
+        ).fetchall()
+    for vertebra, row in zip(spine, rows):
+        np.testing.assert_allclose(row[:3], vertebra.body.regressions[Endplate.UPPER])
+        np.testing.assert_allclose(row[3:], vertebra.body.regressions[Endplate.LOWER])
+
+
+def test_round_trip(tmp_path, spine):
+    with ResultsStore(str(tmp_path / "store.sqlite")) as store:
+        store.add_spine("s1", spine, Parameters())
+        stored = store.spine_result("s1")
+        angles = store.angles("L1/L2", max_angle=PARAMETERS["max_angle"])
+
+    expected = SpineResult.from_spine(spine, spine_id="s1")
+    np.testing.assert_allclose(stored.regressions, expected.regressions)
+    np.testing.assert_allclose(stored.centers, expected.centers)
+    np.testing.assert_allclose(angles, [spine.named_angles["L1/L2"]])
+
+
+def test_decimated_results_kept_apart(tmp_path, spine):
+    with ResultsStore(str(tmp_path / "store.sqlite")) as store:
+        store.add("s1", SpineResult.from_spine(spine), [1.0] * 6, Parameters())
+        store.add("s1", SpineResult.from_spine(spine), [2.0] * 6, Parameters(max_triangles=2000))
+        store.add("s1", SpineResult.from_spine(spine), [3.0] * 6, Parameters(max_error=0.1))
+        store.add("s1", SpineResult.from_spine(spine), [5.0] * 6, Parameters(proxy_triangles=5000))
+
+        np.testing.assert_array_equal(store.angles("L1/L2", max_angle=45.0), [1.0])
+        np.testing.assert_array_equal(store.angles("L1/L2", max_triangles=2000), [2.0])
+        np.testing.assert_array_equal(store.angles("L1/L2", max_error=0.1), [3.0])
+        np.testing.assert_array_equal(store.angles("L1/L2", proxy_triangles=5000), [5.0])
+        assert sorted(store.angles("L1/L2", max_triangles=None, max_error=None, proxy_triangles=None)) == [
+            1.0,
+            2.0,
+            3.0,
+            5.0,
+        ]
+        assert len(store.to_arrays()["spine_ids"]) == 1
+
@@ -0,0 +1,81 @@
+import gc
+import multiprocessing
+import os
+import signal
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import vtk_convenience as conv
+
+from shared_mesh import AttachedMesh, SharedMesh
+from vtk_convenience import load_stl
+
+
+def segments_exist(descriptor) -> bool:
+    """Whether all segments of "descriptor" can still be attached to."""
+    try:
+        for array in descriptor.arrays.values():
+            SharedMemory(name=array.segment).close()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def center_of_mass(descriptor):
+    with AttachedMesh(descriptor) as mesh:
+        return conv.calc_center_of_mass(mesh.polydata)
+
+
+def attach_and_die(descriptor):
+    mesh = AttachedMesh(descriptor)
+    assert mesh.polydata.GetNumberOfPoints()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_round_trip(spine_files):
+    geometry = load_stl(spine_files[0])
+    with SharedMesh(geometry) as shared:
+        assert shared.descriptor.nbytes == sum(a.nbytes for a in conv.polydata_to_arrays(geometry).values())
+        with AttachedMesh(shared.descriptor) as mesh:
+            expected = conv.polydata_to_arrays(geometry)
+            for name, array in conv.polydata_to_arrays(mesh.polydata).items():
+                np.testing.assert_array_equal(array, expected[name])
+            # a view that outlives the attachment does not make close fail
+            points = conv.points_array(mesh.polydata)
+        assert mesh.polydata is None
+    np.testing.assert_array_equal(points, conv.points_array(geometry))
+
+
+def test_owner_unlinks(spine_files):
+    geometry = load_stl(spine_files[0])
+    shared = SharedMesh(geometry)
+    descriptor = shared.descriptor
+    assert segments_exist(descriptor)
+    shared.close()
+    assert not segments_exist(descriptor)
+    shared.close()
+
+    shared = SharedMesh(geometry)
+    descriptor = shared.descriptor
+    del shared
+    gc.collect()
+    assert not segments_exist(descriptor)
+
+
+def test_workers_leave_segments_to_the_owner(spine_files):
+    geometry = load_stl(spine_files[0])
+    with SharedMesh(geometry) as shared:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            center = pool.submit(center_of_mass, shared.descriptor).result()
+        np.testing.assert_allclose(center, conv.calc_center_of_mass(geometry))
+        assert segments_exist(shared.descriptor)
+
+        worker = multiprocessing.Process(target=attach_and_die, args=(shared.descriptor,))
+        worker.start()
+        worker.join()
+        assert worker.exitcode == -signal.SIGKILL
+        assert segments_exist(shared.descriptor)
+    assert not segments_exist(shared.descriptor)
@@ -0,0 +1,44 @@
+import pytest
+
+from vtk_convenience import SMP_BACKEND_VARIABLE, SMP_THREADS_VARIABLE, configure_smp
+from vtkmodules.vtkCommonCore import vtkSMPTools
+
+
+@pytest.fixture(autouse=True)
+def restore_backend(monkeypatch):
+    monkeypatch.delenv(SMP_BACKEND_VARIABLE, raising=False)
+    monkeypatch.delenv(SMP_THREADS_VARIABLE, raising=False)
+    backend = vtkSMPTools.GetBackend()
+    yield
+    vtkSMPTools.SetBackend(backend)
+
+
+def test_arguments():
+    backend, threads = configure_smp("Sequential")
+    assert (backend, threads) == ("Sequential", 1)
+    backend, threads = configure_smp("STDThread", 2)
+    assert backend == "STDThread"
+    # at most one thread per core
+    assert 1 <= threads <= 2
+
+
+def test_environment(monkeypatch):
+    monkeypatch.setenv(SMP_BACKEND_VARIABLE, "Sequential")
+    monkeypatch.setenv(SMP_THREADS_VARIABLE, "2")
+    assert configure_smp() == ("Sequential", 1)
+    # arguments take precedence
+    assert configure_smp("STDThread")[0] == "STDThread"
+
+
+@pytest.mark.parametrize("value", ["four", "-2", "2.5"])
+def test_bad_thread_count(monkeypatch, value):
+    monkeypatch.setenv(SMP_THREADS_VARIABLE, value)
+    with pytest.raises(ValueError, match=SMP_THREADS_VARIABLE):
+        configure_smp()
+    with pytest.raises(ValueError, match="negative"):
+        configure_smp(threads=-1)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError, match="not available"):
+        configure_smp("NoSuchBackend")
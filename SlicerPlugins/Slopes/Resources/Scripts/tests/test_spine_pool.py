@@ -0,0 +1,14 @@
+import numpy as np
+
+from conftest import PARAMETERS
+from morphology import Spine
+from vtk_convenience import load_stl
+
+
+def test_workers_match_serial(spine_files, spine):
+    geometries = [load_stl(f) for f in spine_files]
+    pooled = Spine(geometries, workers=2, **PARAMETERS)
+
+    np.testing.assert_array_equal(pooled.angle_matrix(), spine.angle_matrix())
+    for vertebra, geometry in zip(pooled, geometries):
+        assert vertebra.geometry is geometry
@@ -0,0 +1,54 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from conftest import LEVELS
+from morphology import Endplate
+from spine_result import SpineResult
+
+
+def test_from_spine(spine):
+    result = SpineResult.from_spine(spine, spine_id="s1")
+
+    assert len(result) == len(spine)
+    assert list(result.levels) == list(LEVELS)
+    for record, vertebra in zip(result, spine):
+        assert record.spine_id == "s1"
+        np.testing.assert_array_equal(record.right, vertebra.orientation.right)
+        np.testing.assert_array_equal(record.front, vertebra.orientation.front)
+        np.testing.assert_array_equal(record.up, vertebra.orientation.up)
+        np.testing.assert_array_equal(record.down, vertebra.orientation.down)
+        np.testing.assert_array_equal(record.center, vertebra.orientation.center)
+        np.testing.assert_array_equal(record.regressions[Endplate.UPPER], vertebra.body.regressions[Endplate.UPPER])
+        assert record.width == vertebra.orientation.width
+        # Slopes does not measure heights
+        assert np.isnan(record.height)
+
+
+def test_concatenate_and_split(spine):
+    first = SpineResult.from_spine(spine, spine_id="s1")
+    second = SpineResult.from_spine(spine, spine_id="s2", levels=[""] * len(spine))
+    cohort = SpineResult.concatenate([first, second])
+
+    assert len(cohort) == 2 * len(spine)
+    assert list(cohort.spine_ids) == ["s1", "s2"]
+    assert cohort[-1].spine_id == "s2" and cohort[-1].level == ""
+    assert cohort[len(spine)].level == ""
+    with pytest.raises(IndexError):
+        cohort[len(cohort)]
+
+    again = cohort.spine(1)
+    assert list(again.spine_ids) == ["s2"]
+    np.testing.assert_array_equal(again.frames, second.frames)
+    np.testing.assert_array_equal(again.spine_index, np.zeros(len(spine)))
+    assert len(SpineResult.concatenate([])) == 0
+
+
+def test_pickles_without_vtk(spine):
+    result = SpineResult.from_spine(spine, spine_id="s1")
+    restored = pickle.loads(pickle.dumps(result))
+    for name in SpineResult.__slots__:
+        np.testing.assert_array_equal(getattr(restored, name), getattr(result, name))
+    # views hold no data of their own
+    assert not hasattr(result[0], "__dict__")
@@ -8,41 +8,57 @@ If time is critical factor, better not use these or extend on
 them.
 """
 # TODO: add function descriptions to module docstring
-from typing import Union, Generator, Tuple, List, Callable
+from __future__ import annotations
+
+from typing import Union, Generator, Tuple, List, Callable, Dict, Optional
 from math import cos, radians
+from os import environ
+from os.path import exists, isfile
 
 # pylint: disable=no-name-in-module
-from vtk import (
-    vtkAlgorithm,
-    vtkPolyData,
-    vtkSTLReader,
-    vtkOBJWriter,
-    vtkPolyDataAlgorithm,
-    vtkPolyDataMapper,
-    vtkActor,
+# import only the vtk modules needed, rendering is imported on demand
+from vtkmodules.vtkCommonCore import (
     vtkDataArray,
-    vtkPolyDataNormals,
-    vtkRemovePolyData,
     vtkIdTypeArray,
-    vtkOBBTree,
+    vtkPoints,
+    vtkSMPTools,
+    VTK_ID_TYPE,
+)
+from vtkmodules.vtkCommonDataModel import (
+    vtkBoundingBox,
+    vtkCellArray,
     vtkPlane,
+    vtkPointSet,
+    vtkPolyData,
+)
+from vtkmodules.vtkCommonExecutionModel import vtkAlgorithm
+from vtkmodules.vtkFiltersCore import (
+    vtkCenterOfMass,
     vtkClipPolyData,
     vtkCutter,
-    vtkCenterOfMass,
-    vtkAbstractPolyDataReader,
-    vtkOBJReader,
-    vtkBoundingBox,
-    vtkPoints,
-    vtkPointSet,
-    vtkAxisActor,
+    vtkPolyDataNormals,
+    vtkQuadricDecimation,
 )
-from numpy import zeros, array, dot, ndarray
+from vtkmodules.vtkFiltersGeneral import vtkOBBTree, vtkRemovePolyData
+from vtkmodules.vtkIOCore import vtkAbstractPolyDataReader
+from vtkmodules.vtkIOGeometry import vtkOBJReader, vtkOBJWriter, vtkSTLReader
+from numpy import zeros, arange, array, concatenate, cumsum, diff, dot, maximum, minimum, ndarray, repeat
 from numpy.linalg import norm
+from numpy.random import default_rng
+from vtkmodules.util.numpy_support import (
+    get_numpy_array_type,
+    numpy_to_vtk,
+    numpy_to_vtkIdTypeArray,
+    vtk_to_numpy,
+)
 
 VtkAlgorithmOrPolyData = Union[vtkAlgorithm, vtkPolyData]
 Tuple3Float = Tuple[float, float, float]
 Vector3D = List[float]
 OBBType = Tuple[Vector3D, Vector3D, Vector3D, Vector3D]
+ID_TYPE = get_numpy_array_type(VTK_ID_TYPE)
+SMP_BACKEND_VARIABLE = "SLOPES_SMP_BACKEND"
+SMP_THREADS_VARIABLE = "SLOPES_SMP_THREADS"
 
 
 class Orientation:
@@ -103,7 +119,39 @@ class Orientation:
         axis_actor.GetAxisLinesProperty().BackfaceCullingOff()
         return axis_actor
 
+def configure_smp(
+    backend: Optional[str] = None, threads: Optional[int] = None
+) -> Tuple[str, int]:
+    """
+    Select the vtkSMPTools backend and thread count used by all multithreaded
+    vtk filters. Returns the backend in use and its estimated thread count.
+
+    Keyword Arguments:
+    backend - "Sequential", "STDThread", "TBB" or "OpenMP", depending on the
+    vtk build; defaults to the SLOPES_SMP_BACKEND environment variable
+    threads - maximum number of threads; defaults to the SLOPES_SMP_THREADS
+    environment variable. Without either, vtk's own default applies.
+    """
+    backend = backend or environ.get(SMP_BACKEND_VARIABLE)
+    if backend and not vtkSMPTools.SetBackend(backend):
+        raise ValueError(f"vtkSMPTools backend '{backend}' is not available")
+
+    if not threads and environ.get(SMP_THREADS_VARIABLE):
+        value = environ[SMP_THREADS_VARIABLE]
+        if not value.strip().isdigit():
+            raise ValueError(f"{SMP_THREADS_VARIABLE} must be a number of threads, not {value!r}")
+        threads = int(value)
+    if threads and threads < 0:
+        raise ValueError(f"number of threads must not be negative, not {threads}")
+    if threads:
+        vtkSMPTools.Initialize(threads)
+
+    return vtkSMPTools.GetBackend(), vtkSMPTools.GetEstimatedNumberOfThreads()
+
+
 def line_actor(point1: ndarray, point2:ndarray) -> vtkAxisActor:
+    from vtkmodules.vtkRenderingAnnotation import vtkAxisActor
+
     line_actor = vtkAxisActor()
     line_actor.SetPoint1(point1)
     line_actor.SetPoint2(point2)
@@ -334,12 +382,236 @@ def _calc_normals(polydata: vtkPolyData) -> vtkDataArray:
     return normals.GetOutput().GetPointData().GetNormals()
 
 
+def decimate(polydata: vtkPolyData, triangles: int = 0, max_error: float = 0.0) -> vtkPolyData:
+    """
+    Reduce a triangle mesh by quadric error decimation. Open boundaries
+    are kept in place by vtk's boundary constraints.
+
+    Keyword Arguments:
+    triangles - maximum number of triangles, 0 for no limit
+    max_error - stop before the surface moves by more than about this
+    distance; vtkQuadricDecimation's error is its square. 0 for no limit
+    Without either limit, or within the budget, "polydata" is returned.
+    """
+    count = polydata.GetNumberOfPolys()
+    if not count or (not max_error and not 0 < triangles < count):
+        return polydata
+    decimation = vtkQuadricDecimation()
+    decimation.SetInputData(polydata)
+    # an error bound alone reduces as far as it allows
+    decimation.SetTargetReduction(1.0 - triangles / count if 0 < triangles < count else 1.0)
+    if max_error:
+        decimation.SetMaximumError(max_error ** 2)
+    decimation.VolumePreservationOn()
+    decimation.Update()
+    return decimation.GetOutput()
+
+
+def _select_polys(arrays: Dict[str, ndarray], keep: ndarray) -> vtkPolyData:
+    """Geometry of the polygons flagged in "keep", with only the points they use."""
+    offsets, connectivity = arrays["polys_offsets"], arrays["polys_connectivity"]
+    lengths = diff(offsets)
+    kept = connectivity[repeat(keep, lengths)]
+    used = zeros(len(arrays["points"]), dtype=bool)
+    used[kept] = True
+    # new ids in the original order of the points
+    renumber = cumsum(used) - 1
+    selection = {
+        "points": arrays["points"][used],
+        "polys_offsets": concatenate([[0], cumsum(lengths[keep])]),
+        "polys_connectivity": renumber[kept],
+    }
+    if "normals" in arrays:
+        selection["normals"] = arrays["normals"][used]
+    return polydata_from_arrays(selection)
+
+
+def subsample_polys(polydata: vtkPolyData, count: int) -> vtkPolyData:
+    """
+    Return "count" polygons of a geometry, or the geometry itself if it
+    has no more: the polygons are split into "count" runs of consecutive
+    ones and one is drawn at random from each, the same on every call.
+    Neighbouring polygons of a mesh lie close to each other, so the
+    sample covers the surface evenly, and statistics over it such as its
+    oriented bounding box and center of mass stay close to those of the
+    geometry, unlike after decimation, which thins flat regions more than
+    detailed ones. Every k-th polygon would not do: meshes from label
+    maps repeat their triangle patterns.
+    """
+    total = polydata.GetNumberOfPolys()
+    if total <= count:
+        return polydata
+    # whole runs, so that no two runs share a polygon
+    bounds = arange(count + 1) * total // count
+    chosen = bounds[:-1] + (default_rng(0).random(count) * diff(bounds)).astype(int)
+    keep = zeros(total, dtype=bool)
+    keep[chosen] = True
+    return _select_polys(polydata_to_arrays(polydata, copy=False), keep)
+
+
+def extract_slab(
+    polydata: vtkPolyData, plane_origin: ndarray, plane_normal: ndarray, half_width: float
+) -> vtkPolyData:
+    """
+    Return the polygons of a geometry that reach into the slab of
+    "half_width" on either side of a plane, with only the points they use.
+    Clipping the result to the slab gives the same geometry as clipping
+    the whole one, at a cost that depends on the slab only.
+    """
+    arrays = polydata_to_arrays(polydata, copy=False)
+    if "polys_offsets" not in arrays:
+        return vtkPolyData()
+    offsets = arrays["polys_offsets"]
+    distances = (arrays["points"] - plane_origin).dot(plane_normal)[arrays["polys_connectivity"]]
+    if len(distances) == 3 * (len(offsets) - 1):
+        # column-wise, much faster than min(axis=1) on three columns
+        first, second, third = distances.reshape(-1, 3).T
+        lowest = minimum(minimum(first, second), third)
+        highest = maximum(maximum(first, second), third)
+    else:
+        lowest, highest = minimum.reduceat(distances, offsets[:-1]), maximum.reduceat(distances, offsets[:-1])
+    # a small margin keeps polygons that touch the slab in rounding
+    margin = 1e-6 * max(half_width, 1.0)
+    keep = (lowest <= half_width + margin) & (highest >= -half_width - margin)
+    return _select_polys(arrays, keep)
+
+
 def iter_points(polydata: vtkPolyData) -> Generator[Tuple3Float, None, None]:
     """Return generator over all vertices as tuple(x, y, z)."""
     for point_id in range(polydata.GetNumberOfPoints()):
         yield polydata.GetPoint(point_id)
 
 
+def memory_size(polydata: vtkPolyData) -> int:
+    """Return the memory held by a vtk data object in bytes."""
+    return polydata.GetActualMemorySize() * 1024
+
+
+def points_array(polydata: vtkPolyData) -> ndarray:
+    """Return a copy of all vertices as numpy array of shape (n, 3)."""
+    if polydata.GetNumberOfPoints() == 0:
+        return zeros((0, 3))
+    return vtk_to_numpy(polydata.GetPoints().GetData()).astype(float)
+
+
+def line_segments(polydata: vtkPolyData) -> ndarray:
+    """
+    Return all line segments of a geometry's (poly)lines as numpy array
+    of shape (m, 2). Each row holds the two point ids of one segment.
+    """
+    lines = polydata.GetLines()
+    connectivity = vtk_to_numpy(lines.GetConnectivityArray())
+    if len(connectivity) < 2:
+        return zeros((0, 2), dtype=int)
+    offsets = vtk_to_numpy(lines.GetOffsetsArray())
+
+    # a segment must not connect the last point of one polyline with the
+    # first point of the next one
+    starts_polyline = zeros(len(connectivity), dtype=bool)
+    starts_polyline[offsets[1:-1]] = True
+    first = connectivity[:-1][~starts_polyline[1:]]
+    second = connectivity[1:][~starts_polyline[1:]]
+    return array([first, second]).T
+
+
+def intersect_plane(
+    points: ndarray,
+    segments: ndarray,
+    plane_origin: ndarray,
+    plane_normal: ndarray,
+) -> ndarray:
+    """
+    Return all intersections between line segments and a plane as numpy
+    array of shape (k, 3). The numpy equivalent of cut_plane for lines.
+
+    Keyword Arguments:
+    points - vertex positions of shape (n, 3)
+    segments - point ids into "points" of shape (m, 2), see line_segments
+    plane_origin - some point on the cutting plane
+    plane_normal - orientation of the cutting plane
+    """
+    distances = (points - plane_origin).dot(plane_normal)
+    first, second = distances[segments[:, 0]], distances[segments[:, 1]]
+    crossing = (first * second <= 0.0) & (first != second)
+
+    ratio = first[crossing] / (first[crossing] - second[crossing])
+    start = points[segments[crossing, 0]]
+    end = points[segments[crossing, 1]]
+    return start + ratio[:, None] * (end - start)
+
+
+POLYDATA_CELL_TYPES = "verts", "lines", "polys", "strips"
+
+
+def polydata_to_arrays(polydata: vtkPolyData, copy: bool = True) -> Dict[str, ndarray]:
+    """
+    Return points, cells and point normals of a geometry as plain numpy
+    arrays, e.g. to send it to another process. Cells are stored per type
+    as "<type>_offsets" and "<type>_connectivity", see vtkCellArray.
+    Inverse of polydata_from_arrays.
+
+    Keyword Arguments:
+    polydata - geometry to convert
+    copy - if False, the arrays are views onto the geometry's memory
+    """
+    def as_numpy(vtk_array: vtkDataArray) -> ndarray:
+        array = vtk_to_numpy(vtk_array)
+        return array.copy() if copy else array
+
+    if polydata.GetNumberOfPoints() == 0:
+        arrays = {"points": zeros((0, 3))}
+    else:
+        arrays = {"points": as_numpy(polydata.GetPoints().GetData())}
+
+    for cell_type in POLYDATA_CELL_TYPES:
+        cells = getattr(polydata, f"Get{cell_type.capitalize()}")()
+        if cells.GetNumberOfCells() == 0:
+            continue
+        arrays[f"{cell_type}_offsets"] = as_numpy(cells.GetOffsetsArray())
+        arrays[f"{cell_type}_connectivity"] = as_numpy(cells.GetConnectivityArray())
+
+    normals = polydata.GetPointData().GetNormals()
+    if normals is not None:
+        arrays["normals"] = as_numpy(normals)
+    return arrays
+
+
+def polydata_from_arrays(arrays: Dict[str, ndarray], deep: bool = True) -> vtkPolyData:
+    """
+    Return a geometry built from numpy arrays as given by polydata_to_arrays.
+
+    Keyword Arguments:
+    arrays - points, cells and optionally normals
+    deep - if False, the geometry references the numpy buffers instead of
+    copying them. Cell arrays must then already be of vtkIdType.
+    """
+    polydata = vtkPolyData()
+
+    points = vtkPoints()
+    points.SetData(numpy_to_vtk(arrays["points"], deep=deep))
+    polydata.SetPoints(points)
+
+    for cell_type in POLYDATA_CELL_TYPES:
+        if f"{cell_type}_offsets" not in arrays:
+            continue
+        cells = vtkCellArray()
+        cells.SetData(
+            numpy_to_vtkIdTypeArray(
+                arrays[f"{cell_type}_offsets"].astype(ID_TYPE, copy=False), deep=deep
+            ),
+            numpy_to_vtkIdTypeArray(
+                arrays[f"{cell_type}_connectivity"].astype(ID_TYPE, copy=False), deep=deep
+            ),
+        )
+        getattr(polydata, f"Set{cell_type.capitalize()}")(cells)
+
+    if "normals" in arrays:
+        normals = numpy_to_vtk(arrays["normals"], deep=deep)
+        normals.SetName("Normals")
+        polydata.GetPointData().SetNormals(normals)
+    return polydata
+
+
 def iter_normals(polydata: vtkPolyData) -> Generator[Tuple3Float, None, None]:
     """Return generator over all vertice's normals as tuple(n_x, n_y, n_z)."""
     normals = _calc_normals(polydata)
@@ -354,10 +626,46 @@ def _load_geometry(filename: str, reader: vtkAbstractPolyDataReader) -> vtkPolyD
     return reader.GetOutput()
 
 def load_stl(filename: str) -> vtkPolyData:
-    """Load the given STL file, and return a vtkPolyData object for it."""
+    """
+    Load the given STL file, and return a vtkPolyData object for it.
+    A mesh inside a mesh archive is given as "<archive>.spz#<name>", one
+    inside a mesh pack as "<pack>.meshpack#<spine>/<level>", and a level
+    of a labelled surface or label map as "<surface>#<level>".
+    """
+    # pylint: disable=import-outside-toplevel
+    from label_volume import is_volume_member, load_volume_member
+    from labelled_surface import is_surface_member, load_surface_member
+    from mesh_archive import is_member, load_member
+    from mesh_pack import is_pack_member, load_pack_member
+
+    if is_member(filename):
+        return load_member(filename)
+    if is_pack_member(filename):
+        return load_pack_member(filename)
+    if is_surface_member(filename):
+        return load_surface_member(filename)
+    if is_volume_member(filename):
+        return load_volume_member(filename)
     return _load_geometry(filename, reader=vtkSTLReader())
 
 
+def mesh_exists(filename: str) -> bool:
+    """
+    Whether "filename", as taken by load_stl, exists. For a member of an
+    archive, pack, labelled surface or label map, only the container is
+    checked; a missing member is reported by load_stl.
+    """
+    # pylint: disable=import-outside-toplevel
+    from label_volume import is_volume_member
+    from labelled_surface import is_surface_member
+    from mesh_archive import is_member
+    from mesh_pack import is_pack_member
+
+    if any(member(filename) for member in (is_member, is_pack_member, is_surface_member, is_volume_member)):
+        return exists(filename.rpartition("#")[0])
+    return isfile(filename)
+
+
 def load_obj(filename: str) -> vtkPolyData:
     """Load the given STL file, and return a vtkPolyData object for it."""
     return _load_geometry(filename, reader=vtkOBJReader())
@@ -395,6 +703,10 @@ def _make_actor(
         line = vtkLine()
         line_actor = _make_actor("SetInputData", line, opacity=0.5)
     """
+    # pylint: disable=import-outside-toplevel,unused-import
+    import vtkmodules.vtkRenderingOpenGL2  # registers the mapper implementation
+    from vtkmodules.vtkRenderingCore import vtkActor, vtkPolyDataMapper
+
     mapper = vtkPolyDataMapper()
     getattr(mapper, input_method)(input_data)
 
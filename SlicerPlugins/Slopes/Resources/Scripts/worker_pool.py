@@ -0,0 +1,279 @@
+"""
+Supervised worker processes for batch runs.
+
+Unlike concurrent.futures, the SupervisedPool can take a job away from a
+worker: each worker owns a pipe to the supervisor, reports progress per
+step (e.g. per vertebra), and is killed and replaced once its job exceeds
+the wall-clock limits. A worker is also replaced after a number of jobs
+or once its resident memory exceeds a ceiling, since long-lived processes
+creating many vtk objects slowly grow. Jobs whose worker was killed or
+crashed are reported with their id instead of stalling the run.
+
+Usage:
+    def work(job, progress):
+        for step, item in enumerate(job.items):
+            progress(step)
+            ...
+        return result
+
+    pool = SupervisedPool(work, workers=4, limits=Limits(job_timeout=600, step_timeout=120))
+    for outcome in pool.map(jobs):
+        ...
+    print(pool.report())
+"""
+from __future__ import annotations
+
+import multiprocessing
+import os
+
+from dataclasses import dataclass, replace
+from multiprocessing.connection import Connection, wait
+from time import monotonic
+from typing import Callable, Iterable, Iterator, List, Optional
+
+KIB = 1024
+MIB = 1024 * KIB
+
+
+@dataclass(frozen=True)
+class Limits:
+    """
+    Keyword Arguments:
+    job_timeout - wall-clock seconds per job, e.g. per spine
+    step_timeout - wall-clock seconds between two progress reports, e.g. per vertebra
+    max_tasks - jobs per worker before it is replaced
+    max_rss - resident bytes after a job above which its worker is replaced
+    """
+    job_timeout: Optional[float] = None
+    step_timeout: Optional[float] = None
+    max_tasks: Optional[int] = None
+    max_rss: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class Outcome:
+    job: object
+    result: object = None
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass(frozen=True)
+class KilledJob:
+    job_id: str
+    reason: str
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes, its peak where unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource  # pylint: disable=import-outside-toplevel
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * KIB
+
+
+def _serve(connection: Connection, work: Callable, initializer: Optional[Callable]) -> None:
+    def progress(step: int) -> None:
+        connection.send(("progress", step))
+
+    if initializer is not None:
+        initializer()
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        connection.send(("started",))
+        try:
+            connection.send(("done", work(job, progress), current_rss()))
+        except Exception as error:
+            connection.send(("failed", repr(error), current_rss()))
+
+
+class _Worker:
+    def __init__(self, context, work: Callable, initializer: Optional[Callable]) -> None:
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, work, initializer), daemon=True)
+        self.process.start()
+        child.close()
+        self.tasks = 0
+        self.job = None
+        self.started = 0.0
+        self.progressed = 0.0
+        self.step = None
+
+    def submit(self, job: object) -> None:
+        self.job = job
+        self.started = self.progressed = monotonic()
+        self.step = None
+        self.tasks += 1
+        self.connection.send(job)
+
+    def deadline(self, limits: Limits) -> float:
+        deadlines = [float("inf")]
+        if limits.job_timeout is not None:
+            deadlines.append(self.started + limits.job_timeout)
+        if limits.step_timeout is not None:
+            deadlines.append(self.progressed + limits.step_timeout)
+        return min(deadlines)
+
+    def stop(self) -> None:
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        self.kill()
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class SupervisedPool:
+    """
+    Runs work(job, progress) for every job in "workers" supervised processes.
+
+    Keyword Arguments:
+    work - picklable callable; it reports progress by calling progress(step)
+    workers - number of worker processes
+    limits - timeouts and recycling thresholds
+    job_id - name of a job in reports
+    initializer - called once in every new worker before its first job,
+    not counted against the timeouts
+    """
+
+    def __init__(
+        self,
+        work: Callable,
+        workers: int,
+        limits: Limits = Limits(),
+        job_id: Callable[[object], str] = str,
+        initializer: Optional[Callable] = None,
+    ) -> None:
+        self.work = work
+        self.workers = max(workers, 1)
+        self.limits = limits
+        self.job_id = job_id
+        self.initializer = initializer
+        self.killed: List[KilledJob] = []
+        self.recycled = 0
+        self.busy = 0.0
+        self.wall_time = 0.0
+        # optional prediction to compare against in report, see cost_model.Plan
+        self.plan = None
+        self._context = multiprocessing.get_context()
+
+    def map(self, jobs: Iterable) -> Iterator[Outcome]:
+        """
+        Yield an Outcome per job, in the order they finish. "jobs" may yield
+        None while its next job depends on the outcome of a running one;
+        map then waits for an outcome before asking again.
+        """
+        jobs = iter(jobs)
+        start = monotonic()
+        idle = [self._spawn() for _ in range(self.workers)]
+        busy: List[_Worker] = []
+        try:
+            while True:
+                while idle:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    worker = idle.pop()
+                    worker.submit(job)
+                    busy.append(worker)
+                if not busy:
+                    return
+
+                now = monotonic()
+                timeout = max(min(w.deadline(self.limits) for w in busy) - now, 0.0)
+                ready = wait([w.connection for w in busy], timeout=min(timeout, 3600.0))
+
+                for worker in list(busy):
+                    if worker.connection in ready:
+                        outcome = self._receive(worker)
+                        if outcome is None:
+                            continue
+                        busy.remove(worker)
+                        idle.append(outcome[1])
+                        yield self._timed(outcome[0], worker)
+                    elif monotonic() >= worker.deadline(self.limits):
+                        busy.remove(worker)
+                        idle.append(self._replace(worker, self._timeout_reason(worker)))
+                        yield self._timed(Outcome(worker.job, error=self.killed[-1].reason), worker)
+        finally:
+            for worker in idle + busy:
+                worker.kill()
+            self.wall_time = monotonic() - start
+
+    def _timed(self, outcome: Outcome, worker: _Worker) -> Outcome:
+        seconds = monotonic() - worker.started
+        self.busy += seconds
+        return replace(outcome, seconds=seconds)
+
+    def _receive(self, worker: _Worker):
+        """
+        Handle one message of a busy worker. Return the finished job's
+        Outcome with the worker to use next, or None while it is still busy.
+        """
+        try:
+            message = worker.connection.recv()
+        except (EOFError, OSError):
+            worker.process.join()
+            reason = f"worker crashed with exit code {worker.process.exitcode}"
+            return Outcome(worker.job, error=reason), self._replace(worker, reason)
+
+        if message[0] == "started":
+            worker.started = worker.progressed = monotonic()
+            return None
+        if message[0] == "progress":
+            worker.step = message[1]
+            worker.progressed = monotonic()
+            return None
+
+        status, value, rss = message
+        outcome = Outcome(worker.job, result=value) if status == "done" else Outcome(worker.job, error=value)
+        if self.limits.max_tasks is not None and worker.tasks >= self.limits.max_tasks:
+            return outcome, self._recycle(worker)
+        if self.limits.max_rss is not None and rss > self.limits.max_rss:
+            return outcome, self._recycle(worker)
+        return outcome, worker
+
+    def _timeout_reason(self, worker: _Worker) -> str:
+        elapsed = monotonic() - worker.started
+        if self.limits.job_timeout is not None and elapsed >= self.limits.job_timeout:
+            return f"killed after {elapsed:.0f} s, job timeout"
+        step = "the first step" if worker.step is None else f"step {worker.step}"
+        return f"killed after {elapsed:.0f} s, {step} exceeded the step timeout"
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self._context, self.work, self.initializer)
+
+    def _replace(self, worker: _Worker, reason: str) -> _Worker:
+        self.killed.append(KilledJob(self.job_id(worker.job), reason))
+        worker.kill()
+        return self._spawn()
+
+    def _recycle(self, worker: _Worker) -> _Worker:
+        self.recycled += 1
+        worker.stop()
+        return self._spawn()
+
+    def report(self) -> str:
+        lines = [
+            f"wall time: {self.wall_time:.2f} s, busy {self.busy:.2f} s",
+            f"workers: {self.workers}, recycled {self.recycled}, killed {len(self.killed)}",
+        ]
+        if self.plan is not None:
+            lines.append(self.plan.report(self.wall_time, self.busy))
+        lines += [f"killed {k.job_id}: {k.reason}" for k in self.killed]
+        return "\n".join(lines)
@@ -28,6 +28,7 @@ def from_module_import(module_name: str, *elements: Tuple[str]) -> Tuple[Any]:
     return tuple(sys.modules[module_name].__dict__[el] for el in elements)
 
 from_module_import("vtk_convenience")
+from_module_import("shared_mesh")
 Spine, Endplate = from_module_import("morphology", "Spine", "Endplate")
 
 #
@@ -665,9 +666,7 @@ class SlopesLogic(ScriptedLoadableModuleLogic):
             geometryName = inputGeometry.GetName()
             self.names.append(geometryName)
 
-            upperCurvePoints = self.getPoints(vertebra.body.curves[Endplate.UPPER], main_axis=vertebra.orientation.front)
-            firstPoint = np.array(upperCurvePoints[0])
-            lastPoint = np.array(upperCurvePoints[-1])
+            firstPoint, lastPoint = vertebra.body.curve_records[Endplate.UPPER].extrema
             distance = np.linalg.norm(lastPoint-firstPoint)
             lastPoint = firstPoint + distance * vertebra.body.regressions[Endplate.UPPER]
 
@@ -677,15 +676,6 @@ class SlopesLogic(ScriptedLoadableModuleLogic):
             self.add(vertebra.body.endplates, parentId=bodyDirectory, name=geometryName)
             self.add(vertebra.body.curves[Endplate.UPPER], parentId=sliceDirectory, name=geometryName)
 
-    @staticmethod
-    def getPoints(polydata, main_axis):
-        points = [polydata.GetPoint(id_) for id_ in range(polydata.GetNumberOfPoints())]
-
-        main_axis = np.array(main_axis)
-        projection = lambda p: np.array(p).dot(main_axis)
-
-        return sorted(points, key=projection)
-        
     def add(self, polydata, parentId, name):
         modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", name)
         modelNode.SetAndObservePolyData(polydata)